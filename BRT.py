@@ -4,26 +4,109 @@
 
 from __future__ import print_function, division, absolute_import
 
-import os, tempfile, shutil
+import os, tempfile, shutil, re
 from requests import session
+from requests.adapters import HTTPAdapter
 import requests
+from http.cookiejar import LWPCookieJar, LoadError
 from bs4 import BeautifulSoup
 import json
-from io import StringIO, BytesIO
+from io import BytesIO
 from zipfile import ZipFile, BadZipFile
 import time
+import calendar
 from os import path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue
 
+import numpy as np
 from astropy.io import fits
 from astropy.coordinates import SkyCoord, Longitude, Latitude
+from astropy.coordinates.name_resolve import NameResolveError
 from astropy.time import Time
 
 import logging
+import diskcache
+
+from transport import default as default_transport
+import jobcache
+from metrics import registry as metrics
 
 def cleanup(s):
     return s.encode('ascii','ignore').decode('ascii','ignore')
 
 
+# Keys of the job data returned by get_job
+job_keys=('type', 'oid', 'tele', 'filter', 'exp', 'completion')
+
+# Keys of get_job for the columns of the job search results holding
+# the same data
+search_columns={
+    'object_type': 'type',
+    'object_id': 'oid',
+    'telescope': 'tele',
+    'telescope_type_name': 'tele',
+    'filter': 'filter',
+    'filter_type': 'filter',
+    'exposure': 'exp',
+    'exposure_time': 'exp',
+    'completion_time': 'completion',
+}
+
+
+def parse_completion(text):
+    '''
+    The completion time of the job (as in get_job) from its text.
+    '''
+    t=text.split()
+    return t[3:6]+[t[6][1:]]+[t[7][:-1]]
+
+
+def parse_search_results(html):
+    '''
+    Parse the job search results page into a list of records: dictionaries
+    with the jid, the columns of the results table under 'columns' (keyed
+    by the column header, lowercase, words joined by _) and the get_job
+    data (job_keys) of the columns known to hold it (search_columns),
+    in the get_job format. The keys which cannot be filled are missing,
+    so the record is complete only if it has all job_keys.
+    '''
+    soup = BeautifulSoup(html,'lxml')
+    keys=[]
+    res=[]
+    for l in soup.findAll('tr'):
+        th=l.findAll('th')
+        if th :
+            keys=['_'.join(re.findall(r'\w+', cleanup(c.text).lower())) for c in th]
+            continue
+        try :
+            a=l.find('a').get('href')
+        except AttributeError :
+            continue
+        jid=a.rfind('jid')
+        if jid<=0 :
+            continue
+        cols={}
+        for n, c in enumerate(l.findAll('td')):
+            k=keys[n] if n < len(keys) and keys[n] else 'col%d' % n
+            cols[k]=cleanup(c.text).strip()
+        r={'jid': int(a[jid+4:].split('&')[0]), 'columns': cols}
+        for k, v in cols.items():
+            if k not in search_columns or not v :
+                continue
+            key=search_columns[k]
+            if key == 'completion' :
+                try :
+                    v=parse_completion(v)
+                except IndexError :
+                    continue
+            elif key == 'tele' :
+                v=v.lower()
+            r.setdefault(key, v)
+        res.append(r)
+    return res
+
+
 # TODO: Cache the downloads to not re-download the same data again if possible.
 # TODO: Better error handling.
 
@@ -59,14 +142,87 @@ class Telescope :
         26: "Other error",
     }
 
-    def __init__(self,user,passwd,cache='.cache/jobs'):
+    def __init__(self,user,passwd,cache='.cache/jobs', cookies=None, poolsize=10,
+                 transport=None, cache_format='zip'):
+        '''
+        Open the session to telescope.org. The session cookies are kept
+        in the cookies file (by default session.cookies next to the
+        cache directory; pass False to disable) and reused if the saved
+        session is still valid, otherwise a fresh login is performed.
+        poolsize is the number of kept-alive connections.
+        All requests go through the transport (rate limit and retries,
+        see transport.Transport); by default one transport is shared
+        by all Telescope objects.
+        With cache_format='fits' the layer archives are kept in the cache
+        as tile-compressed FITS files (see fitscache).
+        '''
         self.s=None
+        self.transport=default_transport if transport is None else transport
         self.user=user
         self.passwd=passwd
         self.tout=60
         self.retry=15
-        self.login()
         self.cache=cache
+        self.cache_format=cache_format
+        if cookies is None :
+            cookies=path.join(path.dirname(path.normpath(cache)), 'session.cookies')
+        self.cookies=cookies
+        self.poolsize=poolsize
+        self.new_session()
+        if not (self.load_cookies() and self.is_logged_in()):
+            self.login()
+
+    def new_session(self):
+        '''
+        Create the HTTP session with the connection pool sized for
+        poolsize concurrent connections.
+        '''
+        self.s=session()
+        adapter=HTTPAdapter(pool_connections=self.poolsize,
+                            pool_maxsize=self.poolsize)
+        self.s.mount('https://', adapter)
+        self.s.mount('http://', adapter)
+        if self.cookies :
+            self.s.cookies=LWPCookieJar(self.cookies)
+
+    def load_cookies(self):
+        '''
+        Load the saved session cookies. Returns True on success.
+        '''
+        log = logging.getLogger(__name__)
+        if not self.cookies or not path.isfile(self.cookies) :
+            return False
+        try :
+            self.s.cookies.load(ignore_discard=True)
+        except (LoadError, OSError) as e :
+            log.warning('Cannot load cookies from %s: %s', self.cookies, e)
+            return False
+        log.debug('Session cookies loaded from %s', self.cookies)
+        return True
+
+    def save_cookies(self):
+        if not self.cookies :
+            return
+        d=path.dirname(self.cookies)
+        if d :
+            os.makedirs(d, exist_ok=True)
+        self.s.cookies.save(ignore_discard=True)
+        os.chmod(self.cookies, 0o600)
+
+    def is_logged_in(self):
+        '''
+        Probe the validity of the current session with a cheap API call.
+        '''
+        log = logging.getLogger(__name__)
+        try :
+            rq=self._send('POST', self.url+"api-user.php",
+                          data={'module': "request-manager",
+                                'request': "0-get-my-folders"}, retry=True)
+            ok=bool(json.loads(rq.content).get('success', False))
+        except (ValueError, requests.RequestException) :
+            ok=False
+        log.debug('Session valid: %s', ok)
+        return ok
 
     def login(self):
         log = logging.getLogger(__name__)
@@ -74,15 +230,72 @@ class Telescope :
                    'username': self.user,
                    'password': self.passwd,
                    'stayloggedin': 'true'}
-        log.debug('Get session ...')
-        self.s=session()
+        if self.s is None :
+            log.debug('Get session ...')
+            self.new_session()
+        self.s.cookies.clear()
         log.debug('Logging in ...')
-        self.s.post(self.url+'login.php', data=payload)
+        self._send('POST', self.url+'login.php', data=payload)
+        self.save_cookies()
 
     def logout(self):
-        if self.s is None :
-            self.s.post(self.url+'logout.php')
+        if self.s is not None :
+            self._send('POST', self.url+'logout.php')
             self.s=None
+            if self.cookies and path.isfile(self.cookies) :
+                os.remove(self.cookies)
+
+    @staticmethod
+    def is_login_page(rq):
+        '''
+        Check if the response is the login form (i.e. the session expired).
+        '''
+        if 'login.php' in rq.url :
+            return True
+        if not rq.headers.get('Content-Type', '').startswith('text/html'):
+            return False
+        t=rq.text
+        return 'name="password"' in t and 'name="username"' in t
+
+    def _send(self, method, url, **kwargs):
+        return self.transport.request(self.s, method, url, **kwargs)
+
+    def _request(self, method, page, **kwargs):
+        '''
+        Do the request to the page of the site. If the session turns out
+        to be expired, log in again and repeat the request once.
+        '''
+        log = logging.getLogger(__name__)
+        rq=self._send(method, self.url+page, **kwargs)
+        if self.is_login_page(rq):
+            log.info('Session expired. Logging in again ...')
+            # Free the connection (and the in-flight slot of a streamed response)
+            rq.close()
+            self.login()
+            rq=self._send(method, self.url+page, **kwargs)
+        return rq
+
+    def _get(self, page, **kwargs):
+        return self._request('GET', page, **kwargs)
+
+    def _post(self, page, data=None, **kwargs):
+        return self._request('POST', page, data=data, **kwargs)
+
+    def get_user_requests_page(self, sort='rid', folder=1, limit=100, start=0):
+        '''
+        Get one page of user requests from folder: limit requests
+        after the first start rows, sorted by sort column.
+        Returns the total number of requests in the folder and
+        the list of dictionaries with the requests on the page.
+        '''
+        params={
+            'limit': limit,
+            'sort': sort,
+            'folderid': folder}
+        if start :
+            params['startAfterRow']=start
+        dat=self.do_rm_api("1-get-list-own", params)
+        return int(dat['data']['totalRequests']), dat['data']['requests']
 
     def get_user_requests(self, sort='rid', folder=1):
         '''
@@ -93,29 +306,13 @@ class Telescope :
         '''
 
         #fetch first batch        
-        params={
-            'limit': 100,
-            'sort': sort,
-            'folderid': folder}
-
-        rq = self.s.post(self.url+"api-user.php", {'module': "request-manager", 
-                                                   'request': "1-get-list-own",
-                                                   'params' : json.dumps(params)})
-        res=[]
-        dat=json.loads(rq.content)
-        total=int(dat['data']['totalRequests'])
-        res+=dat['data']['requests']
+        total, res = self.get_user_requests_page(sort, folder, 100)
 
         # Fetch the rest
-        params['limit']=total-len(res)
-        params['startAfterRow']=len(res)
-        rq = self.s.post(self.url+"api-user.php", {'module': "request-manager", 
-                                                   'request': "1-get-list-own",
-                                                   'params' : json.dumps(params)})
-
-        dat=json.loads(rq.content)
-        total=int(dat['data']['totalRequests'])
-        res+=dat['data']['requests']
+        if total > len(res):
+            total, rest = self.get_user_requests_page(sort, folder,
+                                                      total-len(res), len(res))
+            res+=rest
         return res
 
 
@@ -123,12 +320,101 @@ class Telescope :
         '''
         Get all user folders. Returns list of dictionaries.
         '''
-        rq = self.s.post(self.url+"api-user.php", {'module': "request-manager", 
-                                                   'request': "0-get-my-folders"})
-        return json.loads(rq.content)['data']
+        return self.do_rm_api("0-get-my-folders")['data']
+
+
+    # Maximum number of rows of the job search results page
+    search_limit=1000
+
+    def _search_window(self, start, end, filtertype='', telescope=''):
+        '''
+        One job search for the jobs completed between start and end
+        (seconds from the epoch, in the time scale of get_obs_list,
+        minute resolution). Returns the list of job records (at most
+        search_limit, see parse_search_results).
+        '''
+        st=time.gmtime(start)
+        et=time.gmtime(end)
+
+        log = logging.getLogger(__name__)
+        log.debug('%s -> %s', time.strftime('%d/%m/%Y %H:%M', st),
+                               time.strftime('%d/%m/%Y %H:%M', et))
+
+        searchdat = {
+            'sort1':'completetime',
+            'sort1order':'desc',
+            'searchearliestcom[]':[st.tm_mday, st.tm_mon, st.tm_year,
+                                   str(st.tm_hour), str(st.tm_min)],
+            'searchlatestcom[]':  [et.tm_mday, et.tm_mon, et.tm_year,
+                                   str(et.tm_hour), str(et.tm_min)],
+            'searchstatus[]':['1'],
+            'resultsperpage':str(self.search_limit),
+            'searchfilter':filtertype,
+            'searchtelescope':telescope,
+            'submit':'Go'
+        }
+
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+
+        request = self._post('v3job-search-query.php',
+                         data=searchdat, headers=headers, retry=True)
+        return parse_search_results(request.text)
+
+    def scan_jobs(self, start, end, window=7*86400, filtertype='', camera='', workers=4,
+                  where=None):
+        '''
+        Generator of the records (see parse_search_results) of all jobs
+        completed between start and end (seconds from the epoch, as t in
+        get_obs_list). The range is split into windows searched
+        concurrently; a window hitting the row limit of the search page
+        is bisected and searched again, so the scan is complete however
+        many jobs there are. Every job is yielded once, as soon as its
+        window is done (the order is not preserved). If where is given,
+        only the records r with where(r) true are yielded.
+        '''
+        log = logging.getLogger(__name__)
+        try :
+            telescope=self.cameratypes[camera.lower()]
+        except KeyError:
+            telescope=''
 
+        seen=set()
+        edges=list(range(int(start), int(end), int(window)))+[int(end)]
+        with ThreadPoolExecutor(workers) as ex :
+            pending={ex.submit(self._search_window, a, b, filtertype, telescope): (a, b)
+                        for a, b in zip(edges[:-1], edges[1:])}
+            while pending :
+                f=next(as_completed(pending))
+                a, b = pending.pop(f)
+                recs=f.result()
+                if len(recs) >= self.search_limit and b-a > 120 :
+                    # Truncated page: search the halves (on minute boundaries)
+                    m=a+(b-a)//120*60
+                    log.debug('Window %d-%d truncated, bisecting', a, b)
+                    metrics.inc('search_bisections_total')
+                    for w in ((a, m), (m, b)):
+                        pending[ex.submit(self._search_window, w[0], w[1],
+                                          filtertype, telescope)]=w
+                    continue
+                if len(recs) >= self.search_limit :
+                    log.warning('%d+ jobs in one minute, results truncated', len(recs))
+                for r in recs:
+                    if r['jid'] not in seen :
+                        seen.add(r['jid'])
+                        if where is None or where(r) :
+                            yield r
+
+    def scan_obs(self, start, end, window=7*86400, filtertype='', camera='', workers=4,
+                 where=None):
+        '''
+        Generator of the JIDs of the jobs found by scan_jobs.
+        '''
+        for r in self.scan_jobs(start, end, window, filtertype, camera, workers, where):
+            yield r['jid']
 
-    def get_obs_list(self, t=None, dt=1, filtertype='', camera='', hour=16, minute=0):
+    def get_obs_list(self, t=None, dt=1, filtertype='', camera='', hour=16, minute=0,
+                     where=None):
         '''Get the dt days of observations taken no later then time in t.
 
             Input
@@ -138,67 +424,42 @@ class Telescope :
             dt - number of days, default to 1
             filtertype - filter by type of filter used
             camera - filter by the camera/telescope used
+            where - function selecting the records of the search
+                    results (see parse_search_results)
 
             Output
             ------
             Returns a list of JobIDs (int) for the observations.
+            Long ranges are scanned in windows (see scan_obs),
+            so the list is not truncated.
 
         '''
 
+        return [r['jid'] for r in self.search_jobs(t, dt, filtertype, camera,
+                                                   hour, minute, where)]
+
+    def search_jobs(self, t=None, dt=1, filtertype='', camera='', hour=16, minute=0,
+                    where=None):
+        '''
+        As get_obs_list but returns the job records of the search results
+        (see parse_search_results), which carry the get_job data available
+        in the results table without fetching each job.
+        '''
+
         assert(self.s is not None)
 
         if t is None :
             t=time.time()-time.timezone
 
-
+        # The days start at hour:minute
         st=time.gmtime(t-86400*dt)
         et=time.gmtime(t)
+        start=calendar.timegm((st.tm_year, st.tm_mon, st.tm_mday, hour, minute, 0))
+        end=calendar.timegm((et.tm_year, et.tm_mon, et.tm_mday, hour, minute, 0))
 
-        d=st.tm_mday
-        m=st.tm_mon
-        y=st.tm_year
-        de=et.tm_mday
-        me=et.tm_mon
-        ye=et.tm_year
-
-        log = logging.getLogger(__name__)
-        log.debug('%d/%d/%d -> %d/%d/%d', d,m,y,de,me,ye)
-
-        try :
-            telescope=self.cameratypes[camera.lower()]
-        except KeyError:
-            telescope=''
-
-        searchdat = {
-            'sort1':'completetime',
-            'sort1order':'desc',
-            'searchearliestcom[]':[d, m, y, str(hour),str(minute)],
-            'searchlatestcom[]':  [de,me,ye,str(hour),str(minute)],
-            'searchstatus[]':['1'],
-            'resultsperpage':'1000',
-            'searchfilter':filtertype,
-            'searchtelescope':telescope,
-            'submit':'Go'
-        }
-
-        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-
-
-        request = self.s.post(self.url+'v3job-search-query.php',
-                         data=searchdat, headers=headers)
-        soup = BeautifulSoup(request.text,'lxml')
-
-        jlst=[]
-        for l in soup.findAll('tr'):
-            try :
-                a=l.find('a').get('href')
-            except AttributeError :
-                continue
-            jid=a.rfind('jid')
-            if jid>0 :
-                jid=a[jid+4:].split('&')[0]
-                jlst.append(int(jid))
-        return jlst
+        # One-day windows, searched concurrently; only the full ones are bisected
+        return list(self.scan_jobs(start, end, 86400, filtertype, camera,
+                                   where=where))
 
     def get_job(self,jid=None):
         '''Get a job data for a given JID'''
@@ -211,7 +472,7 @@ class Telescope :
 
         obs={}
         obs['jid']=jid
-        rq=self.s.post(self.url+('v3cjob-view.php?jid=%d' % jid))
+        rq=self._post('v3cjob-view.php?jid=%d' % jid, retry=True)
         soup = BeautifulSoup(rq.text, 'lxml')
         for l in soup.findAll('tr'):
             log.debug(cleanup(l.text))
@@ -228,8 +489,7 @@ class Telescope :
                 if txt.find('Exposure Time') >= 0:
                     obs['exp']=f.text
                 if txt.find('Completion Time') >= 0:
-                    t=f.text.split()
-                    obs['completion']=t[3:6]+[t[6][1:]]+[t[7][:-1]]
+                    obs['completion']=parse_completion(f.text)
                 if txt.find('Status') >= 0:
                     obs['status']= (f.text == 'Success')
 
@@ -239,31 +499,42 @@ class Telescope :
         return obs
 
 
+    def _write_obs(self, obs, fd, cube=False):
+        '''Stream the raw observation obs into the open file fd.'''
+
+        rq=self._get('v3image-download%s.php?jid=%d' %
+                        ('' if cube else '-layers', obs['jid']),
+                     stream=True)
+        try :
+            for chunk in rq.iter_content(65536):
+                fd.write(chunk)
+                metrics.inc('download_bytes_total', len(chunk))
+        finally :
+            rq.close()
+
     def download_obs(self,obs=None, directory='.', cube=False):
         '''Download the raw observation obs (obtained from get_job) into zip
         file named job_jid.zip located in the directory (current by default).
         Alternatively, when the cube=True the file will be a 3D fits file.
+        The file appears only when complete and valid.
         The name of the file (without directory) is returned.'''
 
         assert(obs is not None)
         assert(self.s is not None)
 
-        rq=self.s.get(self.url+
-                      ('v3image-download%s.php?jid=%d' %
-                        ('' if cube else '-layers', obs['jid'])),
-                      stream=True)
-
         fn = ('%(jid)d.' % obs) + ('fits' if cube else 'zip')
-        with open(path.join(directory, fn), 'wb') as fd:
-            for chunk in rq.iter_content(512):
-                fd.write(chunk)
+        with jobcache.publishing(path.join(directory, fn)) as fd:
+            self._write_obs(obs, fd, cube)
         return fn
 
 
     def get_obs(self,obs=None, cube=False, recurse=True):
         '''Get the raw observation obs (obtained from get_job) into zip
         file-like object. The function returns ZipFile structure of the
-        downloaded data.'''
+        downloaded data (or the open file for cube=True); close it when done.
+        The cache may be shared by many processes: each job is
+        downloaded only once and published atomically (see jobcache).
+        Raises jobcache.InvalidEntry if no valid archive can be obtained.'''
 
         assert(obs is not None)
         assert(self.s is not None)
@@ -272,94 +543,252 @@ class Telescope :
 
         fn = ('%(jid)d.' % obs) + ('fits' if cube else 'zip')
         fp = path.join(self.cache,fn[0],fn[1],fn)
-        if not path.isfile(fp) :
-            log.info('Getting %s from server', fp)
-            os.makedirs(path.dirname(fp), exist_ok=True)
-            self.download_obs(obs,path.dirname(fp),cube)
-        else :
-            log.info('Getting %s from cache', fp)
-        content = open(fp,'rb')
+        if not cube and self.cache_format == 'fits' :
+            return self._get_obs_compressed(obs, fp)
+        try :
+            downloaded=jobcache.fetch(fp, lambda fd: self._write_obs(obs, fd, cube))
+        except jobcache.InvalidEntry as e :
+            log.warning('Invalid download: %s', e)
+            if recurse :
+                return self.get_obs(obs, cube, False)
+            raise
+        metrics.hit('jobs', not downloaded)
+        log.info('Getting %s from %s', fp, 'server' if downloaded else 'cache')
+        if cube :
+            return open(fp,'rb')
         try :
-            return content if cube else ZipFile(content)
-        except BadZipFile :
-            # Probably corrupted download. Try again once.
-            content.close()
+            return ZipFile(fp)
+        except BadZipFile as e :
+            # Corrupted entry from an older cache. Try again once.
             os.remove(fp)
             if recurse :
                 return self.get_obs(obs, cube, False)
-            else :
-                return None
+            raise jobcache.InvalidEntry('%s: %s' % (fp, e))
 
-    def download_obs_processed(self,obs=None, directory='.', cube=False):
-        '''Download the raw observation obs (obtained from get_job) into zip
-        file named job_jid.zip located in the directory (current by default).
-        Alternatively, when the cube=True the file will be a 3D fits file.
-        The name of the file (without directory) is returned.'''
+    def cached_obs(self, jid):
+        '''The file of the job jid in the cache (the layer archive, zip or
+        tile-compressed) or None if the job is not cached. Nothing is
+        requested from the server.'''
+        import fitscache
 
-        assert(obs is not None)
-        assert(self.s is not None)
-
-        log = logging.getLogger(__name__)
-
-        fn=None
+        fn = '%d.zip' % jid
+        fp = path.join(self.cache,fn[0],fn[1],fn)
+        for f in (fp[:-len('.zip')]+fitscache.suffix, fp):
+            if path.isfile(f) :
+                return f
+        return None
 
-        tout=self.tout
+    def _get_obs_compressed(self, obs, fp):
+        '''
+        get_obs for the tile-compressed cache: the archive is transcoded
+        right after the download and only the compressed file is kept.
+        If the transcoding fails the zip archive is kept (and returned);
+        the transcoding is tried again at the next call.
+        '''
+        import fitscache
 
-        while tout > 0 :
-            rq=self.s.get(self.url+
-                          ('imageengine-request.php?jid=%d&type=%d' %
-                            (obs['jid'], 1 if cube else 3 )))
+        log = logging.getLogger(__name__)
+        fz = fp[:-len('.zip')]+fitscache.suffix
+        hit = path.isfile(fz)
+        if not hit :
+            os.makedirs(path.dirname(fp), exist_ok=True)
+            with jobcache.locked(fz):
+                hit = path.isfile(fz)
+                if not hit :
+                    if not path.isfile(fp) :
+                        log.info('Getting %s from server', fp)
+                        with jobcache.publishing(fp) as fd:
+                            self._write_obs(obs, fd)
+                    try :
+                        fitscache.transcode(fp, fz)
+                    except (BadZipFile, OSError, ValueError) as e :
+                        log.warning('Cannot transcode %s, keeping the zip: %s', fp, e)
+                        metrics.hit('jobs', False)
+                        return ZipFile(fp)
+                    os.remove(fp)
+        metrics.hit('jobs', hit)
+        if hit :
+            log.info('Getting %s from cache', fz)
+        return fitscache.CompressedArchive(fz)
+
+    def ingest_obs(self, obs, callback=None):
+        '''Download the layers of the observation obs into the cache,
+        decompressing the archive while it arrives. callback(n, name, hdu)
+        is called for every layer as soon as its last byte is in, so the
+        layers can be queued for solving while the rest downloads (keep
+        the callback quick). Returns the number of layers, or None if
+        the job is in the cache already.'''
+
+        import zipstream
 
-            soup = BeautifulSoup(rq.text, 'lxml')
-            dlif=soup.find('iframe')
+        assert(obs is not None)
+        assert(self.s is not None)
 
-            try :
-                dl=dlif.get('src')
-                rq=self.s.get(self.url+dl,stream=True)
+        log = logging.getLogger(__name__)
 
-                fn = ('brt_%(jid)d.' % obs) + ('fits' if cube else 'zip')
-                with open(path.join(directory, fn), 'wb') as fd:
-                    for chunk in rq.iter_content(512):
+        fn = '%(jid)d.zip' % obs
+        fp = path.join(self.cache,fn[0],fn[1],fn)
+        target = fp
+        if self.cache_format == 'fits' :
+            import fitscache
+            target = fp[:-len('.zip')]+fitscache.suffix
+        if path.isfile(target) :
+            metrics.hit('jobs')
+            return None
+        os.makedirs(path.dirname(fp), exist_ok=True)
+        with jobcache.locked(target):
+            if path.isfile(target) :
+                metrics.hit('jobs')
+                return None
+            metrics.hit('jobs', False)
+            log.info('Streaming %s from server', target)
+            rq=self._get('v3image-download-layers.php?jid=%d' % obs['jid'], stream=True)
+            layers=[]
+            keep = target != fp
+
+            def chunks(fd=None):
+                for chunk in rq.iter_content(65536):
+                    metrics.inc('download_bytes_total', len(chunk))
+                    if fd is not None :
                         fd.write(chunk)
-                return fn
-            except AttributeError :
-                tout-=self.retry
-                log.warning('No data. Sleep for %ds ...'%self.retry)
-                time.sleep(self.retry)
-
-        return None
+                    yield chunk
+
+            def ingest(stream):
+                for n, (name, data) in enumerate(zipstream.iter_members(stream)):
+                    # Layers are kept only to build the compressed file
+                    layers.append((name, data if keep else None))
+                    if callback is not None :
+                        with fits.open(BytesIO(data)) as f :
+                            h=f[0]
+                            h.data
+                        callback(n, name, h)
+                # The central directory
+                for chunk in stream:
+                    pass
 
+            try :
+                if not keep :
+                    with jobcache.publishing(fp) as fd:
+                        ingest(chunks(fd))
+                else :
+                    ingest(chunks())
+                    fitscache.write_layers(layers, target)
+            finally :
+                rq.close()
+        return len(layers)
+
+    def processed_url(self, obs, cube=False):
+        '''Request the processed image of the observation obs from the
+        image engine. Returns the download path or None if the image
+        is not ready yet. The first call triggers the generation.'''
+
+        rq=self._get('imageengine-request.php?jid=%d&type=%d' %
+                        (obs['jid'], 1 if cube else 3 ))
+        rq.raise_for_status()
+        dlif=BeautifulSoup(rq.text, 'lxml').find('iframe')
+        return None if dlif is None else dlif.get('src')
+
+    def _fetch_processed(self, obs, dl, directory, cube):
+        rq=self._get(dl, stream=True)
+        try :
+            rq.raise_for_status()
+            if directory is None :
+                bio=BytesIO()
+                for chunk in rq.iter_content(65536):
+                    bio.write(chunk)
+                    metrics.inc('download_bytes_total', len(chunk))
+                bio.seek(0)
+                return bio if cube else ZipFile(bio)
+            fn = ('brt_%(jid)d.' % obs) + ('fits' if cube else 'zip')
+            with open(path.join(directory, fn), 'wb') as fd:
+                for chunk in rq.iter_content(65536):
+                    fd.write(chunk)
+                    metrics.inc('download_bytes_total', len(chunk))
+            return fn
+        finally :
+            rq.close()
+
+    def fetch_obs_processed(self, obsl, directory=None, cube=False,
+                            timeout=None, interval=2, workers=4):
+        '''Fetch the processed images of all observations in obsl.
+        The generation is triggered for all jobs up front and then the
+        pending jobs are polled together. The polling interval starts
+        at interval and grows (up to self.retry) while nothing new
+        arrives. Each result is downloaded as soon as it is ready
+        into the directory (brt_jid.zip/fits, the file name is returned)
+        or into memory (BytesIO, or ZipFile if cube=False) if the
+        directory is None.
+
+        This is a generator yielding (obs, result) pairs in the order
+        of completion. The jobs not ready after timeout seconds
+        (self.tout by default) or failing to request or download are
+        yielded with None result.'''
 
-    def get_obs_processed(self,obs=None, cube=False):
-        '''Get the raw observation obs (obtained from get_job) into zip
-        file-like object. The function returns ZipFile structure of the
-        downloaded data.'''
-
-        assert(obs is not None)
         assert(self.s is not None)
         log = logging.getLogger(__name__)
 
-        tout=self.tout
+        if timeout is None :
+            timeout=self.tout
+        deadline=time.monotonic()+timeout
+        pending=list(obsl)
+        dt=interval
+        with ThreadPoolExecutor(workers) as ex :
+            while pending :
+                polls={ex.submit(self.processed_url, o, cube): o for o in pending}
+                ready=[]
+                pending=[]
+                for f in as_completed(polls):
+                    o=polls[f]
+                    try :
+                        dl=f.result()
+                    except (requests.RequestException, ValueError, AttributeError) as e :
+                        log.warning('Request of processed %d failed: %s', o['jid'], e)
+                        yield o, None
+                        continue
+                    if dl :
+                        ready.append((o, dl))
+                    else :
+                        pending.append(o)
+                jobs={ex.submit(self._fetch_processed, o, dl, directory, cube): o
+                        for o, dl in ready}
+                for f in as_completed(jobs):
+                    try :
+                        res=f.result()
+                    except (requests.RequestException, BadZipFile, OSError) as e :
+                        log.warning('Download of processed %d failed: %s', jobs[f]['jid'], e)
+                        res=None
+                    yield jobs[f], res
+                if not pending :
+                    break
+                if time.monotonic()+dt > deadline :
+                    for o in pending:
+                        log.warning('No processed data for %d', o['jid'])
+                        yield o, None
+                    break
+                dt = interval if ready else min(dt*1.5, self.retry)
+                log.info('%d jobs pending. Sleep for %.1fs ...', len(pending), dt)
+                time.sleep(dt)
 
-        while tout > 0 :
-            rq=self.s.get(self.url+
-                          ('imageengine-request.php?jid=%d&type=%d' %
-                            (obs['jid'], 1 if cube else 3 )))
+    def download_obs_processed(self,obs=None, directory='.', cube=False):
+        '''Download the processed observation obs (obtained from get_job)
+        into zip file named brt_jid.zip located in the directory
+        (current by default). Alternatively, when the cube=True the file
+        will be a 3D fits file. The name of the file (without directory)
+        is returned (None if the image was not generated in time).'''
 
-            soup = BeautifulSoup(rq.text,'lxml')
-            dlif=soup.find('iframe')
+        assert(obs is not None)
+        for o, fn in self.fetch_obs_processed([obs], directory, cube):
+            return fn
 
-            try :
-                dl=dlif.get('src')
-                rq=self.s.get(self.url+dl,stream=True)
-                return StringIO(rq.content) if cube else ZipFile(StringIO(rq.content))
 
-            except AttributeError :
-                tout-=self.retry
-                log.warning('No data. Sleep for %ds ...'%self.retry)
-                time.sleep(self.retry)
+    def get_obs_processed(self,obs=None, cube=False):
+        '''Get the processed observation obs (obtained from get_job) into
+        zip file-like object. The function returns ZipFile structure of the
+        downloaded data (BytesIO of the fits file if cube=True).'''
 
-        return None
+        assert(obs is not None)
+        for o, content in self.fetch_obs_processed([obs], None, cube):
+            return content
 
     @staticmethod
     def extract_ticket(rq):
@@ -372,18 +801,35 @@ class Telescope :
         return t
 
 
-    def do_api_call(self, module, req, params=None):
-        rq = self.s.post(self.url+"api-user.php", {'module': module,
-                                                   'request': req,
-                                                   'params': {} if params is None else json.dumps(params)})
-        return json.loads(rq.content)
+    def do_api_call(self, module, req, params=None, retry=True):
+        '''
+        Call the request of the API module. The call is repeated after
+        transient failures unless retry is False (for the calls which
+        must not be done twice, like submissions): then an invalid
+        answer is returned as the failure {'success': False, 'status': ...}
+        since the request may have been done anyway.
+        '''
+        data={'module': module,
+              'request': req,
+              'params': {} if params is None else json.dumps(params)}
+        rq = self._post("api-user.php", data, retry=retry)
+        try :
+            return json.loads(rq.content)
+        except ValueError :
+            # Not a JSON answer - most probably the session expired.
+            log = logging.getLogger(__name__)
+            log.info('Invalid API response. Logging in again ...')
+            self.login()
+            if not retry :
+                return {'success': False, 'status': 'Invalid API response (HTTP %d)' % rq.status_code}
+            return json.loads(self._post("api-user.php", data, retry=retry).content)
 
-    def do_rm_api(self, req, params=None):
-        return self.do_api_call("request-manager", req, params)
+    def do_rm_api(self, req, params=None, retry=True):
+        return self.do_api_call("request-manager", req, params, retry)
 
 
-    def do_rc_api(self, req, params=None):
-        return self.do_api_call("request-constructor", req, params)
+    def do_rc_api(self, req, params=None, retry=True):
+        return self.do_api_call("request-constructor", req, params, retry)
 
 
     def submit_job_api(self, obj, exposure=30000, tele='COAST',
@@ -424,7 +870,8 @@ class Telescope :
         r = self.do_rc_api("0-rb-set", params)
         log.debug('Req data:%s', r)
         if r['success'] :
-            r = self.do_rc_api("0-rb-submit")
+            # A repeated submission would create a duplicate request
+            r = self.do_rc_api("0-rb-submit", retry=False)
             log.debug('Submission data:%s', r)
         if r['success'] :
             return True, r['data']['id']
@@ -463,17 +910,17 @@ class Telescope :
             if filt=='Green' : filt='V'
             if filt=='Red' : filt='R'
 
-        u=self.url+'/request-constructor.php'
-        r=self.s.get(u+'?action=new')
+        u='request-constructor.php'
+        r=self._get(u+'?action=new')
         t=self.extract_ticket(r)
         log.debug('GoTo Part 1 (ticket %s)', t)
-        r=self.s.post(u,data={'ticket':t,'action':'main-go-part1'})
+        r=self._post(u,data={'ticket':t,'action':'main-go-part1'})
         t=self.extract_ticket(r)
         log.debug('GoTo RADEC (ticket %s)', t)
-        r=self.s.post(u,data={'ticket':t,'action':'part1-go-radec'})
+        r=self._post(u,data={'ticket':t,'action':'part1-go-radec'})
         t=self.extract_ticket(r)
         log.debug('Save RADEC (ticket %s)', t)
-        r=self.s.post(u,data={'ticket':t,'action':'part1-radec-save',
+        r=self._post(u,data={'ticket':t,'action':'part1-radec-save',
                              'raHours':ra[0],
                              'raMins':ra[1],
                              'raSecs':ra[2].split('.')[0],
@@ -485,19 +932,19 @@ class Telescope :
                              'newObjectName':name})
         t=self.extract_ticket(r)
         log.debug('GoTo Part 2 (ticket %s)', t)
-        r=self.s.post(u,data={'ticket':t,'action':'main-go-part2'})
+        r=self._post(u,data={'ticket':t,'action':'main-go-part2'})
         t=self.extract_ticket(r)
         log.debug('Save Telescope (ticket %s)', t)
-        r=self.s.post(u,data={'ticket':t,
+        r=self._post(u,data={'ticket':t,
                                 'action':'part2-save',
                                 'submittype':'Save',
                                 'newTelescopeSelection':tele})
         t=self.extract_ticket(r)
         log.debug('GoTo Part 3 (ticket %s)', t)
-        r=self.s.post(u,data={'ticket':t,'action':'main-go-part3'})
+        r=self._post(u,data={'ticket':t,'action':'main-go-part3'})
         t=self.extract_ticket(r)
         log.debug('Save Exposure (ticket %s)', t)
-        r=self.s.post(u,data={'ticket':t,
+        r=self._post(u,data={'ticket':t,
                                 'action':'part3-save',
                                 'submittype':'Save',
                                 'newExposureTime':exposure,
@@ -506,14 +953,183 @@ class Telescope :
                                 'newRequestComments':comment})
         t=self.extract_ticket(r)
         log.debug('Submit (ticket %s)', t)
-        r=self.s.post(u,data={'ticket':t, 'action':'main-submit'})
+        r=self._post(u,data={'ticket':t, 'action':'main-submit'})
         return r
 
-    def submitVarStar(self, name, expos=90, filt='BVR',comm='', tele='COAST'):
-        o=SkyCoord.from_name(name)
+    def submitVarStar(self, name, expos=90, filt='BVR',comm='', tele='COAST', obj=None,
+                      check=False, nights=3):
+        '''
+        Submit the observation of the object by name. The coordinates
+        are resolved through the name cache unless given in obj.
+        With check=True the object is submitted only if it is observable
+        from the telescope in the coming nights (see visibility).
+        '''
+        o=resolve_name(name) if obj is None else obj
+        if check :
+            import visibility
+            if not visibility.observable(o, tele, nights=nights)[0] :
+                logging.getLogger(__name__).info('%s not observable in %d nights', name, nights)
+                return False, 'Not observable'
         return self.submit_job_api(o, name=name, comment=comm,
                                 exposure=expos*1000, filt=filt, tele=tele)
 
+    def clone(self, cookies=None):
+        '''
+        Create another, independently logged-in, session to the site
+        sharing the cache and the transport with this one.
+        '''
+        return Telescope(self.user, self.passwd, self.cache, cookies=cookies,
+                         poolsize=self.poolsize, transport=self.transport,
+                         cache_format=self.cache_format)
+
+    def session_pool(self, n):
+        '''
+        List of n independent sessions (this one included). The extra
+        sessions are created on demand and kept for later calls.
+        Their cookies are saved next to the cookies of this session.
+        '''
+        if not hasattr(self, '_pool') :
+            self._pool=[self]
+        while len(self._pool) < n :
+            i=len(self._pool)
+            self._pool.append(self.clone(cookies='%s.%d' % (self.cookies, i)
+                                                if self.cookies else False))
+        return self._pool[:n]
+
+    def submit_many(self, targets, sessions=4):
+        '''
+        Submit many observations in parallel. The request builder state
+        on the server is bound to the session, so each concurrent
+        submission runs in its own logged-in session from the pool
+        of the given size.
+
+        targets is a list of dictionaries with submitVarStar arguments
+        (name is required).
+        Returns a list of (name, success, id or error) in the order
+        of targets.
+        '''
+        log = logging.getLogger(__name__)
+        pool=Queue()
+        for t in self.session_pool(max(1, min(sessions, len(targets)))):
+            pool.put(t)
+
+        def submit(target):
+            t=pool.get()
+            try :
+                r, i = t.submitVarStar(**target)
+            except Exception as e :
+                log.warning('Submission of %s failed: %s', target['name'], e)
+                r, i = False, str(e)
+            finally :
+                pool.put(t)
+            return target['name'], r, i
+
+        with ThreadPoolExecutor(pool.qsize()) as ex :
+            return list(ex.map(submit, targets))
+
+
+class NameCache :
+    '''
+    Persistent cache of the object name resolution (SkyCoord.from_name).
+    Names are normalised (whitespace and case) before lookup. Names
+    unknown to the resolver are remembered for negative_ttl seconds;
+    network failures are not cached.
+    '''
+
+    def __init__(self, directory='.cache/names', negative_ttl=86400):
+        self.cache=diskcache.Cache(directory)
+        self.negative_ttl=negative_ttl
+        self.hits=0
+        self.misses=0
+
+    @staticmethod
+    def normalize(name):
+        return ' '.join(name.split()).lower()
+
+    @staticmethod
+    def not_found(e):
+        '''
+        True if the NameResolveError e is the answer of the resolver
+        (the name is unknown), False for the failures to reach it.
+        '''
+        return 'Unable to find coordinates' in str(e)
+
+    def _lookup(self, name):
+        log = logging.getLogger(__name__)
+        key=self.normalize(name)
+        try :
+            o=SkyCoord.from_name(name)
+        except NameResolveError as e :
+            log.warning('Cannot resolve %s: %s', name, e)
+            if self.not_found(e) :
+                self.cache.set(key, None, expire=self.negative_ttl)
+            return None
+        except OSError as e :
+            # Network trouble: try again next time
+            log.warning('Cannot resolve %s: %s', name, e)
+            return None
+        v=(o.ra.deg, o.dec.deg)
+        self.cache.set(key, v)
+        return v
+
+    def _get(self, name):
+        v=self.cache.get(self.normalize(name), default=KeyError)
+        if v is KeyError :
+            self.misses+=1
+        else :
+            self.hits+=1
+        metrics.hit('names', v is not KeyError)
+        return v
+
+    @staticmethod
+    def _coord(v):
+        return None if v is None else SkyCoord(v[0], v[1], unit='deg', frame='icrs')
+
+    def resolve(self, name):
+        '''
+        Coordinates (SkyCoord) of the named object.
+        Raises NameResolveError if the name cannot be resolved.
+        '''
+        v=self._get(name)
+        if v is KeyError :
+            v=self._lookup(name)
+        if v is None :
+            raise NameResolveError('Unable to resolve %s' % name)
+        return self._coord(v)
+
+    def resolve_many(self, names, workers=4):
+        '''
+        Resolve all names at once. The names missing in the cache are
+        looked up concurrently. Returns a dictionary name -> SkyCoord
+        (None for the names which cannot be resolved).
+        '''
+        res={}
+        missing=[]
+        for n in names:
+            v=self._get(n)
+            if v is KeyError :
+                missing.append(n)
+            else :
+                res[n]=self._coord(v)
+        if missing :
+            with ThreadPoolExecutor(workers) as ex :
+                for n, v in zip(missing, ex.map(self._lookup, missing)):
+                    res[n]=self._coord(v)
+        return res
+
+
+# Name cache used by resolve_name (default one created on first use)
+namecache=None
+
+def resolve_name(name):
+    '''
+    Resolve the object name using the module name cache.
+    '''
+    global namecache
+    if namecache is None :
+        namecache=NameCache()
+    return namecache.resolve(name)
+
 
 def getFrameRaDec(hdu):
     if 'OBJCTRA' in hdu.header:
@@ -582,7 +1198,99 @@ from am import Client
 
 astrometryAPIkey=None
 
-def _solveField_remote(hdu, name='brtjob', apikey=None, apiurl='http://nova.astrometry.net/api/', cleanup=True):
+
+def downcast_data(data):
+    '''
+    Return the data as the smallest integer type holding it exactly
+    (uint16, int16, int32), or float32 if it is not integer valued.
+    '''
+    d=np.asarray(data)
+    if np.issubdtype(d.dtype, np.integer) or np.array_equal(d, np.round(d)) :
+        lo, hi = d.min(), d.max()
+        for t in (np.uint16, np.int16, np.int32):
+            if np.iinfo(t).min <= lo and hi <= np.iinfo(t).max :
+                return d.astype(t)
+    return d.astype(np.float32)
+
+
+def reduce_for_upload(hdu, compress=False, downcast=True, binning=1, maxsize=None):
+    '''
+    Prepare a reduced copy of the frame for the upload to the remote solver.
+
+    maxsize  - centre crop the frame to at most maxsize pixels on each axis
+    binning  - bin the frame by this integer factor (mean of the pixels)
+    downcast - store the data in the smallest exact integer type
+               (binned data are rounded first)
+    compress - tile compress the frame (RICE_1, lossless for integer data;
+               float data are never compressed)
+
+    Returns the FITS file contents (bytes) and the transformation
+    (x0, y0, binning) needed by restore_wcs: x0, y0 are the
+    offsets of the crop in original pixels.
+    '''
+    data=np.asarray(hdu.data)
+    ny, nx = data.shape
+    x0=y0=0
+    if maxsize is not None :
+        x0, y0 = max(0, (nx-maxsize)//2), max(0, (ny-maxsize)//2)
+        data=data[y0:y0+min(ny, maxsize), x0:x0+min(nx, maxsize)]
+    if binning > 1 :
+        by, bx = data.shape[0]//binning, data.shape[1]//binning
+        data=data[:by*binning, :bx*binning].reshape(by, binning, bx, binning).mean(axis=(1,3))
+        if downcast :
+            data=np.round(data)
+    if downcast :
+        data=downcast_data(data)
+    header=hdu.header.copy()
+    for k in ('BSCALE', 'BZERO', 'BLANK'):
+        header.remove(k, ignore_missing=True)
+    if compress and np.issubdtype(data.dtype, np.integer) :
+        out=fits.HDUList([fits.PrimaryHDU(),
+                          fits.CompImageHDU(data, header, compression_type='RICE_1')])
+    else :
+        out=fits.HDUList([fits.PrimaryHDU(data, header)])
+    bio=BytesIO()
+    out.writeto(bio)
+    return bio.getvalue(), (x0, y0, binning)
+
+
+_wcs_keys=re.compile(r'^(WCSAXES|CTYPE\d|CUNIT\d|CRVAL\d|CRPIX\d|CD\d_\d|CDELT\d|PC\d_\d|'
+                     r'LONPOLE|LATPOLE|RADESYS|EQUINOX|(A|B|AP|BP)_ORDER|(A|B|AP|BP)_\d+_\d+)$')
+
+def restore_wcs(header, x0=0, y0=0, binning=1):
+    '''
+    Take the WCS keywords from the solved header of the reduced frame
+    (see reduce_for_upload) and transform them to the pixels of the
+    original frame. Returns a new Header with the WCS keywords only.
+    '''
+    b=binning
+    w=fits.Header()
+    for k, v in header.items():
+        if not _wcs_keys.match(k) :
+            continue
+        if k == 'CRPIX1' :
+            v=b*v+x0-(b-1)/2
+        elif k == 'CRPIX2' :
+            v=b*v+y0-(b-1)/2
+        elif k.startswith('CD') :
+            # both CDi_j and CDELTi scale with the pixel size
+            v=v/b
+        else :
+            m=re.match(r'^(A|B|AP|BP)_(\d+)_(\d+)$', k)
+            if m :
+                v=v*b**(1-int(m.group(2))-int(m.group(3)))
+        w[k]=v
+    return w
+
+
+def _solveField_remote(hdu, name='brtjob', apikey=None, apiurl='http://nova.astrometry.net/api/',
+                       cleanup=True, upload=None, downsample_factor=None):
+    '''
+    Solve the field with the astrometry.net web service.
+    upload is a dictionary of reduce_for_upload options (by default
+    the data are only downcast) and downsample_factor is passed to the
+    service. The returned WCS is always expressed in the pixels of hdu.
+    '''
     log = logging.getLogger(__name__)
 
     if apikey is None :
@@ -591,69 +1299,72 @@ def _solveField_remote(hdu, name='brtjob', apikey=None, apiurl='http://nova.astr
             return None
         else :
             apikey=astrometryAPIkey
-    cli=Client()
-    cli.login(apikey)
-    bio=BytesIO()
-    hdu.writeto(bio)
-    bio.seek(0)
-    res=cli.send_request('upload',{},(name,bio.read()))
-
-    while True:
-        stat = cli.sub_status(res['subid'], justdict=True)
-        log.debug('Got status: %s', stat)
-        jobs = stat.get('jobs', [])
-        if len(jobs):
-            for j in jobs:
-                if j is not None:
-                    break
-            if j is not None:
-                log.debug('Selecting job id %d', j)
-                job_id = j
+    with Client(apiurl) as cli :
+        cli.login(apikey)
+        dat, trans = reduce_for_upload(hdu, **(upload or {}))
+        log.debug('Uploading %d bytes (crop %d,%d bin %d)', len(dat), *trans)
+        metrics.inc('solver_upload_bytes_total', len(dat))
+        args={}
+        if downsample_factor :
+            args['downsample_factor']=int(downsample_factor)
+        res=cli.send_request('upload',args,(name,dat))
+
+        while True:
+            stat = cli.sub_status(res['subid'], justdict=True)
+            log.debug('Got status: %s', stat)
+            jobs = [j for j in stat.get('jobs', []) if j is not None]
+            if jobs:
+                job_id = jobs[0]
+                log.debug('Selecting job id %d', job_id)
+                break
+            time.sleep(5)
+
+        while True:
+            stat = cli.job_status(job_id, justdict=True)
+            log.debug('Got job status: %s', stat)
+            if stat.get('status','') in ['success', 'failure']:
                 break
-        time.sleep(5)
-
-    success = False
-    while True:
-        stat = cli.job_status(job_id, justdict=True)
-        log.debug('Got job status: %s', stat)
-        if stat.get('status','') in ['success']:
-            success = (stat['status'] == 'success')
-            break
-        time.sleep(5)
-
-    if success:
-        cli.job_status(job_id)
-        # result = c.send_request('jobs/%s/calibration' % opt.job_id)
-        # dprint('Calibration:', result)
-        # result = c.send_request('jobs/%s/tags' % opt.job_id)
-        # dprint('Tags:', result)
-        # result = c.send_request('jobs/%s/machine_tags' % opt.job_id)
-        # dprint('Machine Tags:', result)
-        # result = c.send_request('jobs/%s/objects_in_field' % opt.job_id)
-        # dprint('Objects in field:', result)
-        #result = c.send_request('jobs/%s/annotations' % opt.job_id)
-        #dprint('Annotations:', result)
-
-        # We don't need the API for file retrival, just construct URL
-        url = apiurl.replace('/api/', '/new_fits_file/%i' % job_id)
-
-        log.debug('Retrieving file from %s', url)
-        r = requests.get(url)
-        shdu=fits.open(BytesIO(r.content))
+            time.sleep(5)
+
+        shdu=None
+        if stat['status'] == 'success':
+            # We don't need the API for file retrival, just construct URL
+            url = apiurl.replace('/api/', '/new_fits_file/%i' % job_id)
+
+            log.debug('Retrieving file from %s', url)
+            r = cli.s.get(url, timeout=cli.timeout)
+            solved=[h for h in fits.open(BytesIO(r.content)) if 'CRVAL1' in h.header][0]
+            header=hdu.header.copy()
+            header.update(restore_wcs(solved.header, *trans))
+            shdu=fits.HDUList([fits.PrimaryHDU(hdu.data, header)])
 
     return shdu
 
-def solveField(hdu, name='brtjob', local=None, apikey=None, apiurl='http://nova.astrometry.net/api/', cleanup=True):
+def solveField(hdu, name='brtjob', local=None, apikey=None, apiurl='http://nova.astrometry.net/api/', cleanup=True,
+               upload=None, downsample_factor=None):
     '''
     Solve plate using local or remote (nova.astrometry.net) plate solver.
+    The upload and downsample_factor parameters control the reduction
+    of the frame sent to the remote solver (see _solveField_remote).
     '''
     if local==True :
-        return _solveField_local(hdu, cleanup=cleanup)
+        return _solve_timed('local', _solveField_local, hdu, cleanup=cleanup)
     elif local==False :
-        return _solveField_remote(hdu, name=name, apikey=apikey, apiurl=apiurl, cleanup=cleanup)
+        return _solve_timed('remote', _solveField_remote, hdu, name=name,
+                            apikey=apikey, apiurl=apiurl, cleanup=cleanup,
+                            upload=upload, downsample_factor=downsample_factor)
     elif local is None :
-        shdu = _solveField_local(hdu)
+        shdu = _solve_timed('local', _solveField_local, hdu)
         if shdu is None :
             print('Local solver failed. Trying remote ...')
-            shdu = _solveField_remote(hdu, name=name, apikey=apikey, apiurl=apiurl)
+            shdu = _solve_timed('remote', _solveField_remote, hdu, name=name,
+                                apikey=apikey, apiurl=apiurl,
+                                upload=upload, downsample_factor=downsample_factor)
         return shdu
+
+def _solve_timed(solver, f, hdu, **kwargs):
+    with metrics.timer('solver_seconds', solver=solver):
+        shdu=f(hdu, **kwargs)
+    metrics.inc('solver_runs_total', solver=solver,
+                result='success' if shdu else 'failure')
+    return shdu
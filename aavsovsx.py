@@ -3,6 +3,7 @@
 import mechanicalsoup
 from lxml import etree
 from math import sqrt
+from metrics import registry as metrics
 mech = mechanicalsoup.StatefulBrowser(soup_config={'features': 'lxml'})
 
 
@@ -27,6 +28,13 @@ dsgn=['u', 'b', 'v', 'rc', 'ic']
 
 
 def get_VS_sequence(vs, fov=60, maglimit=17):
+    with metrics.timer('aavso_sequence_seconds'):
+        seq, stars = _get_VS_sequence(vs, fov, maglimit)
+    metrics.inc('aavso_sequence_total', result='found' if seq else 'none')
+    return seq, stars
+
+
+def _get_VS_sequence(vs, fov=60, maglimit=17):
     fov*=sqrt(2)
     url="http://www.aavso.org/cgi-bin/vsp.pl?name=%s&ccdtable=on&fov=%d" % ("%20".join(vs.split()),fov)
     url="https://www.aavso.org/apps/vsp/photometry/?fov=%.1f&star=%s&Rc=on&B=on&maglimit=%.1f" % ( fov,
@@ -1,4 +1,3 @@
 from __future__ import absolute_import
-from .client import Client
-__all__ = 'Client'
-
+from .client import Client, AsyncClient
+__all__ = ['Client', 'AsyncClient']
@@ -4,9 +4,13 @@ import os
 import sys
 import time
 import base64
+import logging
 
-from future.standard_library import install_aliases
-install_aliases()
+try:
+    from future.standard_library import install_aliases
+    install_aliases()
+except ImportError:
+    pass
 
 from urllib.parse import urlparse, urlencode, quote
 from urllib.request import urlopen, Request
@@ -29,6 +33,8 @@ def json2python(data):
     return None
 python2json = json.dumps
 
+log = logging.getLogger(__name__)
+
 class MalformedResponse(Exception):
     pass
 class RequestError(Exception):
@@ -38,47 +44,64 @@ class Client(object):
     default_url = 'http://nova.astrometry.net/api/'
 
     def __init__(self,
-                 apiurl = default_url):
+                 apiurl = default_url, timeout = (10, 120), poolsize = 10):
+        '''
+        apiurl:   API base URL
+        timeout:  requests timeout (connect, read) in seconds
+        poolsize: number of kept-alive connections
+        '''
+        import requests
+        from requests.adapters import HTTPAdapter
+
         self.session = None
         self.apiurl = apiurl
+        self.timeout = timeout
+        self.s = requests.Session()
+        adapter = HTTPAdapter(pool_connections=poolsize, pool_maxsize=poolsize)
+        self.s.mount('http://', adapter)
+        self.s.mount('https://', adapter)
 
     def get_url(self, service):
         return self.apiurl + service
 
+    def close(self):
+        self.s.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
     def send_request(self, service, args=None, file_args=None):
         '''
         service: string
         args: dict
         '''
 
-        import requests
-
         if args is None :
             args={}
 
         if self.session is not None:
             args.update({ 'session' : self.session })
-        print('Python:', args)
         json = python2json(args)
-        print('Sending json:', json)
         url = self.get_url(service)
-        print('Sending to URL:', url)
+        log.debug('Sending to URL: %s json: %s', url, json)
+        data = {'request-json': json}
         if file_args is not None:
-            print(file_args[0])
+            log.debug('Uploading %s (%d bytes)', file_args[0], len(file_args[1]))
             files = {'file': (file_args[0], file_args[1], 'application/octet-stream')}
-            data = {'request-json': json}
-            r = requests.post(url, data=data, files=files)
+            r = self.s.post(url, data=data, files=files, timeout=self.timeout)
         else :
             # Else send x-www-form-encoded
-            data = {'request-json': json}
-            print('Sending form data:', data)
-            r = requests.post(url, data=data)
+            r = self.s.post(url, data=data, timeout=self.timeout)
 
-        print('Got json:', r.text)
-        result = json2python(r.text)
-        print('Got result:', result)
+        try:
+            result = json2python(r.text)
+        except ValueError:
+            raise MalformedResponse('HTTP %d: %s' % (r.status_code, r.text[:200]))
         stat = result.get('status')
-        print('Got status:', stat)
+        log.debug('Got status: %s result: %s', stat, result)
         if stat == 'error':
             errstr = result.get('errormessage', '(none)')
             raise RequestError('server error message: ' + errstr)
@@ -96,11 +119,9 @@ class Client(object):
             args = {}
         if self.session is not None:
             args.update({ 'session' : self.session })
-        print('Python:', args)
         json = python2json(args)
-        print('Sending json:', json)
         url = self.get_url(service)
-        print('Sending to URL:', url)
+        log.debug('Sending to URL: %s json: %s', url, json)
 
         # If we're sending a file, format a multipart/form-data
         if file_args is not None:
@@ -133,7 +154,6 @@ class Client(object):
                     # have to copy-n-paste-n-modify.
                     for h, v in msg.items():
                         #print(('%s: %s\r\n' % (h,v)), end='', file=self._fp)
-                        print('Writing header:',h, v)
                         self._fp.write(('%s: %s\r\n' % (h,v)))
                     # A blank line always separates headers from body
                     #print('\r\n', end='', file=self._fp)
@@ -153,9 +173,7 @@ class Client(object):
         else:
             # Else send x-www-form-encoded
             data = {'request-json': json}
-            print('Sending form data:', data)
             data = urlencode(data).encode('ascii')
-            print('Sending data:', data)
             headers = {}
 
         request = Request(url=url, headers=headers, data=data)
@@ -163,31 +181,30 @@ class Client(object):
         try:
             f = urlopen(request)
             txt = f.read()
-            print('Got json:', txt)
             result = json2python(txt)
-            print('Got result:', result)
             stat = result.get('status')
-            print('Got status:', stat)
+            log.debug('Got status: %s result: %s', stat, result)
             if stat == 'error':
                 errstr = result.get('errormessage', '(none)')
                 raise RequestError('server error message: ' + errstr)
             return result
         except HTTPError as e:
-            print('HTTPError', e)
+            log.error('HTTPError %s', e)
             txt = e.read()
             open('err.html', 'wb').write(txt)
-            print('Wrote error text to err.html')
+            log.error('Wrote error text to err.html')
 
     def login(self, apikey):
         args = { 'apikey' : apikey }
         result = self.send_request('login', args)
         sess = result.get('session')
-        print('Got session:', sess)
+        log.debug('Got session: %s', sess)
         if not sess:
             raise RequestError('no session in result')
         self.session = sess
 
-    def _get_upload_args(self, **kwargs):
+    @staticmethod
+    def _get_upload_args(**kwargs):
         args = {}
         for key,default,typ in [('allow_commercial_use', 'd', str),
                                 ('allow_modifications', 'd', str),
@@ -212,7 +229,7 @@ class Client(object):
                 args.update({key: val})
             elif default is not None:
                 args.update({key: default})
-        print('Upload args:', args)
+        log.debug('Upload args: %s', args)
         return args
 
     def url_upload(self, url, **kwargs):
@@ -228,7 +245,7 @@ class Client(object):
             result = self.send_request('upload', args, (fn, f.read()))
             return result
         except IOError:
-            print('File %s does not exist' % fn)
+            log.error('File %s does not exist', fn)
             raise
 
     def submission_images(self, subid):
@@ -244,11 +261,11 @@ class Client(object):
                       cd21 = wcs.cd[2], cd22 = wcs.cd[3],
                       imagew = wcs.imagew, imageh = wcs.imageh)
         result = self.send_request(service, {'wcs':params})
-        print('Result status:', result['status'])
+        log.debug('Result status: %s', result['status'])
         plotdata = result['plot']
         plotdata = base64.b64decode(plotdata)
         open(outfn, 'wb').write(plotdata)
-        print('Wrote', outfn)
+        log.info('Wrote %s', outfn)
 
     def sdss_plot(self, outfn, wcsfn, wcsext=0):
         return self.overlay_plot('sdss_image_for_wcs', outfn,
@@ -268,18 +285,10 @@ class Client(object):
             return result
         stat = result.get('status')
         if stat == 'success':
-            result = self.send_request('jobs/%s/calibration' % job_id)
-            print('Calibration:', result)
-            result = self.send_request('jobs/%s/tags' % job_id)
-            print('Tags:', result)
-            result = self.send_request('jobs/%s/machine_tags' % job_id)
-            print('Machine Tags:', result)
-            result = self.send_request('jobs/%s/objects_in_field' % job_id)
-            print('Objects in field:', result)
-            result = self.send_request('jobs/%s/annotations' % job_id)
-            print('Annotations:', result)
-            result = self.send_request('jobs/%s/info' % job_id)
-            print('Calibration:', result)
+            for info in ['calibration', 'tags', 'machine_tags',
+                         'objects_in_field', 'annotations', 'info']:
+                result = self.send_request('jobs/%s/%s' % (job_id, info))
+                log.info('%s: %s', info, result)
 
         return stat
 
@@ -305,6 +314,115 @@ class Client(object):
         )
         return result
 
+class AsyncClient(object):
+    '''
+    asyncio variant of the Client (requires aiohttp). All requests share
+    one connection pool, so many submissions and status polls can run
+    concurrently:
+
+        async with AsyncClient() as c:
+            await c.login(apikey)
+            subs = await asyncio.gather(*[c.upload(n, d) for n, d in files])
+    '''
+    default_url = Client.default_url
+
+    def __init__(self, apiurl = default_url, timeout = 120, poolsize = 10):
+        self.session = None
+        self.apiurl = apiurl
+        self.timeout = timeout
+        self.poolsize = poolsize
+        self.s = None
+
+    async def __aenter__(self):
+        import aiohttp
+        self.s = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=self.poolsize),
+                    timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self.s is not None:
+            await self.s.close()
+            self.s = None
+
+    def get_url(self, service):
+        return self.apiurl + service
+
+    async def send_request(self, service, args=None, file_args=None):
+        import aiohttp
+
+        if self.s is None:
+            await self.__aenter__()
+        if args is None:
+            args = {}
+        if self.session is not None:
+            args.update({ 'session' : self.session })
+        json = python2json(args)
+        url = self.get_url(service)
+        log.debug('Sending to URL: %s json: %s', url, json)
+        data = aiohttp.FormData()
+        data.add_field('request-json', json)
+        if file_args is not None:
+            data.add_field('file', file_args[1], filename=file_args[0],
+                           content_type='application/octet-stream')
+        async with self.s.post(url, data=data) as r:
+            txt = await r.text()
+        try:
+            result = json2python(txt)
+        except ValueError:
+            raise MalformedResponse('HTTP %d: %s' % (r.status, txt[:200]))
+        stat = result.get('status')
+        log.debug('Got status: %s result: %s', stat, result)
+        if stat == 'error':
+            errstr = result.get('errormessage', '(none)')
+            raise RequestError('server error message: ' + errstr)
+        return result
+
+    async def login(self, apikey):
+        result = await self.send_request('login', { 'apikey' : apikey })
+        sess = result.get('session')
+        if not sess:
+            raise RequestError('no session in result')
+        self.session = sess
+
+    async def upload(self, name, data, **kwargs):
+        args = Client._get_upload_args(**kwargs)
+        return await self.send_request('upload', args, (name, data))
+
+    async def sub_status(self, sub_id, justdict=False):
+        result = await self.send_request('submissions/%s' % sub_id)
+        return result if justdict else result.get('status')
+
+    async def job_status(self, job_id, justdict=False):
+        result = await self.send_request('jobs/%s' % job_id)
+        return result if justdict else result.get('status')
+
+    async def wait_for_job(self, sub_id, interval=5, timeout=None):
+        '''
+        Wait for the submission to produce a job and for the job to
+        finish. Returns (job_id, status) or (None, None) on timeout.
+        '''
+        import asyncio
+
+        t0 = time.monotonic()
+        job_id = None
+        while timeout is None or time.monotonic()-t0 < timeout:
+            if job_id is None:
+                stat = await self.sub_status(sub_id, justdict=True)
+                jobs = [j for j in stat.get('jobs', []) if j is not None]
+                if jobs:
+                    job_id = jobs[0]
+            if job_id is not None:
+                stat = await self.job_status(job_id)
+                if stat in ('success', 'failure'):
+                    return job_id, stat
+            await asyncio.sleep(interval)
+        return None, None
+
+
 if __name__ == '__main__':
     print("Running with args %s"%sys.argv)
     import optparse
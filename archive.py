@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+# coding: utf-8
+
+'''
+Header-only index of the local observation archive (the job cache).
+
+Only the FITS headers of the zip members are read (the members are
+inflated only up to the END card), and the interesting keywords are
+stored in a sqlite table which can be queried by telescope, filter,
+date and position. The index is updated incrementally: only the
+archives which are new or changed since the last update are read.
+
+Usage: python archive.py [-d index.db] cache_directory
+'''
+
+from __future__ import print_function, division, absolute_import
+
+import os
+from os import path
+import re
+import io
+import sqlite3
+import logging
+from zipfile import ZipFile, BadZipFile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+from astropy.time import Time
+
+import fitscache
+
+
+def read_headers(fp):
+    '''
+    Read the FITS headers of all members of the zip archive fp without
+    decoding the images. Returns the list of (member name, Header).
+    Tile-compressed job files (fitscache) are read as well.
+    '''
+    if fp.endswith(fitscache.suffix) :
+        return fitscache.read_headers(fp)
+    res=[]
+    with ZipFile(fp) as z :
+        for name in z.namelist():
+            with z.open(name) as f :
+                res.append((name, fits.Header.fromfile(f)))
+    return res
+
+
+def _header_row(jid, layer, name, h):
+    from BRT import getFrameRaDec
+
+    try :
+        o=getFrameRaDec(fits.PrimaryHDU(header=h))
+        ra, dec = o.ra.deg, o.dec.deg
+    except (KeyError, ValueError) :
+        ra=dec=None
+    try :
+        mjd=Time(h['DATE-OBS']).mjd
+    except (KeyError, ValueError) :
+        mjd=None
+    exp=h.get('EXPTIME', h.get('EXPOSURE'))
+    return (jid, name, layer, h.get('DATE-OBS'), mjd, str(h.get('TELESCOP', '')).strip(),
+            h.get('FILTER'), exp, ra, dec, h.get('IMAGETYP'),
+            str(h.get('INSTRUME', '')).strip())
+
+
+def scan_archive(fp):
+    '''
+    Extract the index rows of the archive fp (job cache zip file).
+    Runs in the worker processes of ArchiveIndex.update.
+    '''
+    log = logging.getLogger(__name__)
+    jid=int(re.match(r'\d+', path.basename(fp)).group())
+    try :
+        return fp, [_header_row(jid, n, name, h)
+                        for n, (name, h) in enumerate(read_headers(fp))]
+    except (BadZipFile, OSError) as e :
+        log.warning('Cannot index %s: %s', fp, e)
+        return fp, None
+
+
+class ArchiveIndex :
+    '''
+    Index of the frames in the job cache stored in the dbfile.
+    '''
+
+    columns=('jid', 'member', 'layer', 'date_obs', 'mjd', 'telescop',
+             'filter', 'exptime', 'ra', 'dec', 'imagetyp', 'instrume')
+
+    def __init__(self, dbfile='.cache/archive.db'):
+        d=path.dirname(dbfile)
+        if d :
+            os.makedirs(d, exist_ok=True)
+        self.db=sqlite3.connect(dbfile)
+        self.db.executescript('''
+            create table if not exists archives (
+                path text primary key, mtime real, size integer);
+            create table if not exists frames (
+                path text, jid integer, member text, layer integer,
+                date_obs text, mjd real, telescop text, filter text,
+                exptime real, ra real, dec real, imagetyp text, instrume text,
+                primary key (jid, member));
+            create index if not exists frames_mjd on frames(mjd);
+            create index if not exists frames_dec on frames(dec);
+            ''')
+        cols={r[1] for r in self.db.execute('pragma table_info(frames)')}
+        if 'instrume' not in cols :
+            # Index from older version: add the column and re-read everything
+            self.db.execute('alter table frames add column instrume text')
+            self.db.execute('delete from archives')
+        self.db.commit()
+
+    def update(self, cache, workers=None):
+        '''
+        Index the new and changed archives in the cache directory and
+        drop the ones which disappeared. The headers are read in
+        a pool of worker processes. Returns the number of indexed archives.
+        '''
+        log = logging.getLogger(__name__)
+        known={p: (m, s) for p, m, s in self.db.execute('select path, mtime, size from archives')}
+        found={}
+        for d, dirs, files in os.walk(cache):
+            for fn in files:
+                if fn.endswith(('.zip', fitscache.suffix)) :
+                    fp=path.join(d, fn)
+                    st=os.stat(fp)
+                    found[fp]=(st.st_mtime, st.st_size)
+        todo=[fp for fp, v in found.items() if known.get(fp) != v]
+        gone=[fp for fp in known if fp not in found]
+        with self.db :
+            self.db.executemany('delete from frames where path=?', [(fp,) for fp in gone+todo])
+            self.db.executemany('delete from archives where path=?', [(fp,) for fp in gone])
+        n=0
+        if todo :
+            with ProcessPoolExecutor(workers) as ex :
+                for fp, rows in ex.map(scan_archive, todo, chunksize=16):
+                    if rows is None :
+                        continue
+                    with self.db :
+                        self.db.executemany('insert or replace into frames values (?,%s)' %
+                                            ','.join('?'*len(self.columns)),
+                                            [(fp,)+r for r in rows])
+                        self.db.execute('insert or replace into archives values (?,?,?)',
+                                        (fp,)+found[fp])
+                    n+=1
+        log.info('Archive index: %d archives indexed, %d removed', n, len(gone))
+        return n
+
+    def query(self, telescope=None, filter=None, start=None, end=None,
+              near=None, radius=1.0, where=None, params=()):
+        '''
+        Find the frames matching all given criteria:
+
+        telescope  - TELESCOP contains this string (case insensitive)
+        filter     - FILTER header value
+        start, end - DATE-OBS range (anything accepted by astropy Time)
+        near       - SkyCoord of the position, frame pointing within radius (deg)
+        where      - additional SQL condition with params
+
+        Returns a list of dictionaries with the index columns and path.
+        '''
+        cond=[]
+        args=[]
+        if telescope :
+            cond.append('lower(telescop) like ?')
+            args.append('%%%s%%' % telescope.lower())
+        if filter :
+            cond.append('filter=?')
+            args.append(filter)
+        if start is not None :
+            cond.append('mjd>=?')
+            args.append(Time(start).mjd)
+        if end is not None :
+            cond.append('mjd<=?')
+            args.append(Time(end).mjd)
+        if near is not None :
+            ra0, dec0 = near.icrs.ra.deg, near.icrs.dec.deg
+            cond.append('dec between ? and ?')
+            args+=[dec0-radius, dec0+radius]
+        if where :
+            cond.append(where)
+            args+=list(params)
+        q='select path, %s from frames' % ', '.join(self.columns)
+        if cond :
+            q+=' where '+' and '.join(cond)
+        rows=[dict(zip(('path',)+self.columns, r)) for r in self.db.execute(q, args)]
+        if near is not None and rows :
+            ra=np.radians([r['ra'] for r in rows])
+            dec=np.radians([r['dec'] for r in rows])
+            d=np.degrees(2*np.arcsin(np.sqrt(np.sin((dec-np.radians(dec0))/2)**2 +
+                        np.cos(dec)*np.cos(np.radians(dec0))*np.sin((ra-np.radians(ra0))/2)**2)))
+            rows=[r for r, dd in zip(rows, d) if dd <= radius]
+        return rows
+
+
+def read_frame(row):
+    '''
+    Image data of the indexed frame (row as returned by ArchiveIndex.query).
+    '''
+    if row['path'].endswith(fitscache.suffix) :
+        with fitscache.CompressedArchive(row['path']) as a :
+            return a.hdu(row['member']).data
+    with ZipFile(row['path']) as z :
+        with z.open(row['member']) as f :
+            return fits.getdata(io.BytesIO(f.read()))
+
+
+def read_matching(fp, headers):
+    '''
+    Image data of the layers of the job archive fp matching the frame
+    headers (e.g. the solved ones) by DATE-OBS, and by FILTER where
+    several layers share the DATE-OBS. Returns the list of the data
+    for each header, None where no layer (or more than one) matches.
+    '''
+    log = logging.getLogger(__name__)
+    layers=[(name, h) for name, h in read_headers(fp) if 'DATE-OBS' in h]
+
+    def match(h):
+        if 'DATE-OBS' not in h :
+            return None
+        c=[(n, l) for n, l in layers if str(l['DATE-OBS']) == str(h['DATE-OBS'])]
+        if len(c) > 1 :
+            f=str(h.get('FILTER', '')).strip()
+            c=[(n, l) for n, l in c if f and str(l.get('FILTER', '')).strip() == f]
+            if len(c) != 1 :
+                log.warning('%s: ambiguous layers for DATE-OBS %s', fp, h['DATE-OBS'])
+                return None
+        return c[0][0] if c else None
+
+    names=[match(h) for h in headers]
+    if fp.endswith(fitscache.suffix) :
+        with fitscache.CompressedArchive(fp) as a :
+            return [None if n is None else np.array(a.hdu(n).data) for n in names]
+    with ZipFile(fp) as z :
+        return [None if n is None else fits.getdata(io.BytesIO(z.read(n))) for n in names]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Update the header index of the job cache')
+    parser.add_argument('cache', help='Job cache directory')
+    parser.add_argument('-d', '--db', default='.cache/archive.db', help='Index database')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes')
+    args = parser.parse_args()
+    logging.basicConfig(level='INFO')
+    ArchiveIndex(args.db).update(args.cache, args.jobs)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# coding: utf-8
+
+'''
+Offline throughput benchmarks.
+
+Runs the Telescope client against the local stand-in server
+(bench/server.py) and the plate solver against the fake solve-field
+(bench/bin/solve-field), so no network or astrometry.net installation
+is needed. Every benchmark is reported in jobs per second.
+
+Usage: python bench/run.py [-n jobs] [-l latency] [-s solve_time] [-o results.json]
+'''
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import sys
+from os import path
+import io
+import json
+import time
+import shutil
+import tempfile
+import argparse
+
+here=path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.dirname(here))
+sys.path.insert(0, here)
+
+import server
+import BRT
+from transport import Transport
+from astropy.io import fits
+
+
+def bench(name, f, n):
+    '''Run f() which processes n jobs, return the result row.'''
+    t0=time.perf_counter()
+    res=f()
+    dt=time.perf_counter()-t0
+    print('%-16s %6d jobs %9.3f s %10.2f jobs/s' % (name, n, dt, n/dt))
+    return {'name': name, 'jobs': n, 'seconds': dt, 'jobs_per_s': n/dt, 'result': res}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline BRT benchmarks')
+    parser.add_argument('-n', '--jobs', type=int, default=20, help='Number of jobs')
+    parser.add_argument('-l', '--latency', type=float, default=0.05, help='Server latency (s)')
+    parser.add_argument('-s', '--solve-time', type=float, default=0.5, help='Fake solver run time (s)')
+    parser.add_argument('-d', '--directory', help='Recorded responses (generated if missing)')
+    parser.add_argument('-o', '--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    work=tempfile.mkdtemp(prefix='brt-bench')
+    try :
+        rec=args.directory or path.join(work, 'responses')
+        server.make_recording(rec, args.jobs)
+        srv=server.serve(rec, latency=args.latency)
+        os.environ['PATH']=path.join(here, 'bin')+os.pathsep+os.environ['PATH']
+        os.environ['FAKE_SOLVE_TIME']=str(args.solve_time)
+
+        BRT.Telescope.url=srv.url
+        tr=Transport(rate=1000, burst=1000, maxinflight=32)
+        brt=BRT.Telescope('bench', 'bench', path.join(work, 'jobs'), cookies=False, transport=tr)
+
+        results=[]
+        r=bench('get_obs_list', lambda: brt.get_obs_list(dt=1), args.jobs)
+        results.append(r)
+        jids=r.pop('result')[:args.jobs]
+
+        r=bench('get_job', lambda: [brt.get_job(j) for j in jids], len(jids))
+        results.append(r)
+        jobs=r.pop('result')
+
+        def get_obs():
+            for o in jobs:
+                brt.get_obs(o).close()
+        results.append(bench('get_obs', get_obs, len(jobs)))
+        results.append(bench('get_obs (cached)', get_obs, len(jobs)))
+
+        z=brt.get_obs(jobs[0])
+        h=fits.open(io.BytesIO(z.read(z.namelist()[0])))[0]
+        z.close()
+        ns=max(1, min(len(jobs), 5))
+        results.append(bench('solveField', lambda: [BRT.solveField(h, local=True) for i in range(ns)], ns))
+
+        def analysis():
+            # list -> job -> archive -> layers -> solve (no catalogue queries)
+            shutil.rmtree(brt.cache, ignore_errors=True)
+            for j in brt.get_obs_list(dt=1)[:ns]:
+                o=brt.get_job(j)
+                z=brt.get_obs(o)
+                for name in z.namelist():
+                    BRT.solveField(fits.open(io.BytesIO(z.read(name)))[0], local=True)
+                z.close()
+        results.append(bench('end-to-end', analysis, ns))
+
+        srv.shutdown()
+        print('Transport:', dict(tr.stats))
+        if args.output :
+            with open(args.output, 'w') as fd :
+                json.dump(results, fd, indent=1)
+    finally :
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
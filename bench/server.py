@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+# coding: utf-8
+
+'''
+Local stand-in for telescope.org used by the benchmarks.
+
+The server replays recorded responses from a directory. The response
+for a page is looked up in the files (first existing is used):
+
+    <page>@<key>    key is the jid query parameter or the API request name
+    <page>
+
+and the text responses have {jid} replaced with the requested jid.
+The api-user.php request-manager list (1-get-list-own) is served from
+the recorded full list, paged according to the request parameters.
+Missing recordings can be generated with make_recording().
+
+Usage: python bench/server.py [-d directory] [-p port] [-l latency]
+'''
+
+from __future__ import print_function, division, absolute_import
+
+import os
+from os import path
+import io
+import json
+import time
+import random
+import zipfile
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+def _search_page(jids):
+    rows=''.join('<tr><td><a href="v3cjob-view.php?jid=%d">%d</a></td></tr>\n' % (j, j)
+                    for j in jids)
+    return '<html><body><table>\n<tr><th>Job</th></tr>\n%s</table></body></html>\n' % rows
+
+
+def _job_page():
+    rows=[('Object Type', 'RADEC'), ('Object ID', '05 29 00.0 +04 06 00'),
+          ('Telescope Type Name', 'coast'), ('Filter Type', 'BVR'),
+          ('Exposure Time', '120'), ('Completion Time', 'Job {jid} completed 19 Oct 2026 (22:10 UTC)'),
+          ('Status', 'Success')]
+    return ('<html><body><table>\n%s</table></body></html>\n' %
+            ''.join('<tr><td>%s</td><td>%s</td></tr>\n' % r for r in rows))
+
+
+def _frame(size, seed=0):
+    import numpy as np
+    from astropy.io import fits
+
+    rng=np.random.default_rng(seed)
+    data=rng.normal(1000, 20, size).astype(np.float32)
+    y, x = np.mgrid[:size[0], :size[1]]
+    for sx, sy, f in zip(rng.uniform(0, size[1], 50), rng.uniform(0, size[0], 50),
+                         rng.uniform(500, 20000, 50)):
+        r=slice(max(0, int(sy)-8), int(sy)+8), slice(max(0, int(sx)-8), int(sx)+8)
+        data[r]+=f*np.exp(-((x[r]-sx)**2+(y[r]-sy)**2)/4)
+    h=fits.PrimaryHDU(np.round(data))
+    h.header['TELESCOP']='COAST'
+    h.header['OBJCTRA']='05 29 00.0'
+    h.header['OBJCTDEC']='+04 06 00'
+    h.header['DATE-OBS']='2026-10-19T22:10:00'
+    h.header['EXPTIME']=120.0
+    bio=io.BytesIO()
+    h.writeto(bio)
+    return bio.getvalue()
+
+
+def make_recording(directory, njobs=50, size=(1024, 1024), first=300000):
+    '''
+    Generate a synthetic set of recorded responses in the directory
+    (existing files are kept): the search page listing njobs jobs,
+    the job view page, the request list and the zip with three layers
+    of size pixels.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    jids=range(first, first+njobs)
+    files={
+        'v3job-search-query.php': _search_page(jids),
+        'v3cjob-view.php': _job_page(),
+        'login.php': '<html><body>Welcome</body></html>\n',
+        'logout.php': '<html><body>Bye</body></html>\n',
+        'api-user.php@0-get-my-folders': json.dumps({'success': True,
+                            'data': [{'folderid': 1, 'name': 'Inbox'}]}),
+        'api-user.php@1-get-list-own': json.dumps({'success': True,
+                            'data': {'requests': [{'rid': first+i, 'status': random.choice((4, 8, 8, 20)),
+                                                   'objectname': 'Star %d' % i}
+                                                    for i in range(njobs)]}}),
+    }
+    for fn, txt in files.items():
+        fp=path.join(directory, fn)
+        if not path.isfile(fp) :
+            with open(fp, 'w') as fd :
+                fd.write(txt)
+    fp=path.join(directory, 'v3image-download-layers.php')
+    if not path.isfile(fp) :
+        bio=io.BytesIO()
+        with zipfile.ZipFile(bio, 'w', zipfile.ZIP_DEFLATED) as z :
+            for n, f in enumerate('RVB'):
+                z.writestr('layer_%s.fits' % f, _frame(size, n))
+        with open(fp, 'wb') as fd :
+            fd.write(bio.getvalue())
+    return directory
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version='HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        logging.getLogger(__name__).debug(fmt, *args)
+
+    def _lookup(self, page, key):
+        for fn in (['%s@%s' % (page, key)] if key else [])+[page]:
+            fp=path.join(self.server.directory, fn)
+            if path.isfile(fp) :
+                with open(fp, 'rb') as fd :
+                    return fd.read()
+        return None
+
+    def _reply(self, body, ctype, code=200):
+        time.sleep(self.server.latency)
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Set-Cookie', 'PHPSESSID=bench; Path=/')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, form):
+        u=urlparse(self.path)
+        page=path.basename(u.path)
+        q={k: v[-1] for k, v in parse_qs(u.query).items()}
+        q.update(form)
+        if page == 'api-user.php' :
+            key=q.get('request')
+        else :
+            key=q.get('jid')
+        body=self._lookup(page, key)
+        if body is None :
+            return self._reply(b'Not recorded', 'text/plain', 404)
+        if key == '1-get-list-own' :
+            dat=json.loads(body)
+            reqs=dat['data']['requests']
+            p=json.loads(q.get('params') or '{}')
+            start=int(p.get('startAfterRow', 0))
+            dat['data']['totalRequests']=len(reqs)
+            dat['data']['requests']=reqs[start:start+int(p.get('limit', 100))]
+            body=json.dumps(dat).encode()
+        if page.startswith('v3image-download') :
+            return self._reply(body, 'application/zip')
+        if page == 'api-user.php' :
+            return self._reply(body, 'application/json')
+        return self._reply(body.replace(b'{jid}', str(key).encode()), 'text/html; charset=UTF-8')
+
+    def do_GET(self):
+        self._handle({})
+
+    def do_POST(self):
+        n=int(self.headers.get('Content-Length', 0))
+        form={k: v[-1] for k, v in parse_qs(self.rfile.read(n).decode()).items()}
+        self._handle(form)
+
+
+def serve(directory, port=0, latency=0.0):
+    '''
+    Start the stand-in server in a background thread.
+    Returns the server; its base URL is in server.url.
+    '''
+    srv=ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    srv.daemon_threads=True
+    srv.directory=directory
+    srv.latency=latency
+    srv.url='http://127.0.0.1:%d/' % srv.server_address[1]
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Stand-in telescope.org server')
+    parser.add_argument('-d', '--directory', default='.cache/bench/responses',
+                        help='Directory with the recorded responses')
+    parser.add_argument('-p', '--port', type=int, default=8080)
+    parser.add_argument('-l', '--latency', type=float, default=0.05, help='Latency of each response (s)')
+    parser.add_argument('-n', '--jobs', type=int, default=50, help='Number of jobs in generated recordings')
+    args = parser.parse_args()
+    make_recording(args.directory, args.jobs)
+    srv=serve(args.directory, args.port, args.latency)
+    print('Serving %s at %s' % (args.directory, srv.url))
+    try :
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt :
+        srv.shutdown()
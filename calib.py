@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+# coding: utf-8
+
+'''
+Library of master calibration frames.
+
+Master darks (per telescope, camera and exposure; the bias is the dark
+of zero exposure) and master flats (per telescope, camera and filter)
+are built as medians of the bias, dark and flat frames found in the
+archive index and stored as .npy files named after the telescope,
+camera, exposure/filter and night. They are
+opened memory-mapped, so the library can hold many masters cheaply.
+
+Frames are calibrated in groups sharing the telescope, camera, exposure,
+filter and night: the group is stacked into one array and the masters
+are applied to the whole stack by broadcasting.
+
+Usage: python calib.py [-d calib_dir] [-a archive.db] [-s start] [-e end]
+'''
+
+from __future__ import print_function, division, absolute_import
+
+import os
+from os import path
+import re
+import glob
+import logging
+from collections import defaultdict, Counter
+
+import numpy as np
+from astropy.time import Time
+
+
+def night(date):
+    '''
+    The night (YYYYMMDD of the evening) of the observation date
+    (anything accepted by astropy Time). Nights change at noon UT.
+    '''
+    return (Time(date)-0.5).strftime('%Y%m%d')
+
+
+def _slug(s):
+    return re.sub(r'[^A-Za-z0-9.-]+', '-', str(s or 'unknown').strip()) or 'unknown'
+
+
+def _exposure(h):
+    return float(h.get('EXPTIME', h.get('EXPOSURE', 0)) or 0)
+
+
+# Filter names of the frame headers to the layer names of the pipeline
+# (see layer_filters in pipeline)
+filter_names={'Blue': 'B', 'Green': 'G', 'Red': 'R'}
+
+
+def normalize_filter(f):
+    f=str(f or '').strip()
+    return filter_names.get(f, f)
+
+
+def frame_group(h):
+    '''
+    Calibration group of the frame header:
+    (telescope, camera, exposure, filter, night).
+    '''
+    return (str(h.get('TELESCOP', '')).strip(), str(h.get('INSTRUME', '')).strip(),
+            _exposure(h), normalize_filter(h.get('FILTER')), night(h['DATE-OBS']))
+
+
+class CalibrationLibrary :
+    '''
+    Master calibration frames stored in the directory.
+    '''
+
+    def __init__(self, directory='.cache/calib'):
+        self.directory=directory
+        self.masters={}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, kind, telescope, camera, param, date):
+        if kind == 'dark' :
+            param='%gs' % param
+        return path.join(self.directory, '%s_%s_%s_%s_%s.npy' %
+                    (kind, _slug(telescope), _slug(camera), _slug(param), date))
+
+    def _open(self, fn):
+        try :
+            return self.masters[fn]
+        except KeyError :
+            m=self.masters[fn]=np.load(fn, mmap_mode='r')
+            return m
+
+    def save(self, kind, telescope, camera, param, date, master):
+        '''
+        Store the master frame (param is the exposure of the darks or
+        the filter of the flats; date is the night YYYYMMDD).
+        '''
+        fn=self._path(kind, telescope, camera, param, date)
+        tmp=fn+'.%d.tmp.npy' % os.getpid()
+        np.save(tmp, np.asarray(master, dtype=np.float32))
+        os.replace(tmp, fn)
+        self.masters.pop(fn, None)
+        return fn
+
+    def build(self, kind, frames, telescope, camera, param, date, dark=None):
+        '''
+        Build and store the master from the stack (or list) of frames:
+        the median of the frames; flats are dark subtracted (if dark
+        is given) and normalised to median 1. Only the frames of the
+        most common shape (binning) are used.
+        '''
+        log = logging.getLogger(__name__)
+        frames=[np.asarray(f) for f in frames]
+        shapes=Counter(f.shape for f in frames)
+        shape=shapes.most_common(1)[0][0]
+        if len(shapes) > 1 :
+            log.warning('Master %s %s %s %s %s: skipping %d frames not of shape %s',
+                        kind, telescope, camera, param, date, len(frames)-shapes[shape], shape)
+        stack=np.asarray([f for f in frames if f.shape == shape], dtype=np.float32)
+        if kind == 'flat' :
+            if dark is not None and dark.shape == shape :
+                stack=stack-dark
+            # Normalise each frame before combining (sky flats vary in level)
+            stack/=np.median(stack.reshape(len(stack), -1), axis=1)[:, None, None]
+        master=np.median(stack, axis=0)
+        if kind == 'flat' :
+            master/=np.median(master)
+        log.info('Master %s %s %s %s %s from %d frames',
+                 kind, telescope, camera, param, date, len(stack))
+        return self.save(kind, telescope, camera, param, date, master)
+
+    def find(self, kind, telescope, camera, param, date):
+        '''
+        Master frame for the night date (YYYYMMDD): the latest one
+        taken on or before that night. If the dark of the exposure is
+        missing, the bias subtracted dark of the nearest exposure is
+        scaled by the exposure ratio (only when there is a bias).
+        Returns None if there is none.
+        '''
+        pfx=path.join(self.directory, '%s_%s_%s_' % (kind, _slug(telescope), _slug(camera)))
+        cands=[]
+        for fn in glob.glob(pfx+'*.npy'):
+            p, d = path.basename(fn)[:-len('.npy')].rsplit('_', 2)[1:]
+            if d > date :
+                continue
+            if kind == 'dark' :
+                cands.append((float(p[:-1]), d, fn))
+            elif p == _slug(param) :
+                cands.append((param, d, fn))
+        if not cands :
+            return None
+        exact=[c for c in cands if c[0] == param]
+        if exact :
+            return self._open(max(exact, key=lambda c: c[1])[2])
+        # The dark holds the bias, only the rest scales with the exposure
+        bias=[c for c in cands if c[0] == 0]
+        darks=[c for c in cands if c[0] > 0]
+        if not bias or not darks :
+            return None
+        bias=self._open(max(bias, key=lambda c: c[1])[2])
+        # Dark of the nearest exposure, latest night, scaled to this one
+        exp, d, fn = max(darks, key=lambda c: (-abs(c[0]-param), c[1]))
+        dark=self._open(fn)
+        if dark.shape != bias.shape :
+            return None
+        return bias+(dark-bias)*(param/exp)
+
+    def calibrate(self, stack, telescope, camera, exptime, filt, date):
+        '''
+        Calibrate the stack of frames (N x ny x nx or a single frame)
+        from the same camera, exposure, filter and night:
+        (stack - dark) / flat, broadcast over the whole stack.
+        Missing masters, and those of another shape (binning) than
+        the frames, are skipped. Returns the float32 array or None
+        if there are no masters at all.
+        '''
+        log = logging.getLogger(__name__)
+        res=np.array(stack, dtype=np.float32)
+        dark=self.find('dark', telescope, camera, exptime, date)
+        flat=self.find('flat', telescope, camera, filt, date)
+        if dark is not None and dark.shape != res.shape[-2:] :
+            log.warning('Dark %s %s %gs %s: shape %s, frames %s', telescope, camera,
+                        exptime, date, dark.shape, res.shape[-2:])
+            dark=None
+        if flat is not None and flat.shape != res.shape[-2:] :
+            log.warning('Flat %s %s %s %s: shape %s, frames %s', telescope, camera,
+                        filt, date, flat.shape, res.shape[-2:])
+            flat=None
+        if dark is None and flat is None :
+            log.debug('No masters for %s %s %gs %s %s', telescope, camera, exptime, filt, date)
+            return None
+        if dark is not None :
+            res-=dark
+        if flat is not None :
+            np.divide(res, flat, out=res, where=flat > 0)
+        return res
+
+    def calibrate_hdus(self, hdul):
+        '''
+        Calibrate the list of hdu's in place: one vectorised pass
+        per calibration group. Returns the list.
+        '''
+        groups=defaultdict(list)
+        for hdu in hdul:
+            try :
+                groups[frame_group(hdu.header)].append(hdu)
+            except (KeyError, ValueError) :
+                pass
+        for g, hdus in groups.items():
+            shapes={hdu.data.shape for hdu in hdus}
+            for shape in shapes:
+                sel=[hdu for hdu in hdus if hdu.data.shape == shape]
+                out=self.calibrate(np.stack([hdu.data for hdu in sel]), *g)
+                if out is None :
+                    continue
+                for hdu, d in zip(sel, out):
+                    hdu.data=d
+                    hdu.header['HISTORY']='Calibrated with master dark/flat'
+        return hdul
+
+    def build_from_index(self, index, read_frame, start=None, end=None, telescope=None):
+        '''
+        Build the masters from the bias, dark and flat frames (IMAGETYP)
+        in the ArchiveIndex, one per group and night. read_frame
+        returns the data of the index row. Returns the list of files.
+        '''
+        def grouped(kind, param):
+            g=defaultdict(list)
+            for r in index.query(telescope=telescope, start=start, end=end,
+                                 where='lower(imagetyp) like ?', params=('%%%s%%' % kind,)):
+                if r['date_obs'] :
+                    g[(r['telescop'], r['instrume'], param(r), night(r['date_obs']))].append(r)
+            return g
+
+        res=[]
+        for (tel, cam, exp, d), rows in grouped('bias', lambda r: 0.0).items():
+            res.append(self.build('dark', [read_frame(r) for r in rows], tel, cam, exp, d))
+        for (tel, cam, exp, d), rows in grouped('dark', lambda r: float(r['exptime'] or 0)).items():
+            res.append(self.build('dark', [read_frame(r) for r in rows], tel, cam, exp, d))
+        for (tel, cam, filt, d), rows in grouped('flat', lambda r: normalize_filter(r['filter'])).items():
+            data=[read_frame(r) for r in rows]
+            dark=self.find('dark', tel, cam, float(rows[0]['exptime'] or 0), d)
+            res.append(self.build('flat', data, tel, cam, filt, d, dark=dark))
+        return res
+
+
+if __name__ == '__main__':
+    import argparse
+    from archive import ArchiveIndex, read_frame
+    parser = argparse.ArgumentParser(description='Build master calibration frames from the archive index')
+    parser.add_argument('-d', '--dir', default='.cache/calib', help='Calibration library directory')
+    parser.add_argument('-a', '--archive', default='.cache/archive.db', help='Archive index database')
+    parser.add_argument('-t', '--telescope', default=None, help='Telescope')
+    parser.add_argument('-s', '--start', default=None, help='Start date')
+    parser.add_argument('-e', '--end', default=None, help='End date')
+    args = parser.parse_args()
+    logging.basicConfig(level='INFO')
+    CalibrationLibrary(args.dir).build_from_index(ArchiveIndex(args.archive), read_frame,
+                                                  args.start, args.end, args.telescope)
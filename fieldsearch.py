@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+# coding: utf-8
+
+'''
+Per-run coalescing of the catalogue cone searches by field.
+
+All layers of a job, and often several jobs of one night, look at the
+same field. FieldSearch groups the frames by field, issues one cone
+search per field sized to the union of their footprints (with a small
+margin, so slightly shifted frames of the same field reuse it) and
+applies the name and magnitude filters once per field. The stars of a
+frame are then selected from its field with one vectorised projection.
+Only a bounded number of the recently used fields is kept, so the
+search can live as long as the process.
+'''
+
+from __future__ import print_function, division, absolute_import
+
+import logging
+
+import numpy as np
+from astropy import wcs
+
+
+def _unit(ra, dec):
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def _sep(u, v):
+    '''Angular distance (deg) between the unit vectors.'''
+    return np.degrees(np.arccos(np.clip(np.sum(u*v, axis=-1), -1, 1)))
+
+
+def footprint(header):
+    '''
+    Centre and corners (unit vectors) of the frame with the solved header.
+    '''
+    w=wcs.WCS(header)
+    nx, ny = header['NAXIS1'], header['NAXIS2']
+    c=w.all_pix2world([[nx/2, ny/2], [0, 0], [nx, 0], [nx, ny], [0, ny]], 0)
+    u=_unit(c[:,0], c[:,1])
+    return u[0], u[1:]
+
+
+class Field :
+
+    def __init__(self, centre, radius, rows):
+        self.centre=centre
+        self.radius=radius
+        self.rows=rows
+        if rows :
+            self.ra=np.array([r[2] for r in rows])
+            self.dec=np.array([r[3] for r in rows])
+
+    def covers(self, corners):
+        return bool(np.all(_sep(corners, self.centre) <= self.radius))
+
+
+class FieldSearch :
+    '''
+    Coalesced cone searches.
+
+    query     - function (ra, dec, radius) -> catalogue rows (deg);
+                the rows have 'Name' (bytes or str) and pos (SkyCoord)
+    accept    - function (name, row) -> bool, applied once per field
+    classify  - function (name) -> bool; the accepted names for which
+                it is true are collected in the designated set
+    pad       - relative margin added to the search radius
+    maxradius - largest search radius (deg)
+    maxfields - number of fields kept (the least recently used ones
+                are dropped), None for no limit
+    '''
+
+    def __init__(self, query, accept=None, classify=None, pad=0.1, maxradius=5,
+                 maxfields=200):
+        self.query=query
+        self.accept=accept
+        self.classify=classify
+        self.pad=pad
+        self.maxradius=maxradius
+        self.maxfields=maxfields
+        self.fields=[]
+        self.designated=set()
+
+    def _find(self, corners):
+        for n, f in enumerate(self.fields):
+            if f.covers(corners) :
+                # Most recently used last
+                self.fields.append(self.fields.pop(n))
+                return f
+        return None
+
+    def _trim(self):
+        if self.maxfields is None or len(self.fields) <= self.maxfields :
+            return
+        old=self.fields[:-self.maxfields]
+        del self.fields[:-self.maxfields]
+        kept={r[0] for f in self.fields for r in f.rows}
+        self.designated-={r[0] for f in old for r in f.rows}-kept
+
+    def _search(self, centre, radius):
+        log = logging.getLogger(__name__)
+        ra=np.degrees(np.arctan2(centre[1], centre[0])) % 360
+        dec=np.degrees(np.arcsin(np.clip(centre[2], -1, 1)))
+        rows=[]
+        for s in self.query(ra, dec, radius):
+            name=s['Name']
+            name=name.decode('ASCII') if isinstance(name, bytes) else str(name)
+            if self.accept is None or self.accept(name, s) :
+                rows.append((name, s, s.pos.ra.deg, s.pos.dec.deg))
+                if self.classify is not None and self.classify(name) :
+                    self.designated.add(name)
+        log.debug('Field %.3f %+.3f r=%.2f: %d stars', ra, dec, radius, len(rows))
+        f=Field(centre, radius, rows)
+        self.fields.append(f)
+        self._trim()
+        return f
+
+    def plan(self, headers):
+        '''
+        Search the fields of all frames (solved headers) not covered yet:
+        frames whose centres are within the frame radius of each other
+        share one search covering all their corners.
+        '''
+        fps=[footprint(h) for h in headers]
+        todo=[fp for fp in fps if self._find(fp[1]) is None]
+        while todo :
+            c0, k0 = todo.pop(0)
+            r0=_sep(k0, c0).max()
+            group=[(c0, k0)]+[fp for fp in todo if _sep(fp[0], c0) <= r0]
+            todo=[fp for fp in todo if _sep(fp[0], c0) > r0]
+            centre=np.mean([c for c, k in group], axis=0)
+            centre/=np.linalg.norm(centre)
+            corners=np.concatenate([k for c, k in group])
+            radius=min(self.maxradius, _sep(corners, centre).max()*(1+self.pad))
+            self._search(centre, radius)
+
+    def search(self, header):
+        '''
+        The accepted catalogue stars inside the frame with the solved
+        header: list of [name, row] pairs.
+        '''
+        centre, corners = footprint(header)
+        f=self._find(corners)
+        if f is None :
+            self.plan([header])
+            f=self._find(corners)
+            if f is None :
+                # Frame larger than maxradius: use the field searched for it
+                f=self.fields[-1]
+        if not f.rows :
+            return []
+        px, py = wcs.WCS(header).all_world2pix(f.ra, f.dec, 0)
+        ok=(0 < px) & (px < header['NAXIS1']) & (0 < py) & (py < header['NAXIS2'])
+        return [[r[0], r[1]] for r, k in zip(f.rows, ok) if k]
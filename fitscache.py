@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+# coding: utf-8
+
+'''
+Tile-compressed FITS format of the job cache.
+
+The zip archives from the server are transcoded into a single FITS
+file (jid.fits.fz) with one tile-compressed image extension per layer
+of the archive (square tiles). Integer frames are Rice compressed and
+float frames are compressed with the byte-shuffled gzip (GZIP_2) with
+quantization off; both are lossless. Cutouts
+are read through the .section of the extension, which decompresses
+only the tiles touched by the cutout.
+
+CompressedArchive gives the zip-like interface (namelist, read) used
+by the code written for the zip archives.
+
+Usage: python fitscache.py [-j workers] [-k] cache_directory
+'''
+
+from __future__ import print_function, division, absolute_import
+
+import os
+from os import path
+import logging
+from io import BytesIO
+from zipfile import ZipFile, BadZipFile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+
+suffix='.fits.fz'
+
+
+def write_layers(layers, fp, tile=64):
+    '''
+    Write the layers, (name, FITS file content) pairs, into the
+    tile-compressed FITS file fp. The file is written under a temporary
+    name and renamed when complete.
+    '''
+    hdul=[fits.PrimaryHDU()]
+    for name, content in layers:
+        with fits.open(BytesIO(content)) as f :
+            h=f[0]
+            if h.data is None :
+                continue
+            hdr=h.header.copy()
+            hdr['EXTNAME']=name
+            if np.issubdtype(h.data.dtype, np.integer) :
+                hdul.append(fits.CompImageHDU(h.data, hdr, compression_type='RICE_1',
+                                              tile_shape=(tile, tile)))
+            else :
+                # quantize_level=0: lossless compression of the floats
+                hdul.append(fits.CompImageHDU(h.data, hdr, compression_type='GZIP_2',
+                                              quantize_level=0.0, tile_shape=(tile, tile)))
+    tmp=fp+'.%d.tmp' % os.getpid()
+    try :
+        fits.HDUList(hdul).writeto(tmp, overwrite=True)
+        os.replace(tmp, fp)
+    finally :
+        if path.isfile(tmp) :
+            os.remove(tmp)
+    return fp
+
+
+def transcode(zipfp, fp=None, tile=64):
+    '''
+    Transcode the zip archive of the job into the tile-compressed FITS
+    file fp (default: the archive name with .fits.fz).
+    Returns the name of the file.
+    '''
+    if fp is None :
+        fp=zipfp[:-len('.zip')]+suffix
+    with ZipFile(zipfp) as z :
+        return write_layers(((name, z.read(name)) for name in z.namelist()), fp, tile)
+
+
+class CompressedArchive :
+    '''
+    Read access to the tile-compressed job file with the interface
+    of ZipFile used for the job archives (namelist, read, close).
+    '''
+
+    def __init__(self, fp):
+        self.fp=fp
+        self.hdul=fits.open(fp)
+        self.names=[h.header.get('EXTNAME', h.name) for h in self.hdul[1:]]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.hdul.close()
+
+    def namelist(self):
+        return list(self.names)
+
+    def hdu(self, name):
+        '''The image extension of the layer name.'''
+        return self.hdul[self.names.index(name)+1]
+
+    def read(self, name):
+        '''
+        The layer as the FITS file content (bytes), as in the zip archive.
+        Decompresses the whole frame; use cutout for parts of it.
+        '''
+        h=self.hdu(name)
+        hdr=h.header.copy()
+        hdr.remove('EXTNAME', ignore_missing=True)
+        buf=BytesIO()
+        fits.PrimaryHDU(h.data, hdr).writeto(buf)
+        return buf.getvalue()
+
+    def cutout(self, name, y0, y1, x0, x1):
+        '''
+        The part [y0:y1, x0:x1] of the layer (0-based numpy indices).
+        Only the tiles covering it are decompressed.
+        '''
+        return self.hdu(name).section[y0:y1, x0:x1]
+
+
+def read_headers(fp):
+    '''
+    The list of (layer name, Header) of the tile-compressed job file.
+    '''
+    with CompressedArchive(fp) as a :
+        return [(n, a.hdu(n).header.copy()) for n in a.names]
+
+
+def migrate_archive(task):
+    '''
+    Transcode one zip archive and check the result; the archive is
+    removed unless keep. Runs in the worker processes of migrate.
+    Returns (zip file, saved bytes or None on failure).
+    '''
+    log = logging.getLogger(__name__)
+    zipfp, keep = task
+    fp=zipfp[:-len('.zip')]+suffix
+    try :
+        transcode(zipfp, fp)
+        with ZipFile(zipfp) as z, CompressedArchive(fp) as a :
+            for name in a.namelist():
+                with fits.open(BytesIO(z.read(name))) as f :
+                    if not np.array_equal(f[0].data, a.hdu(name).data) :
+                        raise ValueError('%s: layer %s differs' % (fp, name))
+    except (BadZipFile, OSError, ValueError) as e :
+        log.warning('Cannot transcode %s: %s', zipfp, e)
+        if path.isfile(fp) :
+            os.remove(fp)
+        return zipfp, None
+    saved=os.stat(zipfp).st_size-os.stat(fp).st_size
+    if not keep :
+        os.remove(zipfp)
+    return zipfp, saved
+
+
+def migrate(cache, workers=None, keep=False):
+    '''
+    Transcode all zip archives in the cache directory into the
+    tile-compressed format in a pool of worker processes.
+    Returns the number of transcoded archives and the saved bytes.
+    '''
+    log = logging.getLogger(__name__)
+    todo=[]
+    for d, dirs, files in os.walk(cache):
+        for fn in files:
+            if fn.endswith('.zip') and not path.isfile(path.join(d, fn[:-4]+suffix)) :
+                todo.append((path.join(d, fn), keep))
+    n=saved=0
+    if todo :
+        with ProcessPoolExecutor(workers) as ex :
+            for fp, s in ex.map(migrate_archive, todo, chunksize=8):
+                if s is not None :
+                    n+=1
+                    saved+=s
+    log.info('Transcoded %d of %d archives, saved %.1f MB', n, len(todo), saved/2**20)
+    return n, saved
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Transcode the job cache into tile-compressed FITS')
+    parser.add_argument('cache', help='Job cache directory')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('-k', '--keep', action='store_true', help='Keep the zip archives')
+    args = parser.parse_args()
+    logging.basicConfig(level='INFO')
+    migrate(args.cache, args.jobs, args.keep)
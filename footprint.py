@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+# coding: utf-8
+
+'''
+Spatial index of the footprints of the solved frames.
+
+The sky is divided into cells of roughly equal area: declination bands
+of the cell size, each split in RA into as many cells as fit around the
+band. Every solved frame is registered in all cells its footprint
+touches (sampled on a grid of pixels finer than the cell and along
+its edges), together with its corners. A position query looks up a single cell and then
+tests the candidates exactly against their footprint polygons.
+'''
+
+from __future__ import print_function, division, absolute_import
+
+import os
+from os import path
+import json
+import sqlite3
+import logging
+import threading
+
+import numpy as np
+
+
+class CellGrid :
+    '''
+    Equal-area-ish grid of cells of size deg.
+    '''
+
+    def __init__(self, size=1.0):
+        self.size=size
+        self.nbands=int(np.ceil(180/size))
+        dec=-90+(np.arange(self.nbands)+0.5)*180/self.nbands
+        self.nra=np.maximum(1, np.ceil(360*np.cos(np.radians(dec))/size)).astype(int)
+
+    def cells(self, ra, dec):
+        '''
+        Cell numbers of the positions (deg, arrays or scalars).
+        '''
+        ra=np.mod(np.asarray(ra, dtype=float), 360)
+        band=np.clip(((np.asarray(dec, dtype=float)+90)*self.nbands/180).astype(int),
+                     0, self.nbands-1)
+        n=self.nra[band]
+        return band*100000+np.minimum((ra*n/360).astype(int), n-1)
+
+
+def _tangent(ra, dec, ra0, dec0):
+    '''Gnomonic projection of (ra, dec) about (ra0, dec0); all in deg.'''
+    ra, dec, ra0, dec0 = (np.radians(v) for v in (ra, dec, ra0, dec0))
+    c=np.sin(dec0)*np.sin(dec)+np.cos(dec0)*np.cos(dec)*np.cos(ra-ra0)
+    x=np.cos(dec)*np.sin(ra-ra0)/c
+    y=(np.cos(dec0)*np.sin(dec)-np.sin(dec0)*np.cos(dec)*np.cos(ra-ra0))/c
+    return x, y, c
+
+
+def _inside(px, py, poly):
+    '''Even-odd point in polygon test.'''
+    inside=False
+    n=len(poly)
+    for i in range(n):
+        x1, y1 = poly[i]
+        x2, y2 = poly[(i+1) % n]
+        if (y1 > py) != (y2 > py) and px < (x2-x1)*(py-y1)/(y2-y1)+x1 :
+            inside=not inside
+    return inside
+
+
+class FootprintIndex :
+    '''
+    Footprint index of the solved frames stored in the dbfile.
+    Frames are identified by their keys (jid_filter, as in wcscache).
+    '''
+
+    def __init__(self, dbfile='.cache/footprints.db', cellsize=1.0):
+        d=path.dirname(dbfile)
+        if d :
+            os.makedirs(d, exist_ok=True)
+        self.db=sqlite3.connect(dbfile, check_same_thread=False)
+        # The connection is shared by the threads: one transaction at a time
+        self.lock=threading.RLock()
+        self.db.executescript('''
+            create table if not exists meta (name text primary key, value text);
+            create table if not exists frames (key text primary key,
+                ra real, dec real, corners text);
+            create table if not exists cells (cell integer, key text);
+            create index if not exists cells_cell on cells(cell);
+            create index if not exists cells_key on cells(key);
+            ''')
+        r=self.db.execute("select value from meta where name='cellsize'").fetchone()
+        if r is None :
+            self.db.execute("insert into meta values ('cellsize', ?)", (str(cellsize),))
+        else :
+            cellsize=float(r[0])
+        self.db.commit()
+        self.grid=CellGrid(cellsize)
+
+    def __contains__(self, key):
+        with self.lock:
+            return self.db.execute('select 1 from frames where key=?', (key,)).fetchone() is not None
+
+    def add(self, key, header):
+        '''
+        Register the frame with the solved header under the key
+        (replacing the previous footprint).
+        '''
+        from astropy import wcs
+        from astropy.wcs.utils import proj_plane_pixel_scales
+
+        w=wcs.WCS(header)
+        nx, ny = header['NAXIS1'], header['NAXIS2']
+        corners=w.all_pix2world([[0.5, 0.5], [nx+0.5, 0.5], [nx+0.5, ny+0.5], [0.5, ny+0.5]], 1)
+        cen=w.all_pix2world([[(nx+1)/2, (ny+1)/2]], 1)[0]
+        # Sample the frame finer than the cells
+        scale=np.max(np.abs(proj_plane_pixel_scales(w)))
+        step=max(1, int(self.grid.size/scale/3))
+        x, y = np.meshgrid(np.r_[np.arange(0.5, nx+0.5, step), nx+0.5],
+                           np.r_[np.arange(0.5, ny+0.5, step), ny+0.5])
+        # and its edges at every pixel, catching the cells it only clips
+        ex, ey = np.arange(0.5, nx+1), np.arange(0.5, ny+1)
+        x=np.r_[x.ravel(), ex, ex, np.full(len(ey), 0.5), np.full(len(ey), nx+0.5)]
+        y=np.r_[y.ravel(), np.full(len(ex), 0.5), np.full(len(ex), ny+0.5), ey, ey]
+        ra, dec = w.all_pix2world(x, y, 1)
+        cells=np.unique(self.grid.cells(ra, dec))
+        with self.lock, self.db :
+            self.db.execute('delete from cells where key=?', (key,))
+            self.db.execute('insert or replace into frames values (?,?,?,?)',
+                            (key, float(cen[0]), float(cen[1]), json.dumps(corners.tolist())))
+            self.db.executemany('insert into cells values (?,?)', [(int(c), key) for c in cells])
+
+    def backfill(self, frames, name='wcscache'):
+        '''
+        One-time registration of the frames solved before the index
+        existed: frames is an iterable of (key, solved header); the keys
+        present already are skipped. The backfill from the source name
+        is recorded in the index and not repeated (frames is not even
+        iterated then). Returns the number of added frames.
+        '''
+        log = logging.getLogger(__name__)
+        flag='backfill:%s' % name
+        with self.lock:
+            done=self.db.execute('select 1 from meta where name=?', (flag,)).fetchone()
+        if done :
+            return 0
+        n=0
+        for key, header in frames:
+            if key in self :
+                continue
+            try :
+                self.add(key, header)
+            except (KeyError, ValueError) as e :
+                log.warning('Cannot index %s: %s', key, e)
+                continue
+            n+=1
+        with self.lock, self.db :
+            self.db.execute('insert or replace into meta values (?, ?)', (flag, str(n)))
+        log.info('Footprint index backfilled with %d frames from %s', n, name)
+        return n
+
+    def remove(self, key):
+        with self.lock, self.db :
+            self.db.execute('delete from cells where key=?', (key,))
+            self.db.execute('delete from frames where key=?', (key,))
+
+    def query(self, ra, dec):
+        '''
+        Keys of all frames covering the position ra, dec (deg, ICRS).
+        '''
+        cell=int(self.grid.cells(ra, dec))
+        with self.lock:
+            rows=self.db.execute(
+                'select f.key, f.ra, f.dec, f.corners from cells c join frames f '
+                'on c.key=f.key where c.cell=?', (cell,)).fetchall()
+        res=[]
+        for key, ra0, dec0, corners in rows:
+            c=np.array(json.loads(corners))
+            x, y, cc = _tangent(c[:,0], c[:,1], ra0, dec0)
+            px, py, pc = _tangent(ra, dec, ra0, dec0)
+            if pc > 0 and _inside(px, py, list(zip(x, y))) :
+                res.append(key)
+        return res
+
+    def query_coord(self, coord):
+        '''
+        Keys of all frames covering the SkyCoord.
+        '''
+        c=coord.icrs
+        return self.query(c.ra.deg, c.dec.deg)
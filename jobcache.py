@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+# coding: utf-8
+
+'''
+Concurrency-safe storage of the downloaded jobs.
+
+Entries are written to a temporary file in the target directory,
+validated and only then renamed to their final name, so readers never
+see partial files. The download of an entry is done under an exclusive
+lock (fcntl.flock on the entry.lock file, removed afterwards), so any
+number of processes sharing the cache fetch each job exactly once: the
+others wait for the lock and find the published entry.
+
+ArchivePool keeps a bounded number of the job archives open for
+repeated access, closing the least recently used ones.
+'''
+
+from __future__ import print_function, division, absolute_import
+
+import os
+from os import path
+import fcntl
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from zipfile import ZipFile, BadZipFile
+
+from metrics import registry as metrics
+
+
+class InvalidEntry(Exception):
+    pass
+
+
+def validate_zip(fp):
+    '''Check the CRCs of all members of the zip archive fp.'''
+    try :
+        with ZipFile(fp) as z :
+            bad=z.testzip()
+    except (BadZipFile, OSError) as e :
+        raise InvalidEntry('%s: %s' % (fp, e))
+    if bad is not None :
+        raise InvalidEntry('%s: bad member %s' % (fp, bad))
+
+
+def validate_fits(fp):
+    '''Check that the FITS file fp is complete.'''
+    from astropy.io import fits
+
+    try :
+        with fits.open(fp) as f :
+            f.verify('exception')
+            for h in f :
+                h.data
+    except (OSError, ValueError, fits.VerifyError) as e :
+        raise InvalidEntry('%s: %s' % (fp, e))
+
+
+validators={'.zip': validate_zip, '.fits': validate_fits, '.fz': validate_fits}
+
+# Permissions of the published entries, as open() would create them
+umask=os.umask(0)
+os.umask(umask)
+mode=0o666 & ~umask
+
+
+@contextmanager
+def locked(fp):
+    '''
+    Hold the exclusive lock of the cache entry fp. The lock file is
+    removed when the lock is released; a waiter which got the lock of
+    the removed file tries again with the current one.
+    '''
+    lock=fp+'.lock'
+    while True :
+        fd=open(lock, 'a')
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try :
+            current=os.stat(lock).st_ino == os.fstat(fd.fileno()).st_ino
+        except FileNotFoundError :
+            current=False
+        if current :
+            break
+        fd.close()
+    try :
+        yield
+    finally :
+        try :
+            os.remove(lock)
+        except FileNotFoundError :
+            pass
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        fd.close()
+
+
+@contextmanager
+def publishing(fp, validate=None):
+    '''
+    Write the entry fp atomically: yields the open temporary file,
+    which is validated (by extension unless validate is given) and
+    renamed to fp when the block completes. On any error the
+    temporary file is removed and fp is left untouched.
+    '''
+    d=path.dirname(fp)
+    fd, tmp = tempfile.mkstemp(prefix='.'+path.basename(fp)+'.', suffix='.tmp', dir=d or '.')
+    try :
+        with os.fdopen(fd, 'wb') as f :
+            # mkstemp creates the file 0600
+            os.fchmod(f.fileno(), mode)
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        if validate is None :
+            validate=validators.get(path.splitext(fp)[1])
+        if validate is not None :
+            validate(tmp)
+        os.replace(tmp, fp)
+    except BaseException :
+        os.remove(tmp)
+        raise
+
+
+def fetch(fp, download, validate=None):
+    '''
+    Make sure the entry fp exists: if it does not, take its lock and
+    (if still missing) call download(file) to write it, publishing it
+    atomically. Returns True if the entry was downloaded by this call.
+    '''
+    log = logging.getLogger(__name__)
+    if path.isfile(fp) :
+        return False
+    os.makedirs(path.dirname(fp), exist_ok=True)
+    with locked(fp):
+        if path.isfile(fp) :
+            log.debug('%s published by another worker', fp)
+            return False
+        with publishing(fp, validate) as f :
+            download(f)
+    return True
+
+
+class ArchivePool :
+    '''
+    Bounded pool of open job archives. Archives are opened by
+    opener(*args) on first use, handed out with acquire (or the
+    archive context manager) and must be given back with release.
+    At most size archives are kept open: the least recently used
+    ones which are not in use are closed first.
+    '''
+
+    def __init__(self, opener, size=16):
+        self.opener=opener
+        self.size=size
+        self.entries=OrderedDict()
+        self.lock=threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def acquire(self, key, *args):
+        '''The open archive for the key (opened with opener(*args) if needed).'''
+        with self.lock:
+            e=self.entries.get(key)
+            if e is not None :
+                e[1]+=1
+                self.entries.move_to_end(key)
+        metrics.hit('archives', e is not None)
+        if e is not None :
+            return e[0]
+        a=self.opener(*args)
+        if a is None :
+            raise OSError('Cannot open the archive %s' % key)
+        with self.lock:
+            e=self.entries.get(key)
+            if e is None :
+                e=self.entries[key]=[a, 1]
+                a=None
+            else :
+                # Opened concurrently by another thread
+                e[1]+=1
+                self.entries.move_to_end(key)
+            self._trim()
+        if a is not None :
+            a.close()
+        return e[0]
+
+    def release(self, key):
+        '''Give the archive back; it may be closed from now on.'''
+        with self.lock:
+            self.entries[key][1]-=1
+            self._trim()
+
+    @contextmanager
+    def archive(self, key, *args):
+        '''Context manager holding the archive (see acquire).'''
+        a=self.acquire(key, *args)
+        try :
+            yield a
+        finally :
+            self.release(key)
+
+    def _trim(self):
+        for k in list(self.entries):
+            if len(self.entries) <= self.size :
+                break
+            a, refs = self.entries[k]
+            if refs <= 0 :
+                del self.entries[k]
+                a.close()
+        metrics.set('open_archives', len(self.entries))
+
+    def close(self):
+        '''Close all archives which are not in use.'''
+        with self.lock:
+            size, self.size = self.size, 0
+            self._trim()
+            self.size=size
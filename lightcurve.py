@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+# coding: utf-8
+
+'''
+Incremental light curves of variable stars from the solved archive.
+
+For the star, all solved frames covering it are found in the footprint
+index, the frames not measured yet are measured (aperture photometry
+against the AAVSO comparison sequence) in a process pool, and the new
+points are appended to the per-star CSV file. The frames are loaded
+by the workers, one job archive per task.
+'''
+
+from __future__ import print_function, division, absolute_import
+
+import os
+from os import path
+import csv
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+# Position of the magnitude column in get_VS_sequence star rows for the filter
+sequence_bands={'B': 6, 'V': 7, 'G': 7, 'R': 8}
+
+fields=('key', 'mjd', 'filter', 'mag', 'err', 'ncomp')
+
+
+def parse_mag(s):
+    '''Magnitude from the AAVSO sequence entry like "11.234 (0.045)".'''
+    try :
+        return float(s.split()[0])
+    except (AttributeError, IndexError, ValueError) :
+        return None
+
+
+def aperture_flux(data, x, y, r=4, rin=8, rout=12):
+    '''
+    Background subtracted flux in the circular aperture of radius r
+    at (x, y) (0-based pixels). The background is the median in the
+    annulus rin-rout. Returns None if the aperture is off the frame.
+    '''
+    ny, nx = data.shape
+    i0, i1 = int(y-rout), int(y+rout)+2
+    j0, j1 = int(x-rout), int(x+rout)+2
+    if i0 < 0 or j0 < 0 or i1 > ny or j1 > nx :
+        return None
+    cut=np.asarray(data[i0:i1, j0:j1], dtype=float)
+    yy, xx = np.mgrid[i0:i1, j0:j1]
+    d2=(xx-x)**2+(yy-y)**2
+    ap=d2 <= r*r
+    sky=np.median(cut[(d2 >= rin*rin) & (d2 <= rout*rout)])
+    return (cut[ap]-sky).sum()
+
+
+def measure_frame(task):
+    '''
+    Measure the target in one frame. task is a dictionary with
+    key, data, header, target (ra, dec) and comps (list of (ra, dec, mag)).
+    Returns the row for the light curve; if the target cannot be
+    measured the mag is empty (the frame is still recorded as done).
+    '''
+    from astropy import wcs
+    from astropy.time import Time
+
+    h=task['header']
+    t=Time(h['DATE-OBS']).mjd+h.get('EXPTIME', 0)/2/86400
+    row={'key': task['key'], 'mjd': t, 'filter': h.get('FILTER'),
+         'mag': None, 'err': None, 'ncomp': 0}
+    if not task['comps'] :
+        return row
+    w=wcs.WCS(h)
+    pos=np.array([task['target']]+[c[:2] for c in task['comps']])
+    px=w.all_world2pix(pos, 0)
+    fl=np.array([aperture_flux(task['data'], x, y) or np.nan for x, y in px])
+    cmag=np.array([c[2] for c in task['comps']])
+    ok=fl[1:] > 0
+    if not fl[0] > 0 or not ok.any() :
+        return row
+    zp=cmag[ok]+2.5*np.log10(fl[1:][ok])
+    row['mag']=-2.5*np.log10(fl[0])+np.median(zp)
+    row['err']=np.std(zp)/np.sqrt(ok.sum()) if ok.sum() > 1 else None
+    row['ncomp']=int(ok.sum())
+    return row
+
+
+def measure_job(task):
+    '''
+    Measure the target in the frames of one job archive, loaded here
+    (in the worker process). task is a dictionary with path (the job
+    archive), target, calib (calibration library directory or None)
+    and frames: the list of dictionaries with key, header (solved) and
+    comps (see measure_frame). Frames missing in the archive are skipped.
+    Returns the list of rows.
+    '''
+    from archive import read_matching
+
+    log = logging.getLogger(__name__)
+    frames=task['frames']
+    lib=None
+    if task.get('calib') :
+        from calib import CalibrationLibrary, frame_group
+        lib=CalibrationLibrary(task['calib'])
+    rows=[]
+    for f, data in zip(frames, read_matching(task['path'], [f['header'] for f in frames])):
+        if data is None :
+            log.warning('Frame %s not found in %s', f['key'], task['path'])
+            continue
+        if lib is not None :
+            try :
+                out=lib.calibrate(data, *frame_group(f['header']))
+            except (KeyError, ValueError) :
+                out=None
+            if out is not None :
+                data=out
+        rows.append(measure_frame(dict(f, data=data, target=task['target'])))
+    return rows
+
+
+def comparison_stars(stars, filt):
+    '''
+    Comparison stars (ra, dec, mag) in the filter from the AAVSO
+    sequence rows of get_VS_sequence.
+    '''
+    from astropy.coordinates import SkyCoord
+    import astropy.units as u
+
+    col=sequence_bands.get(filt)
+    res=[]
+    for s in stars or []:
+        m=parse_mag(s[col]) if col is not None and col < len(s) else None
+        if m is None and filt in ('V', 'G') :
+            # The AAVSO label is the V magnitude times 10
+            m=float(s[1])/10
+        if m is None :
+            continue
+        c=SkyCoord(s[2], s[4], unit=(u.hourangle, u.deg))
+        res.append((c.ra.deg, c.dec.deg, m))
+    return res
+
+
+class LightCurveBuilder :
+    '''
+    Builds light curves in the directory (one name.csv file per star).
+
+    footprints - FootprintIndex of the solved frames
+    locate     - function returning (job archive file, solved header)
+                 for the frame key, or None if it is not available
+    sequence   - function returning (sequence, stars) for the star name
+                 (like get_VS_sequence)
+    calib      - directory of the calibration library applied to the
+                 frames (see calib), or None
+    '''
+
+    def __init__(self, directory, footprints, locate, sequence, calib=None):
+        self.directory=directory
+        self.footprints=footprints
+        self.locate=locate
+        self.sequence=sequence
+        self.calib=calib
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return path.join(self.directory, '_'.join(name.split()).replace('/', '_')+'.csv')
+
+    def load(self, name):
+        '''
+        The light curve of the star: list of dictionaries (fields).
+        Frames where the star could not be measured have empty mag.
+        '''
+        fp=self._path(name)
+        if not path.isfile(fp) :
+            return []
+        with open(fp, newline='') as fd :
+            return list(csv.DictReader(fd))
+
+    def update(self, name, workers=None):
+        '''
+        Measure the star in all covering frames not measured before and
+        append the new points to its light curve.
+        Returns the list of new points.
+        '''
+        import BRT
+
+        log = logging.getLogger(__name__)
+        obj=BRT.resolve_name(name)
+        done={r['key'] for r in self.load(name)}
+        keys=[k for k in self.footprints.query_coord(obj) if k not in done]
+        if not keys :
+            return []
+        seq, stars = self.sequence(name)
+        # One task per job archive, holding all its frames
+        jobs={}
+        for k in keys:
+            loc=self.locate(k)
+            if loc is None :
+                continue
+            fp, header = loc
+            jobs.setdefault(fp, []).append(dict(key=k, header=header,
+                              comps=comparison_stars(stars, header.get('FILTER'))))
+        if not jobs :
+            return []
+        tasks=[dict(path=fp, frames=frames, target=(obj.ra.deg, obj.dec.deg), calib=self.calib)
+                for fp, frames in jobs.items()]
+        with ProcessPoolExecutor(workers) as ex :
+            rows=[r for res in ex.map(measure_job, tasks) for r in res]
+        if not rows :
+            return []
+        rows.sort(key=lambda r: r['mjd'])
+        fp=self._path(name)
+        new=not path.isfile(fp)
+        with open(fp, 'a', newline='') as fd :
+            wr=csv.DictWriter(fd, fields)
+            if new :
+                wr.writeheader()
+            wr.writerows(rows)
+        log.info('%s: %d new frames measured', name, len(rows))
+        return rows
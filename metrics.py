@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+# coding: utf-8
+
+'''
+Simple metrics registry.
+
+Counters, gauges and summaries (count/sum/max of observed values)
+with optional labels. The registry can be exported to a Prometheus
+text file (node exporter textfile format) or to JSON, once or
+periodically from a background thread.
+'''
+
+from __future__ import print_function, division, absolute_import
+
+import os
+from os import path
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _prom_labels(labels):
+    if not labels :
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                                for k, v in labels)
+
+
+class Registry :
+
+    def __init__(self, prefix='brt_'):
+        self.prefix=prefix
+        self.counters={}
+        self.gauges={}
+        self.summaries={}
+        self.lock=threading.Lock()
+        self._exporter=None
+
+    def inc(self, name, n=1, **labels):
+        '''Increase the counter.'''
+        k=_key(name, labels)
+        with self.lock:
+            self.counters[k]=self.counters.get(k, 0)+n
+
+    def set(self, name, value, **labels):
+        '''Set the gauge.'''
+        with self.lock:
+            self.gauges[_key(name, labels)]=value
+
+    def observe(self, name, value, **labels):
+        '''Add the value to the summary (count, sum, max).'''
+        k=_key(name, labels)
+        with self.lock:
+            c, s, m = self.summaries.get(k, (0, 0, value))
+            self.summaries[k]=(c+1, s+value, max(m, value))
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''Observe the wall time (s) of the block in the summary name.'''
+        t0=time.monotonic()
+        try :
+            yield
+        finally :
+            self.observe(name, time.monotonic()-t0, **labels)
+
+    def hit(self, cache, hit=True):
+        '''Count the cache hit (or miss if hit is False).'''
+        self.inc('cache_hits_total' if hit else 'cache_misses_total', cache=cache)
+
+    def to_dict(self):
+        def lst(d, f):
+            return [dict(name=k[0], labels=dict(k[1]), **f(v)) for k, v in sorted(d.items())]
+        with self.lock:
+            return {'time': time.time(),
+                    'counters': lst(self.counters, lambda v: {'value': v}),
+                    'gauges': lst(self.gauges, lambda v: {'value': v}),
+                    'summaries': lst(self.summaries,
+                            lambda v: {'count': v[0], 'sum': v[1], 'max': v[2]})}
+
+    def to_prometheus(self):
+        out=[]
+        with self.lock:
+            for kind, d in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({k[0] for k in d}):
+                    out.append('# TYPE %s%s %s' % (self.prefix, name, kind))
+                    for k, v in sorted(d.items()):
+                        if k[0] == name :
+                            out.append('%s%s%s %g' % (self.prefix, name, _prom_labels(k[1]), v))
+            for name in sorted({k[0] for k in self.summaries}):
+                out.append('# TYPE %s%s summary' % (self.prefix, name))
+                for k, (c, s, m) in sorted(self.summaries.items()):
+                    if k[0] == name :
+                        lb=_prom_labels(k[1])
+                        out.append('%s%s_count%s %d' % (self.prefix, name, lb, c))
+                        out.append('%s%s_sum%s %g' % (self.prefix, name, lb, s))
+                # The maximum is not part of a summary: separate gauge
+                out.append('# TYPE %s%s_max gauge' % (self.prefix, name))
+                for k, (c, s, m) in sorted(self.summaries.items()):
+                    if k[0] == name :
+                        out.append('%s%s_max%s %g' % (self.prefix, name, _prom_labels(k[1]), m))
+        return '\n'.join(out)+'\n'
+
+    def export(self, fn):
+        '''
+        Write the metrics to the file fn: JSON if the name ends
+        with .json, Prometheus text format otherwise.
+        The file is replaced atomically.
+        '''
+        d=path.dirname(fn)
+        if d :
+            os.makedirs(d, exist_ok=True)
+        txt=json.dumps(self.to_dict(), indent=1) if fn.endswith('.json') else self.to_prometheus()
+        tmp=fn+'.%d.tmp' % os.getpid()
+        with open(tmp, 'w') as fd :
+            fd.write(txt)
+        os.replace(tmp, fn)
+
+    def start_export(self, fn, interval=60):
+        '''
+        Export the metrics to fn every interval seconds
+        from a background thread (until stop_export).
+        '''
+        log = logging.getLogger(__name__)
+        self.stop_export()
+        stop=threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                try :
+                    self.export(fn)
+                except OSError as e :
+                    log.warning('Metrics export to %s failed: %s', fn, e)
+
+        t=threading.Thread(target=run, name='metrics-export', daemon=True)
+        t.start()
+        self._exporter=(stop, t)
+
+    def stop_export(self):
+        if self._exporter is not None :
+            stop, t = self._exporter
+            stop.set()
+            t.join()
+            self._exporter=None
+
+
+# Default registry used by all modules
+registry=Registry()
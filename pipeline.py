@@ -11,19 +11,84 @@ from astropy import wcs
 import astropy.units as u
 from pyvo import conesearch
 import sys
+import re
+from os import path
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from pylab import *
 import diskcache
+import atexit
+import preview
+import jobcache
+from footprint import FootprintIndex
+from lightcurve import LightCurveBuilder
+from calib import CalibrationLibrary
+from fieldsearch import FieldSearch
+from rqmirror import RequestMirror
+from watch import Watcher
+from stack import stack_frames
+from metrics import registry as metrics
 
 config = configparser.ConfigParser()
 config.read('telescope.ini')
 
 brt=BRT.Telescope(config['telescope.org']['user'],
                     config['telescope.org']['password'],
-                    config['cache']['jobs'])
+                    config['cache']['jobs'],
+                    cache_format=config['cache'].get('format', 'zip'))
 BRT.astrometryAPIkey=config['astrometry.net']['apikey']
 
 wcscache=diskcache.Cache(config['cache']['wcs'])
+# Failed solutions are retried after wcs_retry days, doubled at every failure
+wcsretry=config['cache'].getfloat('wcs_retry', 7)*86400
 seqcache=diskcache.Cache(config['cache']['seq'])
+BRT.namecache=BRT.NameCache(config['cache'].get('names',
+                    path.join(path.dirname(config['cache']['jobs']), 'names')))
+# Metrics are written at exit (and periodically if interval is set)
+if config.has_option('metrics', 'file'):
+    atexit.register(metrics.export, config['metrics']['file'])
+    if config.has_option('metrics', 'interval'):
+        metrics.start_export(config['metrics']['file'],
+                             config['metrics'].getfloat('interval'))
+
+footprints=FootprintIndex(config['cache'].get('footprints',
+                    path.join(path.dirname(config['cache']['jobs']), 'footprints.db')))
+
+def wcs_headers():
+    '''
+    Generator of (key, solved header) of all solved frames in wcscache.
+    '''
+    for key in wcscache:
+        e=wcscache.get(key)
+        if isinstance(e, fits.PrimaryHDU) :
+            yield key, e.header
+        elif isinstance(e, dict) and 'header' in e :
+            yield key, e['header']
+
+# The frames solved before the index existed (done once)
+footprints.backfill(wcs_headers())
+pyramid=preview.PreviewPyramid(config['cache'].get('previews',
+                    path.join(path.dirname(config['cache']['jobs']), 'previews')))
+# Recently used job archives kept open
+archives=jobcache.ArchivePool(lambda o: brt.get_obs(o, cube=False),
+                              config['cache'].getint('open_archives', 16))
+atexit.register(archives.close)
+# Master darks/flats applied to the loaded frames if [calib] apply is set
+calibration=None
+if config.has_section('calib') and config['calib'].getboolean('apply', False):
+    calibration=CalibrationLibrary(config['calib'].get('directory',
+                    path.join(path.dirname(config['cache']['jobs']), 'calib')))
+
+def read_layer(z, name):
+    '''
+    The hdu of the layer name of the job archive z. The data is read
+    into memory and the file is closed.
+    '''
+    with fits.open(BytesIO(z.read(name))) as f:
+        h=f[0]
+        h.data
+    return h
+
 
 def get_obs_hdul(brt, jid=None, obs=None):
     '''
@@ -35,8 +100,80 @@ def get_obs_hdul(brt, jid=None, obs=None):
         o=brt.get_job(jid)
     else :
         return None
-    z=brt.get_obs(o,cube=False)
-    return [fits.open(BytesIO(z.read(name)))[0] for name in z.namelist()]
+    with metrics.timer('stage_seconds', stage='load'):
+        with archives.archive(o['jid'], o) as z:
+            hdul=[read_layer(z, name) for name in z.namelist()]
+    return hdul
+
+
+def wcs_entry(h):
+    '''
+    The wcscache entry of the solved hdu: only its header. The scaling
+    keywords are dropped as they belong to the data of the solved copy.
+    '''
+    hdr=h.header.copy()
+    for k in ('BZERO', 'BSCALE', 'BLANK'):
+        hdr.remove(k, ignore_missing=True)
+    return {'header': hdr}
+
+
+def layer_filters(obs):
+    '''
+    Filters of the layers of the observation obs, in order.
+    '''
+    filt=obs['filter']
+    if filt == 'Colour':
+        filt='R,G,B'
+    elif filt == 'BVR':
+        filt='R,V,B'
+    elif filt== 'SHO':
+        filt = 'SII,Halpha,OIII'
+    return filt.split(',')
+
+
+def fix_layer(h, f):
+    '''
+    Set the filter f of the layer h and fix its header.
+    '''
+    h.header['FILTER']=f
+    if 'EPOCH' in h.header and h.header['EPOCH'].startswith('REAL'):
+        h.header['EPOCH']=2000.0
+        h.header['EQUINOX']=2000.0
+
+
+def solve_layer(jid, h):
+    '''
+    The solved hdu of the layer h of the job jid (from wcscache or
+    solved now), or None if it cannot be solved (yet).
+    '''
+    sjid='_'.join([str(jid), h.header['FILTER']])
+    if sjid not in pyramid :
+        pyramid.build(sjid, h.data)
+    e=wcscache.get(sjid)
+    if isinstance(e, fits.PrimaryHDU) :
+        # Entry of the old format (whole hdu): keep just the header
+        e=wcs_entry(e)
+        wcscache[sjid]=e
+    elif not isinstance(e, dict) :
+        # Not solved yet, or an old permanent failure: (re)try
+        e=None
+    if e is not None and 'header' in e :
+        metrics.hit('wcs')
+        return fits.PrimaryHDU(h.data, e['header'])
+    if e is not None and time.time() < e['retry'] :
+        metrics.hit('wcs')
+        return None
+    metrics.hit('wcs', False)
+    sol=BRT.solveField(h,name=str(jid),local=True)
+    if sol :
+        e=wcs_entry(sol[0])
+        wcscache[sjid]=e
+        footprints.add(sjid, e['header'])
+        return fits.PrimaryHDU(h.data, e['header'])
+    n=1 if e is None else e['failed']+1
+    wcscache[sjid]={'failed': n,
+                    'retry': time.time()+wcsretry*2**(n-1)}
+    return None
 
 
 def get_obs_shdul(brt, jid=None, obs=None):
@@ -47,39 +184,44 @@ def get_obs_shdul(brt, jid=None, obs=None):
     else :
         return None
     hdul=get_obs_hdul(brt, obs=o)
-    jid=o['jid']
-    filt=o['filter']
-    if filt == 'Colour':
-        filt='R,G,B'
-    elif filt == 'BVR':
-        filt='R,V,B'
-    elif filt== 'SHO':
-        filt = 'SII,Halpha,OIII'
-    for h,f in zip(hdul,filt.split(',')):
-        h.header['FILTER']=f
-        if 'EPOCH' in h.header and h.header['EPOCH'].startswith('REAL'):
-            h.header['EPOCH']=2000.0
-            h.header['EQUINOX']=2000.0
-    shdul=[]
-    for h in hdul:
-        sjid='_'.join([str(jid), h.header['FILTER']])
-        try :
-            h=wcscache[sjid]
-        except KeyError :
-            h=BRT.solveField(h,name=str(jid),local=True)
-            if h :
-                h=h[0]
-                wcscache[sjid]=h
-            else :
-                wcscache[sjid]=h
-        if h :
-            shdul.append(h)
-    return shdul
+    # The layers without a filter are dropped
+    hdul=hdul[:len(layer_filters(o))]
+    for h,f in zip(hdul,layer_filters(o)):
+        fix_layer(h, f)
+    if calibration is not None :
+        # Grouped by the fixed filter names
+        with metrics.timer('stage_seconds', stage='calibrate'):
+            calibration.calibrate_hdus(hdul)
+    shdul=[solve_layer(o['jid'], h) for h in hdul]
+    return [h for h in shdul if h is not None]
 #    shdul=[BRT.solveField(h,name=str(jid),local=True) for h in hdul]
 #    shdul=[h[0] for h in shdul if h]
 #    return shdul
 
 
+def ingest_job(obs, solvers=1):
+    '''
+    Stream the job into the cache, solving its layers while the rest
+    of the archive downloads (see Telescope.ingest_obs). Does nothing
+    if the job is in the cache already.
+    '''
+    flist=layer_filters(obs)
+    jobs=[]
+    with ThreadPoolExecutor(solvers) as ex :
+        def queue(n, name, h):
+            if n >= len(flist) :
+                # Layer without a filter (dropped as in get_obs_shdul)
+                return
+            fix_layer(h, flist[n])
+            if calibration is not None :
+                calibration.calibrate_hdus([h])
+            jobs.append(ex.submit(solve_layer, obs['jid'], h))
+        with metrics.timer('stage_seconds', stage='ingest'):
+            brt.ingest_obs(obs, queue)
+        for j in jobs:
+            j.result()
+
+
 def searchVS(h, cat='GCVS', caturl=None, maxSearchRadius=5):
     '''
     Search the area of the image in h (hdu, fits) for variable stars
@@ -95,12 +237,7 @@ def searchVS(h, cat='GCVS', caturl=None, maxSearchRadius=5):
     Returns a list of VS in the circle with the frame inscribed in it.
     '''
 
-    if cat=='GCVS' :
-        caturl='http://vizier.u-strasbg.fr/viz-bin/votable/-A?-source=B/vsx&amp;'
-    elif cat=='VSX' :
-        caturl='http://heasarc.gsfc.nasa.gov/cgi-bin/vo/cone/coneGet.pl?table=aavsovsx&amp;'
-    else :
-        caturl=caturl
+    caturl=catalogue_urls.get(cat, caturl)
 
     w=wcs.WCS(h.header, fix=False)
     cen=w.all_pix2world(array([[h.header['NAXIS1'], h.header['NAXIS2']]])/2,0)[0]
@@ -108,12 +245,80 @@ def searchVS(h, cat='GCVS', caturl=None, maxSearchRadius=5):
     rad=sqrt(sum((real(eigvals(w.wcs.cd))*array([h.header['NAXIS1'], h.header['NAXIS2']]))**2))/2
     # Clamp to reasonable size
     rad=min(rad, maxSearchRadius)
-    r=conesearch(caturl,pos=list(cen),radius=rad)
+    return cone_search(cat, caturl, cen[0], cen[1], rad)
+
+
+catalogue_urls={
+    'GCVS': 'http://vizier.u-strasbg.fr/viz-bin/votable/-A?-source=B/vsx&amp;',
+    'VSX': 'http://heasarc.gsfc.nasa.gov/cgi-bin/vo/cone/coneGet.pl?table=aavsovsx&amp;',
+}
+
+
+def cone_search(cat, caturl, ra, dec, rad):
+    with metrics.timer('conesearch_seconds', cat=cat):
+        r=conesearch(caturl,pos=[ra, dec],radius=rad)
+    metrics.inc('conesearch_total', cat=cat)
     return r
 
+
+blocked_names=['OGLE', 'MACHO', 'NSV', 'VSX', 'CSS', 'SWASP', 'CAG', 'ASAS', 'SDSS', 'HAT']
+
+vsre = re.compile('([V][0-9]+)|([R-Z])|([R-Z][R-Z])|([A-IK-Q][A-IK-Z])')
+
+# Faint limit of the variable stars (magnitude at maximum brightness)
+maglimit=config.getfloat('search', 'maglimit', fallback=None)
+
+
+def accept_vs(name, s):
+    '''
+    Catalogue filter: no survey designations, bright enough at maximum.
+    '''
+    if any(n in '%-25s' % name for n in blocked_names):
+        return False
+    if maglimit is not None :
+        try :
+            return float(s['max']) <= maglimit
+        except (KeyError, TypeError, ValueError) :
+            pass
+    return True
+
+
+def vs_designation(name):
+    '''
+    True for the GCVS style designations (R Cyg, V1234 Sgr ...).
+    '''
+    vsname = name.upper().split()
+    return len(vsname) == 2 and len(vsname[-1]) == 3 and bool(vsre.match(vsname[0]))
+
+
+# Catalogue searches coalesced by field for the whole run (per catalogue)
+fieldsearches={}
+
+def field_search(cat='GCVS'):
+    try :
+        return fieldsearches[cat]
+    except KeyError :
+        fs=fieldsearches[cat]=FieldSearch(
+                lambda ra, dec, rad: cone_search(cat, catalogue_urls[cat], ra, dec, rad),
+                accept=accept_vs, classify=vs_designation)
+        return fs
+
+def job_target(obs):
+    '''
+    Coordinates of the target of the observation obs (from get_job).
+    '''
+    if obs['type']=='RADEC':
+        return SkyCoord(obs['oid'], unit=(u.hourangle, u.deg))
+    else :
+        return BRT.resolve_name(obs['type']+obs['oid'])
+
+
 def analyse_job(obs, cat='GCVS', local=True):
-    blocked_names=['OGLE', 'MACHO', 'NSV', 'VSX', 'CSS', 'SWASP', 'CAG', 'ASAS', 'SDSS', 'HAT']
-#    blocked_names=[]
+    with metrics.timer('stage_seconds', stage='analyse'):
+        return _analyse_job(obs, cat, local)
+
+
+def _analyse_job(obs, cat='GCVS', local=True):
     try:
         jid=obs['jid']
     except TypeError :
@@ -128,76 +333,105 @@ def analyse_job(obs, cat='GCVS', local=True):
         if shdul :
             print('  Scope:', shdul[0].header['TELESCOP'].strip(), end='')
         print(' Filters: ', end='')
+        fs=field_search(cat)
+        # One catalogue search for all layers (and other jobs of the field)
+        with metrics.timer('stage_seconds', stage='search'):
+            fs.plan([h.header for h in shdul])
         for n,h in enumerate(shdul):
             print(h.header['FILTER'],end=',')
             sys.stdout.flush()
-            w=wcs.WCS(h.header)
-            if obs['type']=='RADEC':
-                obj=SkyCoord(obs['oid'], unit=(u.hourangle, u.deg))
-            else :
-                obj=SkyCoord.from_name(obs['type']+obs['oid'])
-            pix=array(obj.to_pixel(w))
-            r=searchVS(h)
-            vsl.append([h,[]])
-            #print("  Number of VS (unfiltered):", len(r))
-            for s in r:
-                vsname='%-25s' % s['Name'].decode('ASCII')
-                if not any( n in vsname for n in blocked_names):
-                    pix=array(s.pos.to_pixel(w))
-                    # reject out of frame stars
-                    if 0 < pix[0] < h.header['NAXIS1'] and 0 < pix[1] < h.header['NAXIS2'] :
-                        #print('    %-30s' % vsname, '%(Period)12.6f %(min)6.2f - %(max)6.2f ' % s)
-                        vsl[n][1].append([s['Name'].decode('ASCII'), s])
+            vsl.append([h, fs.search(h.header)])
         print()
     return vsl
 
 
 
-def plot_job(jid, cat='GCVS', local=True):
-    blocked_names=['OGLE', 'MACHO', 'NSV', 'VSX', 'CSS', 'SWASP', 'CAG', 'ASAS', 'SDSS', 'HAT']
+def show_frame(h, key=None, size=1000):
+    '''
+    Display the frame h using the smallest adequate level from the
+    preview pyramid (key is jid_filter). Without the key the full frame
+    is stretched. The axes stay in full-resolution pixels.
+    '''
+    nx, ny = h.header['NAXIS1'], h.header['NAXIS2']
+    if key is None :
+        img=preview.stretch(h.data)
+    else :
+        img, f = pyramid.get(key, size, h.data)
+    imshow(img, origin='lower', aspect='equal', extent=(0, nx, 0, ny))
+
+
+class CachedFrame :
+    '''
+    Solved frame known from the caches only: the solved header, no data
+    (the image is taken from the preview pyramid).
+    '''
+    data=None
+
+    def __init__(self, header):
+        self.header=header
+
+
+def cached_frames(obs):
+    '''
+    The solved frames of the observation obs without loading the job:
+    CachedFrame's for the layers with the solution in wcscache and the
+    preview in the pyramid. None if some layer has not been processed.
+    '''
+    res=[]
+    for f in layer_filters(obs):
+        key='%d_%s' % (obs['jid'], f)
+        e=wcscache.get(key)
+        if not isinstance(e, dict) or key not in pyramid :
+            return None
+        if 'header' in e :
+            res.append(CachedFrame(e['header']))
+        elif time.time() >= e['retry'] :
+            # Unsolved layer due for another attempt
+            return None
+    return res
+
+
+def plot_job(jid, cat='GCVS', local=True, size=1000):
     obs=brt.get_job(jid)
     if obs['type']!='SSBODY' :
         print(jid, obs['filter'], obs['exp'], obs['type'], obs['oid'])
 
-        shdul=get_obs_shdul(brt, jid=jid, obs=obs)
+        # Frames processed before are drawn from the caches
+        shdul=cached_frames(obs)
+        if shdul is None :
+            shdul=get_obs_shdul(brt, jid=jid, obs=obs)
+        obj=job_target(obs)
+        fs=field_search(cat)
+        fs.plan([h.header for h in shdul if h is not None])
         for h in shdul:
             if h is None :
                 print('Unable to solve the field!')
                 continue
             print('   Scope: ', h.header['TELESCOP'], 'Filter: ',h.header['FILTER'],end='')
             w=wcs.WCS(h.header)
-            imshow((h.data-h.data.min())**(1/3),aspect='equal')
+            show_frame(h, '_'.join([str(jid), h.header['FILTER']]), size)
             plot(h.header['NAXIS1']/2,h.header['NAXIS2']/2,'r+',ms=30)
-            if obs['type']=='RADEC':
-                obj=SkyCoord(obs['oid'], unit=(u.hourangle, u.deg))
-            else :
-                obj=SkyCoord.from_name(obs['type']+obs['oid'])
             pix=array(obj.to_pixel(w))
             plot(pix[0],pix[1],'r+',ms=20)
             plot(pix[0],pix[1],'ro',fillstyle='none', ms=12)
-            r=searchVS(h)
-            print("  Number of VS (unfiltered):", len(r))
-            for s in r:
-                vsname='%-25s' % s['Name'].decode('ASCII')
-                # filter out NSV and VSX hits (leave just GCVS marked stars)
-                if not any( n in vsname for n in blocked_names):
-                #if vsname.find('NSV')<0 and vsname.find('VSX')<0 :
-                    pix=array(s.pos.to_pixel(w))
-                    # reject out of frame stars
-                    if 0 < pix[0] < h.header['NAXIS1'] and 0 < pix[1] < h.header['NAXIS2'] :
-                        plot(pix[0],pix[1],'ro',fillstyle='none')
-                        annotate(vsname, pix, xytext=(5,-7), textcoords='offset points', color='y')
-                        print('%25s' % vsname, '%(Period)12.6f %(min)6.2f - %(max)6.2f ' % s)
+            # Filtered catalogue stars inside the frame
+            r=fs.search(h.header)
+            print("  Number of VS:", len(r))
+            for vsname, s in r:
+                pix=array(s.pos.to_pixel(w))
+                plot(pix[0],pix[1],'ro',fillstyle='none')
+                annotate(vsname, pix, xytext=(5,-7), textcoords='offset points', color='y')
+                print('%25s' % vsname, '%(Period)12.6f %(min)6.2f - %(max)6.2f ' % s)
             xlim(0,h.header['NAXIS1'])
             ylim(0,h.header['NAXIS2'])
             show()
         print()
 
 
-def plot_frame(h, vsl=None):
+def plot_frame(h, vsl=None, key=None, size=1000):
     print('  Scope: ', h.header['TELESCOP'], 'Filter: ',h.header['FILTER'])
     w=wcs.WCS(h.header)
-    imshow((h.data-h.data.min())**(1/3),aspect='equal')
+    show_frame(h, key, size)
     plot(h.header['NAXIS1']/2,h.header['NAXIS2']/2,'r+',ms=30)
     for vsname, s in vsl:
         pix=array(s.pos.to_pixel(w))
@@ -210,19 +444,181 @@ def plot_frame(h, vsl=None):
     show()
 
 
+def job_previews(obs, directory, size=800):
+    '''
+    Prepare the preview rendering tasks (see preview.render_previews)
+    for all solved frames of the job obs. The PNG files are named
+    jid_filter.png and placed in the directory. The frames are binned
+    to the preview size here, so the tasks stay small.
+    '''
+    try:
+        jid=obs['jid']
+    except TypeError :
+        jid=obs
+        obs=brt.get_job(jid)
+    if obs['type']=='SSBODY' :
+        return []
+    obj=job_target(obs)
+    tasks=[]
+    for h, vsl in analyse_job(obs):
+        target, labels = preview.frame_annotations(h, obj, vsl)
+        data=preview.downsample(h.data, preview.preview_factor(h.data.shape, size))
+        tasks.append(dict(fn=path.join(directory, '%d_%s.png' % (jid, h.header['FILTER'])),
+                          data=data, shape=h.data.shape, target=target, labels=labels,
+                          title='%d %s %s' % (jid, h.header['TELESCOP'].strip(), h.header['FILTER']),
+                          size=size))
+    return tasks
+
+
 from aavsovsx import get_VS_sequence
 
 
+def get_sequence(name, fov=60):
+    '''
+    AAVSO comparison sequence for the star (cached in seqcache).
+    '''
+    try:
+        sq, sq_stars = seqcache[name]
+        metrics.hit('seq')
+    except KeyError:
+        metrics.hit('seq', False)
+        sq, sq_stars = get_VS_sequence(name, fov)
+        seqcache[name]=(sq, sq_stars)
+    return sq, sq_stars
+
+
+def locate_frame(key):
+    '''
+    The cached job archive and the solved header of the frame key
+    (jid_filter), or None if the frame is not solved or its job is
+    not in the cache. Nothing is requested from the server.
+    '''
+    e=wcscache.get(key)
+    if isinstance(e, fits.PrimaryHDU) :
+        header=e.header
+    elif isinstance(e, dict) and 'header' in e :
+        header=e['header']
+    else :
+        return None
+    fp=brt.cached_obs(int(key.split('_', 1)[0]))
+    return None if fp is None else (fp, header)
+
+
+def solved_frames(keys):
+    '''
+    Generator of the solved hdu's of the frames keys (jid_filter) read
+    from the caches, one job archive at a time (see locate_frame).
+    The frames which are not solved or not cached are skipped.
+    '''
+    from archive import read_matching
+
+    jobs={}
+    for k in keys:
+        loc=locate_frame(k)
+        if loc is None :
+            print(k, 'not solved or not cached')
+            continue
+        jobs.setdefault(loc[0], []).append(loc[1])
+    for fp, headers in jobs.items():
+        hdus=[fits.PrimaryHDU(d, h) for d, h in zip(read_matching(fp, headers), headers)
+                if d is not None]
+        if calibration is not None :
+            calibration.calibrate_hdus(hdus)
+        for h in hdus:
+            yield h
+
+
+lightcurves=LightCurveBuilder(config['cache'].get('lightcurves',
+                    path.join(path.dirname(config['cache']['jobs']), 'lightcurves')),
+                    footprints, locate_frame, get_sequence,
+                    calib=None if calibration is None else calibration.directory)
+
+
 BRT.DEBUG=1
 #jid=293657
 #vlst=analyse_job(jid)
 #plot_job(jid)
 
-import re
+filters=set(('BVR','B','V','R','Blue', 'Green', 'Red', 'Colour'))
+# Solve the layers of new jobs while they download ([cache] stream)
+streaming=config['cache'].getboolean('stream', False)
+solvers=config['cache'].getint('solvers', 1)
 
-vsre = re.compile('([V][0-9]+)|([R-Z])|([R-Z][R-Z])|([A-IK-Q][A-IK-Z])')
 
-if len(sys.argv)>2 and sys.argv[1].startswith('-j'):
+def process_job(rec):
+    '''
+    Download, solve and analyse the job (search record or get_job data)
+    and print the variable stars found. Returns the set of the stars
+    with comparison sequences (light curve candidates).
+    '''
+    if all(k in rec for k in BRT.job_keys):
+        obs=rec
+    else :
+        obs=brt.get_job(rec['jid'])
+    print( obs['completion'], end=' ' )
+    if obs['filter'] not in filters:
+        return set()
+    if streaming :
+        ingest_job(obs, solvers)
+    vlst=analyse_job(obs)
+    fov=60
+    if obs['tele'] == 'coast' :
+        fov=20
+    elif obs['tele'] == 'pirate' :
+        fov=43
+    lcstars=set()
+    empty=True
+    for f, vsl in vlst:
+        for vs in vsl:
+            # Classified once per field by the field search
+            if vs[0] not in field_search().designated :
+                continue
+            empty = False
+            print('    %20s' % vs[0], '%(Period)12.6f %(min)6.2f - %(max)6.2f ' % vs[1], end='')
+            sq, sq_stars = get_sequence(vs[0], fov)
+            if sq :
+                print('    Seq: %s (%d stars)' % (sq, len(sq_stars)))
+                lcstars.add(vs[0])
+            else :
+                print('    No sequence found')
+        #plot_frame(f,vsl)
+        if not empty : print()
+    return lcstars
+
+
+def watch_job(rec):
+    for name in sorted(process_job(rec)):
+        print('    Light curve %s: %d new frames' % (name, len(lightcurves.update(name))))
+
+
+if len(sys.argv)>2 and sys.argv[1].startswith('-p'):
+    # Render previews: -p directory [jid ...] (last day if no jids given)
+    jids=[int(i) for i in sys.argv[3:]] or brt.get_obs_list(dt=1)
+    tasks=[]
+    for jid in jids:
+        tasks+=job_previews(jid, sys.argv[2])
+    for fn in preview.render_previews(tasks):
+        print(fn)
+elif len(sys.argv)>2 and sys.argv[1].startswith('-l'):
+    # Update light curves: -l "star name" ...
+    for name in sys.argv[2:]:
+        print(name, len(lightcurves.update(name)), 'new frames')
+elif len(sys.argv)>3 and sys.argv[1].startswith('-s'):
+    # Stack solved frames: -s output.fits jid_filter ...
+    memory=config.getfloat('stack', 'memory', fallback=1024)*2**20
+    hdu=stack_frames(solved_frames(sys.argv[3:]),
+                     method=config.get('stack', 'method', fallback='median'),
+                     memory=memory)
+    hdu.writeto(sys.argv[2], overwrite=True)
+    print(sys.argv[2], hdu.header['NCOMBINE'], 'frames')
+elif len(sys.argv)>1 and sys.argv[1].startswith('-w'):
+    # Watch the requests and process the jobs as they complete
+    mirror=RequestMirror(config['cache'].get('requests',
+                    path.join(path.dirname(config['cache']['jobs']), 'requests.db')))
+    Watcher(brt, mirror, watch_job,
+            min_interval=config.getfloat('watch', 'min_interval', fallback=120),
+            max_interval=config.getfloat('watch', 'max_interval', fallback=1800)).run()
+elif len(sys.argv)>2 and sys.argv[1].startswith('-j'):
     for i in sys.argv[2:]:
         jid = int(i)
         vlst=analyse_job(jid)
@@ -235,39 +631,13 @@ else :
     if len(sys.argv)==2 :
         dt=int(sys.argv[1])
         t=time.time()-time.timezone-dt*86400
-    for jid in brt.get_obs_list(t=t, dt=1):
-        obs=brt.get_job(jid)
-        print( obs['completion'], end=' ' )
-        if obs['filter'] not in set(('BVR','B','V','R','Blue', 'Green', 'Red', 'Colour')):
-            continue
-        vlst=analyse_job(obs)
-        fov=60
-        if obs['tele'] == 'coast' :
-            fov=20
-        elif obs['tele'] == 'pirate' :
-            fov=43
-        empty=True
-        for f, vsl in vlst:
-            for vs in vsl:
-                vsname = vs[0].upper().split()
-                if len(vsname[-1]) != 3 or len(vsname) != 2:
-                    continue
-                if not vsre.match(vsname[0]) :
-                    continue
-                empty = False
-                print('    %20s' % vs[0], '%(Period)12.6f %(min)6.2f - %(max)6.2f ' % vs[1], end='')
-                try:
-                    sq, sq_stars = seqcache[vs[0]]
-                except KeyError:
-                    sq, sq_stars = get_VS_sequence(vs[0], fov)
-                    seqcache[vs[0]]=(sq, sq_stars)
-                if sq :
-                    print('    Seq: %s (%d stars)' % (sq, len(sq_stars)))
-                else :
-                    print('    No sequence found')
-            #plot_frame(f,vsl)
-            if not empty : print()
-
-
-
-
+    # Jobs are selected on the search results, before fetching any of them
+    jobs=brt.search_jobs(t=t, dt=1,
+                         where=lambda r: 'filter' not in r or r['filter'] in filters)
+    lcstars=set()
+    for n, rec in enumerate(jobs):
+        metrics.set('pipeline_queue_depth', len(jobs)-n)
+        lcstars|=process_job(rec)
+    metrics.set('pipeline_queue_depth', 0)
+    for name in sorted(lcstars):
+        print('    Light curve %s: %d new frames' % (name, len(lightcurves.update(name))))
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+# coding: utf-8
+
+'''
+Headless rendering of annotated frame previews.
+
+The drawing is done with the Agg canvas directly (no pylab state), so
+the functions can run in worker processes and never open a window.
+'''
+
+from __future__ import print_function, division, absolute_import
+
+import os
+from os import path
+import logging
+from multiprocessing import Pool
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from metrics import registry as metrics
+
+
+def downsample(data, factor):
+    '''
+    Bin the 2D array by an integer factor (mean of factor x factor blocks).
+    Rows/columns which do not fill a whole block are dropped.
+    Returns a float32 array.
+    '''
+    data=np.asarray(data)
+    if factor <= 1 :
+        return data.astype(np.float32)
+    ny, nx = data.shape[0]//factor, data.shape[1]//factor
+    d=data[:ny*factor, :nx*factor].astype(np.float32)
+    return d.reshape(ny, factor, nx, factor).mean(axis=(1,3))
+
+
+def stretch(data):
+    '''
+    Cube-root stretch (as used by plot_job) scaled to 0-255 uint8.
+    '''
+    d=np.array(data, dtype=np.float32)
+    d-=d.min()
+    np.cbrt(d, out=d)
+    m=d.max()
+    if m > 0 :
+        d*=255/m
+    return d.astype(np.uint8)
+
+
+def preview_factor(shape, size):
+    '''
+    Binning factor needed to fit the frame of given shape into size pixels.
+    '''
+    return max(1, max(shape)//size)
+
+
+def frame_annotations(h, obj=None, vsl=()):
+    '''
+    Compute the pixel positions of the annotations for the frame h (solved hdu).
+    obj is the target (SkyCoord) and vsl the list of [name, star] pairs
+    as produced by analyse_job. Stars outside the frame are dropped.
+    Returns (target, labels) where target is (x, y) or None and labels
+    is a list of (name, x, y).
+    '''
+    from astropy import wcs
+
+    w=wcs.WCS(h.header)
+    nx, ny = h.header['NAXIS1'], h.header['NAXIS2']
+    target=None
+    if obj is not None :
+        target=tuple(float(p) for p in obj.to_pixel(w))
+    labels=[]
+    for vsname, s in vsl:
+        x, y = (float(p) for p in s.pos.to_pixel(w))
+        # reject out of frame stars
+        if 0 < x < nx and 0 < y < ny :
+            labels.append((vsname, x, y))
+    return target, labels
+
+
+def render_preview(fn, data, target=None, labels=(), title=None, size=800, dpi=100,
+                   shape=None):
+    '''
+    Render the annotated preview of the frame data into the PNG file fn.
+    The data is binned to fit in size pixels before stretching.
+    target and labels are in the full-resolution pixel coordinates
+    (see frame_annotations); if the data is binned already, shape is
+    the shape of the full-resolution frame. Returns fn.
+    '''
+    ny, nx = np.shape(data) if shape is None else shape
+    img=stretch(downsample(data, preview_factor(np.shape(data), size)))
+
+    fig=Figure(figsize=(img.shape[1]/dpi, img.shape[0]/dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax=fig.add_axes([0,0,1,1])
+    ax.set_axis_off()
+    ax.imshow(img, origin='lower', aspect='equal', extent=(0, nx, 0, ny))
+    ax.plot(nx/2, ny/2, 'r+', ms=30)
+    if target is not None :
+        ax.plot(target[0], target[1], 'r+', ms=20)
+        ax.plot(target[0], target[1], 'ro', fillstyle='none', ms=12)
+    for vsname, x, y in labels:
+        ax.plot(x, y, 'ro', fillstyle='none')
+        ax.annotate(vsname, (x, y), xytext=(5,-7), textcoords='offset points', color='y')
+    if title :
+        ax.text(0.01, 0.99, title, transform=ax.transAxes, color='w',
+                va='top', ha='left')
+    ax.set_xlim(0, nx)
+    ax.set_ylim(0, ny)
+    fig.savefig(fn, dpi=dpi)
+    return fn
+
+
+def _render_task(task):
+    log = logging.getLogger(__name__)
+    try :
+        return render_preview(**task)
+    except Exception as e :
+        log.warning('Preview %s failed: %s', task.get('fn'), e)
+        return None
+
+
+def render_previews(tasks, processes=None, chunksize=1):
+    '''
+    Render many previews in a process pool. tasks is an iterable of
+    dictionaries with the keyword arguments of render_preview
+    (fn, data, target, labels, title, size, shape).
+    Returns the list of written files (failed renders are skipped).
+    '''
+    tasks=list(tasks)
+    if not tasks :
+        return []
+    for t in tasks :
+        d=path.dirname(t['fn'])
+        if d :
+            os.makedirs(d, exist_ok=True)
+    with Pool(processes) as pool :
+        return [fn for fn in pool.imap_unordered(_render_task, tasks, chunksize)
+                if fn is not None]
+
+
+class PreviewPyramid :
+    '''
+    Cache of pre-stretched, binned versions of the frames.
+    Each frame (key, e.g. jid_filter) is stored as a compressed npz file
+    holding uint8 images binned by each of the levels factors.
+    The files are laid out like the job cache (k/e/key.npz).
+    Each level must be a multiple of the previous one.
+    '''
+
+    def __init__(self, directory='.cache/previews', levels=(2,4,8)):
+        self.directory=directory
+        self.levels=tuple(sorted(levels))
+        for a, b in zip(self.levels[:-1], self.levels[1:]):
+            if b % a :
+                raise ValueError('Preview level %d is not a multiple of %d' % (b, a))
+
+    def _path(self, key):
+        key=str(key)
+        return path.join(self.directory, key[0], key[1], key+'.npz')
+
+    def __contains__(self, key):
+        return path.isfile(self._path(key))
+
+    def build(self, key, data):
+        '''
+        Generate and store all levels for the frame data under the key.
+        Each level is binned from the previous one, so the full
+        resolution array is traversed only once.
+        '''
+        log = logging.getLogger(__name__)
+        fp=self._path(key)
+        os.makedirs(path.dirname(fp), exist_ok=True)
+        lv={'shape': np.array(np.shape(data))}
+        d=np.asarray(data)
+        f=1
+        for l in self.levels:
+            d=downsample(d, l//f)
+            f=l
+            lv['L%d' % l]=stretch(d)
+        tmp=fp+'.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as fd :
+            np.savez_compressed(fd, **lv)
+        os.replace(tmp, fp)
+        log.debug('Preview pyramid for %s stored in %s', key, fp)
+
+    def get(self, key, size, data=None):
+        '''
+        Get the smallest stored level which is at least size pixels
+        along its longer side. If no level is large enough the full
+        resolution frame is returned (stretched from the data), or the
+        finest level when the data is not given. When the key is not
+        cached and the frame data is given the pyramid is built first.
+        Returns (image, factor), or None if the key is not cached.
+        '''
+        metrics.hit('previews', key in self)
+        if key not in self :
+            if data is None :
+                return None
+            self.build(key, data)
+        with np.load(self._path(key)) as z :
+            shape=z['shape']
+            for l in reversed(self.levels):
+                if max(shape)//l >= size :
+                    return z['L%d' % l], l
+            if data is not None :
+                return stretch(data), 1
+            l=self.levels[0]
+            return z['L%d' % l], l
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+# coding: utf-8
+
+'''
+Local mirror of the request-manager state.
+
+The requests are kept in a small sqlite database keyed by the request
+ID. The sync is incremental: only the requests newer than the newest
+known one and the ones still in a non-terminal state are fetched again
+(when the server lists the newest first). Active requests which
+disappear from the server are marked GONE.
+'''
+
+from __future__ import print_function, division, absolute_import
+
+import os
+from os import path
+import json
+import time
+import sqlite3
+import logging
+
+# Statuses below this one (see Telescope.REQUESTSTATUS_TEXTS) are not final
+TERMINAL=8
+
+# Status of the requests which disappeared from the folder on the server
+GONE=99
+
+
+def request_id(r):
+    '''
+    ID of the request dictionary returned by the request-manager API.
+    '''
+    for k in ('rid', 'id', 'requestid'):
+        if k in r :
+            return int(r[k])
+    raise KeyError('No request id in %s' % r)
+
+
+class RequestMirror :
+    '''
+    Mirror of the user requests in the folder, stored in the dbfile.
+    '''
+
+    def __init__(self, dbfile='.cache/requests.db', folder=1):
+        d=path.dirname(dbfile)
+        if d :
+            os.makedirs(d, exist_ok=True)
+        self.db=sqlite3.connect(dbfile)
+        self.folder=folder
+        self.db.execute('''create table if not exists requests (
+                            rid integer primary key,
+                            folder integer,
+                            status integer,
+                            objectname text,
+                            data text,
+                            updated real)''')
+        self.db.execute('create index if not exists requests_status on requests(status)')
+        self.db.commit()
+
+    def store(self, reqs):
+        now=time.time()
+        with self.db :
+            self.db.executemany('''insert or replace into requests
+                                (rid, folder, status, objectname, data, updated)
+                                values (?,?,?,?,?,?)''',
+                [(request_id(r), self.folder, int(r['status']), r.get('objectname'),
+                    json.dumps(r), now) for r in reqs])
+
+    def _scalar(self, q):
+        return self.db.execute(q, (self.folder,)).fetchone()[0]
+
+    def sync(self, brt, pagesize=100, overlap=5):
+        '''
+        Update the mirror from the server using the brt session.
+        Pages of requests sorted by ID are fetched; newest first, only
+        until every request newer than the newest known one and every
+        request which was not final at the last sync has been seen.
+        Consecutive pages overlap by a few rows, so the requests deleted
+        meanwhile do not shift other ones out of sight; if a page does
+        not continue the previous one the sync is incomplete.
+        After a complete sync the non-final requests which were not seen
+        are marked GONE (deleted or moved to another folder).
+        Returns the number of fetched requests.
+        '''
+        log = logging.getLogger(__name__)
+        maxid=self._scalar('select max(rid) from requests where folder=?')
+        minpend=self._scalar('select min(rid) from requests where folder=? and status<%d' % TERMINAL)
+        stop=min(i for i in (maxid, minpend) if i is not None) if maxid is not None else None
+
+        seen=set()
+        fetched=0
+        start=0
+        descending=None
+        complete=True
+        while True :
+            offset=max(0, start-overlap)
+            total, page = brt.get_user_requests_page('rid', self.folder, pagesize, offset)
+            ids=[request_id(r) for r in page]
+            if start and (not ids or ids[0] not in seen) :
+                log.warning('Requests moved during the sync at row %d', start)
+                complete=False
+                break
+            fetched+=len(page)
+            self.store(page)
+            seen.update(ids)
+            if descending is None :
+                descending = len(ids) < 2 or ids[0] > ids[-1]
+            if offset+len(page) >= total :
+                break
+            if descending and stop is not None and ids and min(ids) < stop :
+                break
+            if offset+len(page) <= start :
+                complete=False
+                break
+            start=offset+len(page)
+        if complete :
+            self.mark_gone(seen)
+        log.info('Request mirror sync: %d requests fetched (%d total)', fetched, total)
+        return fetched
+
+    def mark_gone(self, seen):
+        '''
+        Mark the non-final requests missing in the set seen of request
+        IDs as GONE. Returns their number.
+        '''
+        log = logging.getLogger(__name__)
+        gone=[(rid, data) for rid, data in self.db.execute(
+                    'select rid, data from requests where folder=? and status<?',
+                    (self.folder, TERMINAL)) if rid not in seen]
+        now=time.time()
+        rows=[]
+        for rid, data in gone:
+            r=json.loads(data)
+            r['status']=GONE
+            rows.append((GONE, json.dumps(r), now, rid))
+        if rows :
+            with self.db :
+                self.db.executemany('update requests set status=?, data=?, updated=? where rid=?', rows)
+            log.info('%d requests gone from the folder', len(rows))
+        return len(rows)
+
+    def poll(self, brt, pagesize=100):
+        '''
+        Sync the mirror and report what changed: returns the list of
+        (request, old status) for the requests which are new (old
+        status None) or changed their status since the last sync.
+        '''
+        before={rid: st for rid, st in self.db.execute(
+                    'select rid, status from requests where folder=?', (self.folder,))}
+        self.sync(brt, pagesize)
+        res=[]
+        for rid, st, data in self.db.execute(
+                    'select rid, status, data from requests where folder=?', (self.folder,)):
+            if before.get(rid) != st :
+                res.append((json.loads(data), before.get(rid)))
+        return res
+
+    def get(self, rid):
+        '''
+        The request dictionary for the request ID (None if unknown).
+        '''
+        r=self.db.execute('select data from requests where rid=?', (rid,)).fetchone()
+        return None if r is None else json.loads(r[0])
+
+    def active(self):
+        '''
+        List of requests in non-terminal states.
+        '''
+        return [json.loads(r[0]) for r in self.db.execute(
+                    'select data from requests where folder=? and status<? order by rid',
+                    (self.folder, TERMINAL))]
+
+    def active_names(self):
+        '''
+        Set of object names of the requests in non-terminal states.
+        '''
+        return {r[0] for r in self.db.execute(
+                    'select objectname from requests where folder=? and status<?',
+                    (self.folder, TERMINAL))}
+
+    def missing(self, names):
+        '''
+        Names from the list which have no active request.
+        '''
+        act=self.active_names()
+        return [n for n in names if n not in act]
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+# coding: utf-8
+
+'''
+Out-of-core stacking of solved frames on a common WCS.
+
+The frames are first spilled to float32 .npy files in a scratch
+directory (sky level removed) and then opened memory-mapped. The output
+image is split into strips of rows small enough that all frames
+reprojected onto a strip fit into the per-worker share of the memory
+budget. Each strip is reprojected (bilinear interpolation) and combined
+(median or sigma-clipped mean) by a worker process and written into the
+output, which is itself a memory-mapped file for large images.
+'''
+
+from __future__ import print_function, division, absolute_import
+
+import os
+from os import path
+import shutil
+import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+from astropy import wcs
+
+
+def bilinear(data, x, y):
+    '''
+    Bilinear interpolation of the image data at the 0-based pixel
+    coordinates x, y (arrays). Points outside the image are NaN.
+    '''
+    ny, nx = data.shape
+    x0=np.floor(x).astype(int)
+    y0=np.floor(y).astype(int)
+    ok=(x0 >= 0) & (y0 >= 0) & (x0 < nx-1) & (y0 < ny-1)
+    x0=np.where(ok, x0, 0)
+    y0=np.where(ok, y0, 0)
+    fx=x-x0
+    fy=y-y0
+    v=(data[y0, x0]*(1-fx)*(1-fy) + data[y0, x0+1]*fx*(1-fy) +
+       data[y0+1, x0]*(1-fx)*fy + data[y0+1, x0+1]*fx*fy)
+    return np.where(ok, v, np.nan).astype(np.float32)
+
+
+def common_wcs(headers, scale=None):
+    '''
+    TAN WCS (and its shape ny, nx) covering all frames with the given
+    headers, centred on their mean position. The pixel scale (deg)
+    defaults to the finest scale of the frames.
+    '''
+    from astropy.wcs.utils import proj_plane_pixel_scales
+    from footprint import _tangent
+
+    corners=[]
+    scales=[]
+    for h in headers:
+        w=wcs.WCS(h)
+        nx, ny = h['NAXIS1'], h['NAXIS2']
+        corners.append(w.all_pix2world([[0.5, 0.5], [nx+0.5, 0.5],
+                                        [nx+0.5, ny+0.5], [0.5, ny+0.5]], 1))
+        scales.append(np.min(proj_plane_pixel_scales(w)))
+    corners=np.concatenate(corners)
+    scale=scale or min(scales)
+    xyz=np.array([np.cos(np.radians(corners[:,1]))*np.cos(np.radians(corners[:,0])),
+                  np.cos(np.radians(corners[:,1]))*np.sin(np.radians(corners[:,0])),
+                  np.sin(np.radians(corners[:,1]))]).mean(axis=1)
+    ra0=np.degrees(np.arctan2(xyz[1], xyz[0])) % 360
+    dec0=np.degrees(np.arctan2(xyz[2], np.hypot(xyz[0], xyz[1])))
+    x, y, c = _tangent(corners[:,0], corners[:,1], ra0, dec0)
+    # Tangent plane offsets (rad) to pixels, symmetric about the centre
+    hx=np.degrees(np.abs(x).max())/scale
+    hy=np.degrees(np.abs(y).max())/scale
+    nx, ny = int(np.ceil(2*hx)), int(np.ceil(2*hy))
+    out=wcs.WCS(naxis=2)
+    out.wcs.ctype=['RA---TAN', 'DEC--TAN']
+    out.wcs.crval=[ra0, dec0]
+    out.wcs.crpix=[(nx+1)/2, (ny+1)/2]
+    out.wcs.cdelt=[-scale, scale]
+    return out, (ny, nx)
+
+
+def sigma_clip_mean(cube, sigma=3.0, iters=3):
+    '''
+    Mean along the first axis of the cube rejecting values further than
+    sigma standard deviations from the median. NaNs are ignored.
+    Works on a copy of the cube and one more temporary of its size.
+    '''
+    cube=np.array(cube)
+    d=np.empty_like(cube)
+    for i in range(iters):
+        m=np.nanmedian(cube, axis=0)
+        s=np.nanstd(cube, axis=0)
+        np.subtract(cube, m, out=d)
+        np.abs(d, out=d)
+        bad=d > sigma*s
+        if not bad.any() :
+            break
+        cube[bad]=np.nan
+    return np.nanmean(cube, axis=0)
+
+
+def stack_strip(task):
+    '''
+    Reproject all frames onto the rows y0:y1 of the output and combine
+    them. Runs in the worker processes of stack_frames.
+    '''
+    import warnings
+
+    files, headers, outhdr, y0, y1, method, sigma = task
+    out=wcs.WCS(outhdr)
+    nx=outhdr['NAXIS1']
+    x, y = np.meshgrid(np.arange(nx), np.arange(y0, y1))
+    ra, dec = out.all_pix2world(x.ravel(), y.ravel(), 0)
+    cube=np.full((len(files), y1-y0, nx), np.nan, dtype=np.float32)
+    for n, (fn, h) in enumerate(zip(files, headers)):
+        data=np.load(fn, mmap_mode='r')
+        fx, fy = wcs.WCS(h).all_world2pix(ra, dec, 0)
+        cube[n]=bilinear(data, fx, fy).reshape(y1-y0, nx)
+    with warnings.catch_warnings():
+        # All-NaN columns outside every frame
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if method == 'median' :
+            res=np.nanmedian(cube, axis=0)
+        else :
+            res=sigma_clip_mean(cube, sigma)
+    return y0, res.astype(np.float32)
+
+
+def stack_frames(frames, method='median', sigma=3.0, memory=2**30, workers=None,
+                 scale=None, output=None, scratch=None):
+    '''
+    Stack the solved frames (iterable of hdu's with celestial WCS) on
+    a common WCS. Each frame is spilled to the scratch directory as it
+    is produced, so only one of them is in memory at a time.
+
+    method  - 'median' or 'mean' (sigma-clipped at sigma)
+    memory  - memory budget (bytes) for the reprojected strips of all workers
+    workers - number of worker processes (default: all cores)
+    scale   - output pixel scale (deg), default: the finest of the frames
+    output  - .npy file for the output data (memory-mapped) or None
+    scratch - directory for the temporary frame files
+
+    Returns the PrimaryHDU of the stack.
+    '''
+    log = logging.getLogger(__name__)
+    workers=workers or os.cpu_count() or 1
+    tmp=tempfile.mkdtemp(prefix='stack-', dir=scratch)
+    try :
+        files=[]
+        levels=[]
+        headers=[]
+        for n, f in enumerate(frames):
+            h=fits.Header(f.header, copy=True)
+            # Drop the data-dependent keywords, keep the WCS
+            for k in ('BZERO', 'BSCALE'):
+                h.remove(k, ignore_missing=True)
+            d=np.asarray(f.data, dtype=np.float32)
+            lev=float(np.nanmedian(d))
+            fn=path.join(tmp, '%d.npy' % n)
+            np.save(fn, d-lev)
+            # Let the frame go before the next one is produced
+            del d, f
+            files.append(fn)
+            levels.append(lev)
+            headers.append(h)
+        if not files :
+            raise ValueError('No frames to stack')
+        outwcs, (ny, nx) = common_wcs(headers, scale)
+        outhdr=outwcs.to_header()
+        outhdr['NAXIS']=2
+        outhdr['NAXIS1']=nx
+        outhdr['NAXIS2']=ny
+        # Copies of the strip of the reprojected frames held by each worker:
+        # the cube and a temporary of the median, or for the clipped mean
+        # the cube, its copy and a temporary (see sigma_clip_mean)
+        copies=2 if method == 'median' else 3
+        rows=max(1, int(memory/workers/(copies*4*len(files)*nx)))
+        log.info('Stacking %d frames into %dx%d in strips of %d rows', len(files), nx, ny, rows)
+        if output is None :
+            res=np.empty((ny, nx), dtype=np.float32)
+        else :
+            res=np.lib.format.open_memmap(output, mode='w+', dtype=np.float32, shape=(ny, nx))
+        tasks=[(files, headers, outhdr, y0, min(ny, y0+rows), method, sigma)
+                    for y0 in range(0, ny, rows)]
+        with ProcessPoolExecutor(workers) as ex :
+            for y0, strip in ex.map(stack_strip, tasks):
+                res[y0:y0+len(strip)]=strip
+        res+=np.mean(levels)
+    finally :
+        shutil.rmtree(tmp, ignore_errors=True)
+    hdu=fits.PrimaryHDU(res, header=outhdr)
+    hdu.header['NCOMBINE']=(len(files), 'Number of stacked frames')
+    hdu.header['COMBINE']=(method, 'Combination method')
+    for k in ('TELESCOP', 'INSTRUME', 'FILTER', 'OBJECT'):
+        if k in headers[0] :
+            hdu.header[k]=headers[0][k]
+    dates=[h['DATE-OBS'] for h in headers if 'DATE-OBS' in h]
+    if dates :
+        hdu.header['DATE-OBS']=min(dates)
+    hdu.header['EXPTIME']=sum(h.get('EXPTIME', 0) for h in headers)
+    return hdu
@@ -2,9 +2,14 @@
 # coding: utf-8
 
 import BRT
+import visibility
+from rqmirror import RequestMirror
+from metrics import registry as metrics
+from astropy.coordinates import SkyCoord
 from collections import namedtuple
 import configparser
 import os
+import atexit
 import logging
 from os.path import expanduser
 
@@ -15,6 +20,9 @@ parser.add_argument('-s', '--submit', help='Execute the submission', action='sto
 parser.add_argument('-q', '--quiet', help='Jast do the job. Stay quiet', action='store_true')
 parser.add_argument('-v', '--verbose', help='Print more status info', action='store_true')
 parser.add_argument('-d', '--debug', help='Print debugging info', action='store_true')
+parser.add_argument('-n', '--sessions', help='Number of parallel submission sessions', type=int, default=4)
+parser.add_argument('-N', '--nights', help='Defer targets not observable in so many nights (0: submit all)',
+                    type=int, default=3)
 args = parser.parse_args()
 
 if args.verbose :
@@ -29,10 +37,18 @@ VStar=namedtuple('VStar', 'name comm expos')
 config = configparser.ConfigParser()
 config.read(expanduser('~/.config/telescope.ini'))
 
+# Metrics of the run, kept apart from the pipeline ones
+if config.has_option('metrics', 'batch_file'):
+    atexit.register(metrics.export, expanduser(config['metrics']['batch_file']))
+
 log.info('Log in to telescope.org ...')
 
-brt=BRT.Telescope(config['telescope.org']['user'], config['telescope.org']['password'])
+brt=BRT.Telescope(config['telescope.org']['user'], config['telescope.org']['password'],
+                  cookies=expanduser(config['telescope.org'].get('cookies',
+                                            '~/.cache/brt/session.cookies')))
 BRT.astrometryAPIkey=config['astrometry.net']['apikey']
+BRT.namecache=BRT.NameCache(expanduser(config['telescope.org'].get('names',
+                                            '~/.cache/brt/names')))
 
 def qprint(*ar, **kwar):
     if not args.quiet:
@@ -61,9 +77,10 @@ obslst=[
 
 log.info('Getting observing queue ...')
 
-reqlst=brt.get_user_requests(sort='completion')
-q=[r for r in reqlst if int(r['status'])<8]
-qn=[r['objectname'] for r in q]
+mirror=RequestMirror(expanduser(config['telescope.org'].get('requests',
+                                            '~/.cache/brt/requests.db')))
+mirror.sync(brt)
+qn=mirror.active_names()
 missing = [vs for vs in obslst if vs.name not in qn]
 
 if missing :
@@ -71,11 +88,30 @@ if missing :
         qprint('Submitting missing jobs:')
     else:
         qprint('Dry run. Add -s to the command line to do actual submissions.')
-        
+
+    coords=BRT.namecache.resolve_many([vs.name for vs in missing])
+    known=[vs for vs in missing if coords[vs.name] is not None]
+    # One observability pass over all targets
+    visible={vs.name: True for vs in known}
+    if args.nights and known :
+        ok=visibility.observable(SkyCoord([coords[vs.name] for vs in known]), nights=args.nights)
+        visible={vs.name: v for vs, v in zip(known, ok)}
+    res={}
+    if args.submit :
+        res={n: (r, i) for n, r, i in brt.submit_many(
+                [dict(name=vs.name, expos=vs.expos, comm=vs.comm, obj=coords[vs.name])
+                    for vs in known if visible[vs.name]],
+                sessions=args.sessions)}
     for vs in missing:
         qprint(f'{vs.name.split()[0]:>8} {vs.name.split()[1]} exp:{vs.expos:3.1f}s   {vs.comm}', end='')
+        if coords[vs.name] is None :
+            qprint(' Unknown object')
+            continue
+        if not visible[vs.name] :
+            qprint(' Not observable, deferred')
+            continue
         if args.submit :
-            r, i = brt.submitVarStar(vs.name, expos=vs.expos, comm=vs.comm)
+            r, i = res[vs.name]
             if r :
                 qprint(f' => id: {i}', end='')
             else :
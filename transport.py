@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+# coding: utf-8
+
+'''
+Rate-limited, retrying HTTP transport.
+
+The Transport object wraps the requests made with any requests session:
+it keeps a token bucket per host, caps the number of requests in flight,
+retries 5xx answers, 429 and timeouts (of the idempotent requests)
+with exponential backoff with jitter and counts what it did. One
+instance may (and should) be shared by all sessions talking to the
+same site.
+'''
+
+from __future__ import print_function, division, absolute_import
+
+import time
+import random
+import logging
+import threading
+from collections import Counter
+from urllib.parse import urlparse
+
+import requests
+
+from metrics import registry
+
+
+class TokenBucket :
+    '''
+    Token bucket: rate tokens per second, at most burst tokens stored.
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate=rate
+        self.burst=burst
+        self.tokens=burst
+        self.last=time.monotonic()
+        self.lock=threading.Lock()
+
+    def acquire(self):
+        '''
+        Take one token, sleeping until it is available.
+        Returns the time spent waiting (s).
+        '''
+        waited=0
+        while True:
+            with self.lock:
+                now=time.monotonic()
+                self.tokens=min(self.burst, self.tokens+(now-self.last)*self.rate)
+                self.last=now
+                if self.tokens >= 1 :
+                    self.tokens-=1
+                    return waited
+                dt=(1-self.tokens)/self.rate
+            time.sleep(dt)
+            waited+=dt
+
+
+class Transport :
+    '''
+    Shared transport layer for the HTTP requests.
+
+    rate, burst - token bucket parameters (requests/s) for each host
+    maxinflight - maximum number of concurrent requests
+    retries     - number of retries of failed requests
+    backoff     - base of the exponential backoff (s), capped at maxbackoff
+    timeout     - default timeout of the requests (s)
+    '''
+
+    def __init__(self, rate=5, burst=10, maxinflight=8, retries=4,
+                 backoff=1, maxbackoff=60, timeout=60):
+        self.rate=rate
+        self.burst=burst
+        self.retries=retries
+        self.backoff=backoff
+        self.maxbackoff=maxbackoff
+        self.timeout=timeout
+        self.inflight=threading.BoundedSemaphore(maxinflight)
+        self.buckets={}
+        self.stats=Counter()
+        self.lock=threading.Lock()
+
+    def bucket(self, host):
+        with self.lock:
+            try :
+                return self.buckets[host]
+            except KeyError :
+                b=self.buckets[host]=TokenBucket(self.rate, self.burst)
+                return b
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key]+=n
+        registry.inc('http_%s_total' % key, n)
+
+    def delay(self, attempt, rq=None):
+        '''
+        Backoff before the next attempt: full jitter exponential backoff,
+        or the Retry-After given by the server.
+        '''
+        try :
+            return min(self.maxbackoff, float(rq.headers['Retry-After']))
+        except (AttributeError, KeyError, TypeError, ValueError) :
+            return random.uniform(0, min(self.maxbackoff, self.backoff*2**attempt))
+
+    def _hold(self, rq):
+        '''
+        Keep the in-flight slot of the streamed response rq until
+        the response is closed (its body is read by the caller).
+        '''
+        close=rq.close
+        held=[True]
+
+        def release():
+            try :
+                close()
+            finally :
+                if held[0] :
+                    held[0]=False
+                    self.inflight.release()
+        rq.close=release
+
+    def request(self, s, method, url, retry=None, **kwargs):
+        '''
+        Do the request using the session s (as s.request would).
+        Transient failures are retried; the last failure is returned
+        (for HTTP errors) or raised (for timeouts and connection errors).
+        Timeouts and 5xx answers are retried only for the idempotent
+        methods (GET, HEAD) unless retry is given: a POST which timed
+        out may have been done by the server. 429 answers and connection
+        timeouts (the request was never sent) are always retried. Streamed responses (stream=True)
+        hold their in-flight slot until they are closed.
+        '''
+        log = logging.getLogger(__name__)
+        kwargs.setdefault('timeout', self.timeout)
+        if retry is None :
+            retry=method.upper() in ('GET', 'HEAD')
+        stream=kwargs.get('stream', False)
+        host=urlparse(url).netloc
+        attempt=0
+        while True:
+            if self.bucket(host).acquire() > 0 :
+                self.count('throttled')
+            rq=None
+            self.inflight.acquire()
+            try :
+                self.count('requests')
+                t0=time.monotonic()
+                rq=s.request(method, url, **kwargs)
+                registry.observe('http_request_seconds', time.monotonic()-t0,
+                                 host=host, method=method)
+                registry.inc('http_responses_total', host=host, code=rq.status_code)
+                if not stream :
+                    registry.inc('http_received_bytes_total', len(rq.content), host=host)
+            except (requests.Timeout, requests.ConnectionError) as e :
+                self.count('timeouts')
+                sent=not isinstance(e, requests.ConnectTimeout)
+                if attempt >= self.retries or (sent and not retry) :
+                    self.count('failures')
+                    raise
+                log.warning('%s %s failed: %s', method, url, e)
+            finally :
+                if rq is not None and stream :
+                    self._hold(rq)
+                else :
+                    self.inflight.release()
+            if rq is not None :
+                if rq.status_code == 429 :
+                    self.count('throttled_by_server')
+                elif rq.status_code < 500 or not retry :
+                    return rq
+                if attempt >= self.retries :
+                    self.count('failures')
+                    return rq
+                log.warning('%s %s returned %d', method, url, rq.status_code)
+                rq.close()
+            dt=self.delay(attempt, rq)
+            attempt+=1
+            self.count('retries')
+            log.info('Retry %d of %s %s in %.1fs', attempt, method, url, dt)
+            time.sleep(dt)
+
+
+# Transport shared by all Telescope objects by default
+default=Transport()
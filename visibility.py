@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# coding: utf-8
+
+'''
+Observability planner for the telescope sites.
+
+For all targets and the coming nights at once, the altitude of the
+targets, the Sun and the Moon are computed on a common time grid as
+numpy arrays (targets x times), giving the dark time each target spends
+above the altitude limit and away from the Moon. Precession, refraction
+and parallax are ignored: the result is meant for deciding whether
+to submit a target, not for pointing.
+'''
+
+from __future__ import print_function, division, absolute_import
+
+import numpy as np
+from astropy.time import Time
+from astropy.coordinates import EarthLocation, get_sun, get_body
+import astropy.units as u
+
+
+# Latitude, longitude (deg) and height (m) of the sites
+sites={
+    'teide': (28.2994, -16.5097, 2390),
+}
+
+# Site of the telescopes (the camera names of Telescope.cameratypes)
+telescope_site={
+    'CONSTELLATION': 'teide',
+    'GALAXY': 'teide',
+    'CLUSTER': 'teide',
+    'PLANET': 'teide',
+    'COAST': 'teide',
+    'PIRATE': 'teide',
+}
+
+
+def site(tele):
+    '''
+    Latitude, longitude (deg) and height (m) of the site of the
+    telescope tele (or of the site of that name).
+    '''
+    name=telescope_site.get(tele.upper(), tele.lower())
+    try :
+        return sites[name]
+    except KeyError :
+        raise ValueError('Unknown site of the telescope %s (see visibility.telescope_site)' % tele)
+
+
+def _altitude(ra, dec, lst, lat):
+    '''Altitude (deg) for the hour angles lst-ra; all angles in rad.'''
+    return np.degrees(np.arcsin(np.sin(dec)*np.sin(lat) +
+                                np.cos(dec)*np.cos(lat)*np.cos(lst-ra)))
+
+
+def _separation(ra1, dec1, ra2, dec2):
+    '''Angular distance (deg); angles in rad, broadcast.'''
+    c=(np.sin(dec1)*np.sin(dec2)+np.cos(dec1)*np.cos(dec2)*np.cos(ra1-ra2))
+    return np.degrees(np.arccos(np.clip(c, -1, 1)))
+
+
+def plan(coords, tele='COAST', start=None, nights=3, step=10,
+         min_alt=30, sun_alt=-12, min_moon=20):
+    '''
+    Observability of the targets (SkyCoord, scalar or array) from the
+    site of the telescope tele in the nights starting at start (Time,
+    default now), sampled every step minutes.
+
+    A time slot is usable for a target if the Sun is below sun_alt,
+    the target is above min_alt and the Moon is set or at least
+    min_moon degrees away.
+
+    Returns a dictionary of arrays (one value per target):
+    hours   - usable time (h)
+    first   - first usable time (MJD, NaN if none)
+    maxalt  - highest altitude in the dark (deg)
+    moonsep - smallest Moon distance in the usable slots (deg, NaN if none)
+    and dark - the total dark time of the period (h, scalar).
+    '''
+    lat, lon, height = site(tele)
+    t0=Time.now() if start is None else Time(start)
+    times=t0+np.arange(0, nights*24*60, step)*u.min
+    loc=EarthLocation(lat=lat*u.deg, lon=lon*u.deg, height=height*u.m)
+    lst=times.sidereal_time('mean', longitude=lon*u.deg).rad
+    phi=np.radians(lat)
+
+    sun=get_sun(times)
+    moon=get_body('moon', times, loc)
+    dark=_altitude(sun.ra.rad, sun.dec.rad, lst, phi) < sun_alt
+    moonup=_altitude(moon.ra.rad, moon.dec.rad, lst, phi) > 0
+
+    c=coords.icrs
+    ra=np.atleast_1d(c.ra.rad)[:, None]
+    dec=np.atleast_1d(c.dec.rad)[:, None]
+    alt=_altitude(ra, dec, lst, phi)
+    msep=_separation(ra, dec, moon.ra.rad, moon.dec.rad)
+    ok=dark & (alt >= min_alt) & (~moonup | (msep >= min_moon))
+
+    anyok=ok.any(axis=1)
+    first=np.where(anyok, times.mjd[np.argmax(ok, axis=1)], np.nan)
+    return {
+        'hours': ok.sum(axis=1)*step/60,
+        'first': first,
+        'maxalt': np.where(dark, alt, -90).max(axis=1),
+        'moonsep': np.where(anyok, np.where(ok, msep, 180).min(axis=1), np.nan),
+        'dark': dark.sum()*step/60,
+    }
+
+
+def observable(coords, tele='COAST', min_hours=0.5, **kwargs):
+    '''
+    Boolean array: the targets have at least min_hours of usable time
+    in the planned period (see plan for the other parameters).
+    '''
+    return plan(coords, tele, **kwargs)['hours'] >= min_hours
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+# coding: utf-8
+
+'''
+Watch the open requests and process the new jobs as they complete.
+
+The Watcher polls the request mirror (which fetches only the pages
+holding new and non-terminal requests) at an adaptive interval: short
+while some request is being observed, doubling up to the maximum while
+nothing changes. While some request is active (or changed), every poll
+runs a single job search over the time since the previous search, and
+each new job is handed to the process function at once. The processed
+jobs are remembered in the mirror database, so restarts do not repeat
+the work; the jobs whose processing failed are kept there too and
+retried later with a growing delay.
+'''
+
+from __future__ import print_function, division, absolute_import
+
+import time
+import json
+import logging
+
+from metrics import registry as metrics
+
+# Request states meaning that the observation is under way
+# (see Telescope.REQUESTSTATUS_TEXTS)
+BUSY_STATUSES=(4, 7)
+
+
+class Watcher :
+    '''
+    brt          - Telescope session
+    mirror       - RequestMirror of the watched folder
+    process      - function called with the record (see
+                   Telescope.scan_jobs) of every new job
+    min_interval - shortest polling interval (s)
+    max_interval - longest polling interval (s)
+    lookback     - time range searched for jobs at the first check (s)
+    overlap      - each search repeats this much of the previous one (s),
+                   catching the jobs which appear in the results late
+    retry        - first delay before processing a failed job again (s),
+                   doubled at every failure up to a day
+    '''
+
+    def __init__(self, brt, mirror, process, min_interval=120, max_interval=1800,
+                 lookback=86400, overlap=3600, retry=600):
+        self.brt=brt
+        self.mirror=mirror
+        self.process=process
+        self.min_interval=min_interval
+        self.max_interval=max_interval
+        self.interval=min_interval
+        self.overlap=overlap
+        self.retry=retry
+        self.last_search=self.now()-lookback
+        self.db=mirror.db
+        self.db.execute('create table if not exists processed (jid integer primary key, t real)')
+        self.db.execute('create table if not exists failed '
+                        '(jid integer primary key, rec text, tries integer, retry real)')
+        self.db.commit()
+
+    @staticmethod
+    def now():
+        # Time scale of the job search (see Telescope.get_obs_list)
+        return time.time()-time.timezone
+
+    def is_processed(self, jid):
+        return self.db.execute('select 1 from processed where jid=?', (jid,)).fetchone() is not None
+
+    def is_failed(self, jid):
+        return self.db.execute('select 1 from failed where jid=?', (jid,)).fetchone() is not None
+
+    def new_jobs(self):
+        '''
+        Records of the jobs completed since the previous search which
+        were not processed (or tried) yet.
+        '''
+        end=self.now()
+        start=self.last_search-self.overlap
+        recs=[r for r in self.brt.scan_jobs(start, end+60, window=max(86400, end+60-start))
+                if not self.is_processed(r['jid']) and not self.is_failed(r['jid'])]
+        self.last_search=end
+        return recs
+
+    def retry_jobs(self):
+        '''
+        Records of the failed jobs due for another attempt.
+        '''
+        return [json.loads(r[0]) for r in self.db.execute(
+                    'select rec from failed where retry<=? order by jid', (time.time(),))]
+
+    def run_job(self, rec):
+        '''
+        Process the job; record it as processed, or as failed with
+        the time of the next attempt. Returns True on success.
+        '''
+        log = logging.getLogger(__name__)
+        jid=rec['jid']
+        try :
+            self.process(rec)
+        except Exception as e :
+            r=self.db.execute('select tries from failed where jid=?', (jid,)).fetchone()
+            tries=1 if r is None else r[0]+1
+            delay=min(86400, self.retry*2**(tries-1))
+            log.error('Processing of job %d failed (%d times, retry in %ds): %s',
+                      jid, tries, delay, e)
+            metrics.inc('watch_failures_total')
+            with self.db :
+                self.db.execute('insert or replace into failed values (?,?,?,?)',
+                                (jid, json.dumps(rec), tries, time.time()+delay))
+            return False
+        with self.db :
+            self.db.execute('insert or replace into processed values (?,?)', (jid, time.time()))
+            self.db.execute('delete from failed where jid=?', (jid,))
+        metrics.inc('watch_jobs_total')
+        return True
+
+    def check(self):
+        '''
+        One poll: sync the requests, search the new jobs if some request
+        is active or changed, process them and the failed jobs due for
+        a retry and adapt the interval. Returns the number of processed jobs.
+        '''
+        log = logging.getLogger(__name__)
+        changes=self.mirror.poll(self.brt)
+        for r, old in changes:
+            log.info('Request %s %s: %s -> %s', r.get('rid', r.get('id')), r.get('objectname'),
+                     old, r['status'])
+        active=self.mirror.active()
+        jobs=self.retry_jobs()
+        # A request may stay in one state while more of its jobs complete
+        if changes or active :
+            jobs+=self.new_jobs()
+        n=0
+        for rec in jobs:
+            log.info('Job %d', rec['jid'])
+            if self.run_job(rec) :
+                n+=1
+        if changes or any(int(r['status']) in BUSY_STATUSES for r in active):
+            self.interval=self.min_interval
+        elif not active :
+            self.interval=self.max_interval
+        else :
+            self.interval=min(self.max_interval, self.interval*2)
+        metrics.set('watch_active_requests', len(active))
+        metrics.set('watch_interval_seconds', self.interval)
+        return n
+
+    def run(self, stop=None):
+        '''
+        Poll until stop() returns true (forever by default).
+        '''
+        log = logging.getLogger(__name__)
+        while stop is None or not stop():
+            try :
+                self.check()
+            except Exception as e :
+                # Network trouble: keep watching, at the longest interval
+                log.warning('Watch poll failed: %s', e)
+                self.interval=self.max_interval
+            log.debug('Next poll in %ds', self.interval)
+            time.sleep(self.interval)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+# coding: utf-8
+
+'''
+Streaming reader of zip archives.
+
+The members are decoded from the local file headers as the bytes
+arrive (e.g. from requests' iter_content), without waiting for the
+central directory at the end of the archive. Stored and deflated
+members are supported, with or without the data descriptor (the end
+of a stored member is found by scanning for the descriptor matching
+its size and CRC); ZIP64 is not (the job archives are far below 4GB). The archive must end
+with its central directory: the number of members is checked against
+it, so a truncated stream is an error and never a shorter archive.
+'''
+
+from __future__ import print_function, division, absolute_import
+
+import zlib
+import struct
+from zipfile import BadZipFile
+
+
+LOCAL_HEADER=b'PK\x03\x04'
+DESCRIPTOR=b'PK\x07\x08'
+CENTRAL_HEADER=b'PK\x01\x02'
+END_RECORD=b'PK\x05\x06'
+ZIP64_END_RECORD=b'PK\x06\x06'
+
+
+class _Buffer :
+    '''Byte reader over an iterator of chunks.'''
+
+    def __init__(self, chunks):
+        self.chunks=iter(chunks)
+        self.buf=bytearray()
+
+    def _fill(self, n):
+        while len(self.buf) < n :
+            try :
+                self.buf+=next(self.chunks)
+            except StopIteration :
+                return False
+        return True
+
+    def read(self, n):
+        if not self._fill(n) :
+            raise BadZipFile('Truncated zip stream')
+        r=bytes(self.buf[:n])
+        del self.buf[:n]
+        return r
+
+    def read_some(self, n):
+        '''Up to n bytes (at least one), fetching a chunk if needed.'''
+        if not self.buf and not self._fill(1) :
+            raise BadZipFile('Truncated zip stream')
+        r=bytes(self.buf[:n])
+        del self.buf[:n]
+        return r
+
+    def unread(self, data):
+        self.buf[:0]=data
+
+
+def _inflate(buf, csize):
+    d=zlib.decompressobj(-15)
+    out=[]
+    if csize is None :
+        # Size in the data descriptor: inflate until the end of the stream
+        while not d.eof :
+            out.append(d.decompress(buf.read_some(65536)))
+        buf.unread(d.unused_data)
+    else :
+        while csize > 0 :
+            c=buf.read_some(min(csize, 65536))
+            csize-=len(c)
+            out.append(d.decompress(c))
+        out.append(d.flush())
+    return b''.join(out)
+
+
+def _stored(buf):
+    '''
+    Data of a stored member with the data descriptor: the bytes up to
+    the first descriptor (signed or not) whose sizes and CRC match them.
+    The descriptor is consumed. Returns the data and the CRC.
+    '''
+    data=bytearray()
+    pos=0
+    while True :
+        data+=buf.read_some(65536)
+        while True :
+            i=data.find(b'PK', pos)
+            if i < 0 :
+                pos=max(0, len(data)-1)
+                break
+            if len(data) < i+16 :
+                # Not enough bytes to check the candidate yet
+                pos=i
+                break
+            sig=bytes(data[i:i+4])
+            if sig == DESCRIPTOR :
+                n, end = i, i+16
+                crc, csize, usize = struct.unpack('<III', data[i+4:i+16])
+            elif sig in (LOCAL_HEADER, CENTRAL_HEADER) and i >= 12 :
+                n, end = i-12, i
+                crc, csize, usize = struct.unpack('<III', data[i-12:i])
+            else :
+                n=None
+            if n is not None and csize == usize == n and zlib.crc32(data[:n]) & 0xffffffff == crc :
+                buf.unread(data[end:])
+                return bytes(data[:n]), crc
+            pos=i+1
+
+
+def _extra_ids(extra):
+    '''IDs of the fields of the extra field block.'''
+    ids=[]
+    while len(extra) >= 4 :
+        i, n = struct.unpack('<HH', extra[:4])
+        ids.append(i)
+        extra=extra[4+n:]
+    return ids
+
+
+def _central_directory(buf):
+    '''
+    Read the central directory up to the end record.
+    Returns the number of entries (counted and recorded).
+    '''
+    n=0
+    while True :
+        sig=buf.read(4)
+        if sig == CENTRAL_HEADER :
+            nlen, elen, clen = struct.unpack('<24xHHH12x', buf.read(42))
+            buf.read(nlen+elen+clen)
+            n+=1
+        elif sig == END_RECORD :
+            total=struct.unpack('<6xH10x', buf.read(18))[0]
+            return n, total
+        elif sig == ZIP64_END_RECORD :
+            raise BadZipFile('ZIP64 archives are not supported')
+        else :
+            raise BadZipFile('Bad record in the central directory')
+
+
+def iter_members(chunks):
+    '''
+    Generator of (name, data) of the members of the zip archive
+    arriving as the iterator of byte chunks. Each member is yielded
+    as soon as its last byte arrived; the CRC is checked. Raises
+    BadZipFile if the stream ends before the central directory or
+    the directory lists another number of members.
+    '''
+    buf=_Buffer(chunks)
+    count=0
+    while True :
+        sig=buf.read(4)
+        if sig in (CENTRAL_HEADER, END_RECORD) :
+            buf.unread(sig)
+            break
+        if sig != LOCAL_HEADER :
+            raise BadZipFile('Bad local header of member %d' % (count+1))
+        (ver, flag, method, mtime, mdate, crc, csize, usize,
+            nlen, elen) = struct.unpack('<HHHHHIIIHH', buf.read(26))
+        name=buf.read(nlen).decode('cp437' if not flag & 0x800 else 'utf-8')
+        extra=buf.read(elen)
+        if flag & 1 :
+            raise BadZipFile('%s: encrypted members are not supported' % name)
+        if 0xffffffff in (csize, usize) or 0x0001 in _extra_ids(extra) :
+            raise BadZipFile('%s: ZIP64 members are not supported' % name)
+        descriptor=bool(flag & 8)
+        if method == 8 :
+            data=_inflate(buf, None if descriptor else csize)
+            if descriptor :
+                d=buf.read(4)
+                if d == DESCRIPTOR :
+                    d=buf.read(4)
+                crc=struct.unpack('<I', d)[0]
+                buf.read(8)
+        elif method == 0 and descriptor :
+            data, crc = _stored(buf)
+        elif method == 0 :
+            data=buf.read(csize)
+        else :
+            raise BadZipFile('%s: unsupported compression %d' % (name, method))
+        if zlib.crc32(data) & 0xffffffff != crc :
+            raise BadZipFile('Bad CRC of %s' % name)
+        count+=1
+        yield name, data
+    n, total = _central_directory(buf)
+    if not n == total == count :
+        raise BadZipFile('%d members read, the central directory lists %d' % (count, total))